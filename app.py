@@ -11,35 +11,46 @@
 # TODO 2 - show directory name in bold?
 # TODO 3 - where it says [Resume] should show how many mins:secs have been watched (ideally also percentage through movie)
 # TODO 4 - show movie duration
-# TODO 5 - pick the (eng) audio stream, and if none then burn in subtitles (eng)
+# TODO 5 - pick the (eng) audio stream, and if none then show subtitles (eng)
+#   (done, transcode_plan picks the eng audio stream and play_file turns on
+#   the subtitles, converted to WebVTT rather than burnt in, see --subtitle_dir)
 # TODO 6 - if you resume, with subtitles, the offset is wrong, as
 #  Chromecast thinks it's starting from 0 but ffmpeg starts from offset,
 #  to fix it need to use mc.seek() instead of ffmpeg -ss.
+#  (this is done when using --hls)
 
 
 import argparse
-import datetime # used when eval(MediaStatus)
+import atexit
+import base64
+import binascii
+import bisect
+import datetime
 import glob
+import hashlib
+import itertools
 import json
 import logging, logging.handlers
 import os
 import re
+import select
+import shelve
+import shutil
 import subprocess
 import sys
-from natsort import natsorted
-from natsort import natsort_keygen
-from pydal import DAL, Field
 import pprint
-import signal
+import queue
 import socket
 import time
 import threading
 import urllib.parse
-import pychromecast
-from functools import partial
+import uuid
 from subprocess import Popen, PIPE, DEVNULL
-from flask import Flask, Response, jsonify, redirect, render_template, request, url_for, stream_with_context
+from flask import Flask, Response, jsonify, redirect, render_template, request, url_for
 from flask_cors import CORS
+from werkzeug.datastructures import ContentRange
+from werkzeug.http import is_resource_modified
+from werkzeug.wsgi import wrap_file
 #from flask.helpers import make_response
 
 
@@ -51,19 +62,77 @@ port = 5000
 movie_dir = '/mnt/cifs/shared/video/movies'
 stream_url = None   # will become something like 'http://192.168.1.30:{port}/api/v1/stream?file='
 download_url = None # ditto
-audio_file_ext = ['.mp3', '.opus', '.ogg', '.flac', '.wav']
+subtitles_url = None # ditto, 'http://192.168.1.30:{port}/api/v1/subtitles?file='
+hls_url = None      # ditto, 'http://192.168.1.30:{port}/api/v1/hls/'
+direct_url = None   # ditto, 'http://192.168.1.30:{port}/api/v1/direct/'
+direct_play = True  # send files which the Chromecast can play as they are, without ffmpeg
+audio_file_ext = ['mp3', 'flac', 'ogg', 'oga', 'opus', 'wav', 'm4a', 'aac', 'wma']
 video_file_ext = ['avi', 'mov', 'mkv', 'mp4', 'flv', 'ts']
 cast = None
-global_file_playing = None
-global_pid = None
-global_process = None
-global_duration = -1
-global_seekpos = 0
+cast_lock = threading.Lock()
+cast_discovery_lock = threading.Lock() # held while discovery is running
+cast_shelf_file = 'ccastplayer.shelf' # the saved address of the Chromecast
+browser = None # the pychromecast discovery browser
+cast_backend = 'pychromecast' # or 'fake' for the in-process fake Chromecast in fakecast.py
+fake_cast_bitrate = 8000000 # bits per second at which the fake Chromecast pulls streams
+session_start_timeout = 60 # seconds for the Chromecast to start playing a new session
+album_queue_max = 100 # the most tracks added to the Chromecast's queue by album=1
+monitor_poll_interval = 10 # seconds between samples of the Chromecast position when not playing
 chunk_size = 2048
+file_chunk_size = 1024*1024 # when sending files which can't use sendfile
+transcode_max = 2 # ffmpeg processes which can be streaming at once
+transcode_queue_timeout = 20 # seconds to wait for one of them to finish
+transcode_stop_timeout = 2 # seconds to wait at each step when stopping ffmpeg
+transcode_nice = 0 # niceness of the ffmpeg processes
+transcode_ionice = None # I/O scheduling class of the ffmpeg processes (see ionice -c), None to leave alone
+transcode_cpus = None # set of CPUs ffmpeg may run on, None for all
+transcode_threads = 0 # threads for each ffmpeg process, 0 for the ffmpeg default
+transcode_slow_speed = 1.0 # warn if a transcode runs slower than this (times real time)
+transcode_slow_window = 30 # for this many seconds
+transcode_cache_dir = None # directory to keep transcoded output, None to disable
+transcode_cache_size = 20*1024*1024*1024 # maximum bytes in transcode_cache_dir
+remux_dir = None # directory for pre-remuxed files, None to disable
+remux_size = 50*1024*1024*1024 # maximum bytes in remux_dir
+remux_workers = 1 # number of ffmpeg processes remuxing at once
+remux_nice = 19 # niceness of the remuxing ffmpeg processes
+remux_recent = 5 # number of recently watched and recently added files to consider
+remux_interval = 60*60 # seconds between looking for files to remux
+transcode_device = 'auto' # device profile for transcoding, auto to use the Chromecast model
+prefetch_at = 0.95 # fraction of the way through a file when the next one is prefetched, 0 to disable
+prefetch_bytes = 32*1024*1024 # the most of the next file's stream kept in memory
+prefetch_max_age = 15*60 # seconds a prefetched stream is kept if the next file isn't played
+thumb_dir = None # directory for thumbnails and seek sprites, None to disable
+thumb_workers = 2 # number of ffmpeg processes making thumbnails at once
+thumb_nice = 19 # niceness of the thumbnail ffmpeg processes
+thumb_width = 320 # pixels, of the poster frame
+sprite_tile_width = 160 # pixels, of each frame in the sprite sheet
+sprite_columns = 10 # frames across the sprite sheet
+sprite_rows = 10 # frames down the sprite sheet
+thumb_max_age = 365*24*60*60 # seconds a client may cache a thumbnail
+hls_dir = None # directory for HLS segments, None to stream a single MP4 instead
+hls_segment_time = 6 # seconds
+hls_lookahead = 5 # segments ahead of ffmpeg which can be waited for rather than restarting ffmpeg
+hls_segment_timeout = 60 # seconds to wait for a segment to be written
+hls_keep_dirs = 5 # number of files for which to keep the segments
+subtitle_max_age = 24*60*60 # seconds a client may cache subtitle files
+subtitle_dir = None # directory for subtitles converted to WebVTT, None to only use .vtt files
+subtitle_language = 'en' # language of the subtitles for subtitles=1, and shown if there's no audio in it
+subtitle_nice = 19 # niceness of the ffmpeg processes converting subtitles
+seekpos_checkpoint_interval = 10 # seconds between saving the seek position while playing
+library_db_file = 'ccastplayer_library.sqlite'
+library_max_age = 15*60 # seconds before the home page triggers a background rescan
+home_page_size = 0 # files listed on each page of the home page, 0 for all
+home_chunk_files = 100 # files rendered into each chunk of the streamed home page
 standalone = True
 debug = True
 
 
+# pydal, pychromecast and natsort are slow to import so they are imported
+# by the functions which use them, not here. That keeps the time taken to
+# start a (gunicorn) worker short: the library scan and Chromecast discovery
+# import them in the background and the first page is served without
+# waiting for pychromecast.
+
 # ---------------------------------------------------------------------
 # Configure logging
 # Uncomment the basicConfig lines to see output from Flask/pychromecast.
@@ -92,8 +161,8 @@ if not logs_dir:
     print('ERROR: cannot find a suitable logs directory', file=sys.stderr)
     exit(1)
 
-# Configure logging if run under gunicorn
-if "gunicorn" in os.environ.get("SERVER_SOFTWARE", ""):
+# Configure logging if run under gunicorn (or by asgi.py, which sets SERVER_SOFTWARE)
+if re.search('gunicorn|asgi', os.environ.get("SERVER_SOFTWARE", "")):
     standalone = False
     # Set the Flask app.logger to be "gunicorn.error"
     # in case any gunicorn/flask internals use app.logger,
@@ -151,6 +220,7 @@ def get_local_ip():
 class SeekDB:
     # Not used yet!
     def __init__(self):
+        from pydal import DAL, Field
         self.db = DAL('sqlite://ccastplayer.sqlite', folder='.')
         self.db.define_table('SeekPos', Field('file', unique=True), Field('seek'), Field('last_modified', type='datetime'))
     def get_seekpos(self, filename):
@@ -172,36 +242,91 @@ class SeekDB:
             print(row)
 
 
+# The whole SeekPos table is loaded into memory when the database is first
+# opened and the in-memory copy is used for all reads. Updates are applied
+# to the in-memory copy immediately and queued for a background thread to
+# write to the database (which is in WAL mode so writes don't block reads).
+
 global_db = None
+global_db_lock = threading.Lock()
+global_db_queue = queue.Queue()
+global_seekpos_cache = {}   # filename -> { 'seek': seconds, 'last_modified': datetime }
+global_seekpos_version = 0  # incremented when any seek position changes
 
 def db_init():
     """ Open and configure the database. Call this to get a db handle
     before any reading or writing. Internal use only """
 
     global global_db
-    if not global_db:
-        global_db = DAL('sqlite://ccastplayer.sqlite', folder='.')
-        global_db.define_table('SeekPos', Field('file', unique=True), Field('seek'), Field('last_modified', type='datetime'))
+    global global_seekpos_cache
+    with global_db_lock:
+        if not global_db:
+            from pydal import DAL, Field
+            db = DAL('sqlite://ccastplayer.sqlite', folder='.')
+            db.executesql('PRAGMA journal_mode=WAL')
+            db.define_table('SeekPos', Field('file', unique=True), Field('seek'), Field('last_modified', type='datetime'))
+            # Load the whole table in a single query
+            cache = {}
+            for row in db().select(db.SeekPos.ALL):
+                cache[row.file] = { 'seek': row.seek, 'last_modified': row.last_modified }
+            global_seekpos_cache = cache
+            global_db = db
+            threading.Thread(target = db_writer, daemon = True).start()
+            atexit.register(db_flush)
+            app_logger.debug('Loaded %d seek positions from database' % len(cache))
     return global_db
 
 
+def db_writer():
+    """ Background thread which writes queued seek position updates
+    to the database. If several updates for the same file are queued
+    only the latest is written, and they are committed together. """
+
+    db = global_db
+    while True:
+        items = [global_db_queue.get()]
+        while not global_db_queue.empty():
+            items.append(global_db_queue.get())
+        latest = {}
+        for filename, seekpos, last_modified in items:
+            latest[filename] = (seekpos, last_modified)
+        try:
+            for filename, (seekpos, last_modified) in latest.items():
+                db.SeekPos.update_or_insert(db.SeekPos.file == filename, file = filename, seek = seekpos, last_modified = last_modified)
+            db.commit()
+        except Exception as e:
+            app_logger.error('Cannot write seek positions to database: %s' % e)
+            db.rollback()
+        for item in items:
+            global_db_queue.task_done()
+
+
+def db_flush():
+    """ Wait until all queued updates have been written to the database """
+
+    if global_db:
+        global_db_queue.join()
+
+
 def db_get_seekpos(filename):
     """ Return the seek position for the given filename, or None if not found. """
 
-    db = db_init()
-    for row in db(db.SeekPos.file == filename).select(db.SeekPos.seek):
-        #app_logger.debug('Got seek position %s for %s' % (row, filename))
-        return row['seek']
-    return None
+    db_init()
+    row = global_seekpos_cache.get(filename)
+    return row['seek'] if row else None
 
 
 def db_update_seekpos(filename, seekpos):
     """ Add a record to the database (or update an existing record)
-        with a value of seekpos for the given filename. """
-
-    db = db_init()
-    db.SeekPos.update_or_insert(db.SeekPos.file == filename, file = filename, seek = seekpos, last_modified = datetime.datetime.now())
-    db.commit()
+        with a value of seekpos for the given filename.
+        The database is written by a background thread. """
+
+    global global_seekpos_version
+    db_init()
+    last_modified = datetime.datetime.now()
+    global_seekpos_cache[filename] = { 'seek': seekpos, 'last_modified': last_modified }
+    global_seekpos_version += 1
+    global_db_queue.put((filename, seekpos, last_modified))
     app_logger.debug('Set seek position %s for %s' % (seekpos, filename))
 
 
@@ -209,78 +334,918 @@ def db_get_last_modified(filename):
     """ Return the last_modified time of the filename in the database, or 0.
     This will be the time when a seek position was updated. """
 
-    db = db_init()
+    db_init()
     null_date = datetime.datetime(2000,1,1)
-    for row in db(db.SeekPos.file == filename).select(db.SeekPos.last_modified):
-        #app_logger.debug('Got last modified %s for %s' % (row, filename))
-        return row['last_modified'] if row['last_modified'] else null_date
-    return null_date
+    row = global_seekpos_cache.get(filename)
+    return row['last_modified'] if row and row['last_modified'] else null_date
 
 
 def db_dump():
     """ Print all rows in the database """
 
     db = db_init()
+    db_flush()
     for row in db().select(db.SeekPos.ALL):
         print(row)
 
 
 # ---------------------------------------------------------------------
-# This function never exits, it periodically queries the Chromecast status
-# and updates global variables with the current seek position.
-# It is started as a separate thread running in the background.
+# Maintain a persistent index of the media files underneath movie_dir
+# so the home page does not have to walk the whole tree on every request,
+# which is very slow on a network mount. The mtime of every directory is
+# remembered, and a rescan only lists the directories whose mtime has
+# changed (i.e. files added, removed or renamed). The index is kept in a
+# database next to the seek position database.
+
+class LibraryIndex:
+    """ In-memory index of media files, backed by a sqlite database.
+    files maps a path relative to movie_dir to a dict with keys
+      path, dir, size, mtime, atime, subtitles (there is a .vtt or .srt file)
+    plus name (the prettyname) and sort_key (the natsort key of the path)
+    which are worked out when the entry is added rather than for every request.
+    dirs maps a directory relative to movie_dir ('' is movie_dir itself)
+    to a dict with keys mtime, subdirs.
+    version is incremented whenever the set of files changes.
+    """
 
-def monitor_chromecast(cast):
-    """ Periodically get the status of the Chromecast
-    if streaming our file then remember the current seek position (duration)
-    otherwise assume streaming stopped so kill the ffmpeg process
-    then write the final duration to the database.
+    def __init__(self, db_file = library_db_file):
+        self.db_file = db_file
+        self.db = None
+        self.lock = threading.Lock()      # protects files, dirs, version
+        self.db_lock = threading.Lock()   # protects opening the database
+        self.scan_lock = threading.Lock() # only one scan at a time
+        self.root = None
+        self.files = {}
+        self.dirs = {}
+        self.version = 0
+        self.last_scan = None
+        self.sort_cache = {}              # sort -> (version, entries, keys), see sorted_files
+        self.natsort_keygen = None
+
+    def add_keys(self, entry):
+        """ Add the display name and natural sort key to the entry """
+        if not self.natsort_keygen:
+            from natsort import natsort_keygen
+            self.natsort_keygen = natsort_keygen()
+        entry['name'] = prettyname(entry['path'])
+        entry['sort_key'] = self.natsort_keygen(entry['path'])
+        return entry
+
+    def db_init(self):
+        """ Open the database and load the index for movie_dir into memory """
+        with self.db_lock:
+            if not self.db:
+                from pydal import DAL, Field
+                self.db = DAL('sqlite://' + self.db_file, folder='.')
+                self.db.define_table('LibraryDir', Field('root'), Field('path'),
+                    Field('mtime', type='double'), Field('subdirs', type='json'))
+                self.db.define_table('LibraryFile', Field('root'), Field('path'), Field('dir'),
+                    Field('size', type='bigint'), Field('mtime', type='double'),
+                    Field('atime', type='double'), Field('subtitles', type='boolean'))
+                self.db.define_table('ProbeCache', Field('path', unique=True),
+                    Field('size', type='bigint'), Field('mtime', type='double'), Field('probe', type='json'))
+            if self.root != movie_dir:
+                db = self.db
+                dirs = {}
+                for row in db(db.LibraryDir.root == movie_dir).select():
+                    dirs[row.path] = { 'mtime': row.mtime, 'subdirs': row.subdirs or [] }
+                files = {}
+                for row in db(db.LibraryFile.root == movie_dir).select():
+                    files[row.path] = self.add_keys({ 'path': row.path, 'dir': row.dir,
+                        'size': row.size, 'mtime': row.mtime, 'atime': row.atime,
+                        'subtitles': row.subtitles })
+                with self.lock:
+                    self.root = movie_dir
+                    self.dirs = dirs
+                    self.files = files
+                    self.version += 1
+                app_logger.debug('Library loaded %d files in %d directories' % (len(files), len(dirs)))
+            return self.db
+
+    def read_dir(self, reldir):
+        """ List one directory, return a list of subdirectories
+        and a list of media file entries (both relative to movie_dir) """
+        absdir = os.path.join(movie_dir, reldir)
+        ext_regex = '.*\.(' + '|'.join(video_file_ext + audio_file_ext) + ')$'
+        subdirs = []
+        entries = []
+        with os.scandir(absdir) as it:
+            dirents = list(it)
+        # movie.mp4.vtt, movie.srt, movie.eng.srt etc. are subtitles of movie.mp4
+        sidecars = set()
+        for ent in dirents:
+            if is_subtitle_sidecar(ent.name):
+                sidecars.update(target for target, tag in subtitle_sidecar_targets(ent.name))
+        for ent in dirents:
+            try:
+                if ent.is_dir():
+                    subdirs.append(os.path.join(reldir, ent.name))
+                elif re.match(ext_regex, ent.name):
+                    st = ent.stat()
+                    entries.append(self.add_keys({ 'path': os.path.join(reldir, ent.name), 'dir': reldir,
+                        'size': st.st_size, 'mtime': st.st_mtime, 'atime': st.st_atime,
+                        'subtitles': ent.name in sidecars or os.path.splitext(ent.name)[0] in sidecars }))
+            except OSError as e:
+                app_logger.debug('Library cannot stat %s: %s' % (ent.path, e))
+        return subdirs, entries
+
+    def scan(self, full = False):
+        """ Bring the index up to date with the filesystem.
+        Only directories whose mtime has changed are read again,
+        unless full is True in which case every directory is read. """
+        with self.scan_lock:
+            db = self.db_init()
+            start = time.time()
+            new_dirs = {}
+            changed = {}
+            seen = set()
+            stack = ['']
+            while stack:
+                reldir = stack.pop()
+                try:
+                    st = os.stat(os.path.join(movie_dir, reldir))
+                except OSError as e:
+                    app_logger.debug('Library cannot stat %s: %s' % (reldir, e))
+                    continue
+                # Avoid loops caused by following symlinks
+                if (st.st_dev, st.st_ino) in seen:
+                    continue
+                seen.add((st.st_dev, st.st_ino))
+                old = self.dirs.get(reldir)
+                if old and old['mtime'] == st.st_mtime and not full:
+                    new_dirs[reldir] = old
+                    stack.extend(old['subdirs'])
+                    continue
+                try:
+                    subdirs, entries = self.read_dir(reldir)
+                except OSError as e:
+                    app_logger.debug('Library cannot read %s: %s' % (reldir, e))
+                    continue
+                new_dirs[reldir] = { 'mtime': st.st_mtime, 'subdirs': subdirs }
+                changed[reldir] = entries
+                stack.extend(subdirs)
+            removed = set(self.dirs) - set(new_dirs)
+            stale = removed | set(changed)
+
+            # Swap in the new index
+            files = { path: entry for path, entry in self.files.items() if entry['dir'] not in stale }
+            for entries in changed.values():
+                for entry in entries:
+                    files[entry['path']] = entry
+            with self.lock:
+                if stale:
+                    self.version += 1
+                self.files = files
+                self.dirs = new_dirs
+                self.last_scan = time.time()
+            if stale:
+                thumb_wakeup.set()
+
+            # Write the changes back to the database
+            for reldir in stale:
+                db((db.LibraryFile.root == movie_dir) & (db.LibraryFile.dir == reldir)).delete()
+                db((db.LibraryDir.root == movie_dir) & (db.LibraryDir.path == reldir)).delete()
+            for reldir, entries in changed.items():
+                db.LibraryDir.insert(root = movie_dir, path = reldir, **new_dirs[reldir])
+                for entry in entries:
+                    db.LibraryFile.insert(root = movie_dir, path = entry['path'], dir = entry['dir'],
+                        size = entry['size'], mtime = entry['mtime'], atime = entry['atime'],
+                        subtitles = entry['subtitles'])
+            db.commit()
+            app_logger.debug('Library scan of %d directories (%d changed, %d removed) took %.3f seconds' %
+                (len(new_dirs), len(changed), len(removed), time.time() - start))
+
+    def scan_in_background(self, full = False):
+        """ Start a thread to rescan the library. Returns immediately.
+        Does nothing if a scan is already running. """
+        if self.scan_lock.locked():
+            return
+        threading.Thread(target = self.scan, kwargs = { 'full': full }, daemon = True).start()
+
+    def get_files(self):
+        """ Return a list of the file entries in the index.
+        The first call will scan the library if it has never been scanned,
+        otherwise a background rescan is started if the index is out of date. """
+        self.db_init()
+        if not self.dirs:
+            self.scan()
+        elif not self.last_scan or time.time() - self.last_scan > library_max_age:
+            self.scan_in_background()
+        with self.lock:
+            return list(self.files.values())
+
+    def sorted_files(self, sort):
+        """ Return (entries, keys) where entries is the list of file entries
+        sorted by name, mtime, atime or wtime (the newest first for the times)
+        and keys is the list of their library_sort_key()s, in ascending order
+        so it can be searched with bisect. The result is kept until the index
+        (or for wtime the seek positions) change. """
+        entries = self.get_files()
+        if sort == 'wtime':
+            db_init() # load the seek positions
+        version = (self.version, global_seekpos_version if sort == 'wtime' else 0)
+        with self.lock:
+            cached = self.sort_cache.get(sort)
+        if cached and cached[0] == version:
+            return cached[1], cached[2]
+        decorated = sorted((library_sort_key(sort, entry['path'], library_sort_value(sort, entry), entry['sort_key']), entry)
+            for entry in entries)
+        keys = [x[0] for x in decorated]
+        entries = [x[1] for x in decorated]
+        with self.lock:
+            self.sort_cache[sort] = (version, entries, keys)
+        return entries, keys
+
+
+def library_sort_value(sort, entry):
+    """ Return the value (other than the path) which entries are sorted on """
+    if sort in ('mtime', 'atime'):
+        return entry[sort]
+    if sort == 'wtime':
+        row = global_seekpos_cache.get(urlencode(entry['path']))
+        return row['last_modified'].timestamp() if row and row['last_modified'] else 0
+    return None
+
+
+def library_sort_key(sort, path, value, natural_key = None):
+    """ Return the key for sorting an entry with the given path and
+    library_sort_value, in ascending order (so the times are negated) """
+    if sort in ('mtime', 'atime', 'wtime'):
+        return (-value, path)
+    if natural_key is None:
+        natural_key = library.add_keys({ 'path': path })['sort_key']
+    return (natural_key, path)
+
+
+library = LibraryIndex()
+
+
+# ---------------------------------------------------------------------
+# Cache the output of ffprobe, keyed on the path, size and mtime of the file,
+# so that playing (or resuming) a file which has been probed before doesn't
+# have to run ffprobe again. The cache is kept in memory and in the library
+# database. The JSON output of ffprobe looks like this (abbreviated):
+#  { "streams": [ { "index": 0, "codec_name": "h264", "codec_type": "video",
+#                   "width": 1920, "height": 818, "tags": { "language": "eng" } },
+#                 { "index": 1, "codec_name": "dts", "codec_type": "audio",
+#                   "channels": 6, "tags": { "language": "tib" } }, ... ],
+#    "format": { "format_name": "matroska,webm", "duration": "6504.500000", ... } }
+
+global_probe_cache = {}  # path -> (size, mtime, probe)
+
+def probe_file(fullpath):
+    """ Return the ffprobe output for the given file as a dict
+    with keys 'streams' (a list of dicts) and 'format' (a dict).
+    ffprobe is only run if the file is not in the cache. """
+
+    st = os.stat(fullpath)
+    cached = global_probe_cache.get(fullpath)
+    if cached and cached[0] == st.st_size and cached[1] == st.st_mtime:
+        return cached[2]
+    db = library.db_init()
+    for row in db(db.ProbeCache.path == fullpath).select():
+        if row.size == st.st_size and row.mtime == st.st_mtime:
+            global_probe_cache[fullpath] = (row.size, row.mtime, row.probe)
+            return row.probe
+    command = ['ffprobe', '-v', 'error',
+            '-print_format', 'json', '-show_streams', '-show_format',
+            fullpath]
+    app_logger.debug('RUN %s' % ' '.join(command))
+    output = subprocess.check_output(command, shell=False, stdin=DEVNULL)
+    probe = json.loads(output)
+    global_probe_cache[fullpath] = (st.st_size, st.st_mtime, probe)
+    db.ProbeCache.update_or_insert(db.ProbeCache.path == fullpath,
+        path = fullpath, size = st.st_size, mtime = st.st_mtime, probe = probe)
+    db.commit()
+    return probe
+
+
+def probe_duration(probe):
+    """ Return the duration in seconds from the probe output, or -1 if not known """
+    try:
+        return float(probe['format']['duration'])
+    except (KeyError, TypeError, ValueError):
+        return -1
+
+
+def probe_streams(probe, codec_type):
+    """ Return a list of the streams of the given codec_type
+    (video, audio, subtitle) from the probe output """
+    return [stream for stream in probe.get('streams', []) if stream.get('codec_type') == codec_type]
+
+
+def stream_language(stream):
+    """ Return the language tag of a stream from the probe output, e.g. 'eng', or None """
+    return stream.get('tags', {}).get('language')
+
+
+# ---------------------------------------------------------------------
+# Timing of the phases of playing a file (e.g. how long the Chromecast took
+# to start playing after [Watch] was pressed). Each timing is added to a
+# histogram, exported by /metrics, and logged as a line of JSON:
+#   TIMING {"name": "play_cast_wait", "seconds": 0.012, "file": "A/b.mkv"}
+# The names and their labels are:
+#   request_seconds{endpoint}   - time to return the response (streams continue after this)
+#   play_*_seconds              - the phases of /play: probe, subtitles, cast_wait, play_media, block_until_active, enqueue, total
+#   press_to_first_byte_seconds - from /play to the first chunk of the stream
+#   press_to_playing_seconds    - from /play to the Chromecast reporting PLAYING
+#   stream_*_seconds            - the phases of /stream: probe, start (ffmpeg), first_byte, total
+#   stream_bytes_per_second     - the rate the stream was delivered at
+#   home_first_chunk_seconds, home_build_seconds - rendering the listing
+#   hls_segment_wait_seconds    - waiting for ffmpeg to write a segment
+#   thumb_seconds{kind}         - making a poster or sprite sheet
+#   prefetch_start_seconds      - probing the next file and starting its ffmpeg
+
+timing_buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+rate_buckets = [64*1024, 256*1024, 1024*1024, 4*1024*1024, 16*1024*1024, 64*1024*1024]
+
+class Histogram:
+    """ Counts of observations in cumulative buckets, as used by Prometheus """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        for n, bucket in enumerate(self.buckets):
+            if value <= bucket:
+                self.counts[n] += 1
+        self.count += 1
+        self.sum += value
+
+
+timing_lock = threading.Lock()
+timing_histograms = {} # (name, labels tuple) -> Histogram
+
+def timing_observe(name, value, labels = {}, buckets = timing_buckets, **fields):
+    """ Add value to the histogram for name and labels, and log it
+    along with any extra fields (which aren't labels so don't make
+    a separate histogram, e.g. the filename) """
+
+    key = (name, tuple(sorted(labels.items())))
+    with timing_lock:
+        histogram = timing_histograms.get(key)
+        if not histogram:
+            histogram = timing_histograms[key] = Histogram(buckets)
+        histogram.observe(value)
+    app_logger.info('TIMING %s' % json.dumps(dict(name = name, value = round(value, 6), **labels, **fields)))
+
+
+class Span:
+    """ Time a block of code, e.g.
+        with Span('play_cast_wait_seconds', file = req_file):
+            cast.wait() """
+
+    def __init__(self, name, labels = {}, **fields):
+        self.name = name
+        self.labels = labels
+        self.fields = fields
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        timing_observe(self.name, time.time() - self.start, self.labels, **self.fields)
+
+
+@app.before_request
+def timing_request_start():
+    request.environ['ccastplayer.start'] = time.time()
+
+
+@app.after_request
+def timing_request_end(response):
+    start = request.environ.get('ccastplayer.start')
+    if start:
+        timing_observe('request_seconds', time.time() - start, { 'endpoint': request.endpoint or 'none' },
+            status = response.status_code)
+    return response
+
+
+# ---------------------------------------------------------------------
+# All ffmpeg processes are started by the supervisor. It runs them with
+# the configured niceness, I/O class, CPU affinity and number of threads,
+# and limits how many streaming transcodes run at once: if the Chromecast
+# keeps retrying, or several people are streaming, a new one waits for up
+# to transcode_queue_timeout seconds for a slot rather than starving the
+# machine. To stop ffmpeg the pipe it writes to is closed (if the caller is
+# the thread reading it) so it exits by itself; if it doesn't it is sent
+# SIGTERM and finally SIGKILL. Every process is reaped, either when it is
+# stopped or by the supervisor's thread when it exits by itself.
+# ffmpeg is run with -progress writing to a pipe, which a thread reads to
+# keep the speed, fps, position (out_time) and bitrate of each process.
+# These are shown by /status and /metrics, and a warning is logged if a
+# transcode stays slower than real time (which makes the Chromecast stutter).
+
+class Transcoder(Popen):
+    """ An ffmpeg process started by the supervisor """
+
+    def __init__(self, supervisor, command, purpose, filename, limited, **kwargs):
+        super().__init__(command, **kwargs)
+        self.supervisor = supervisor
+        self.purpose = purpose    # stream, prefetch, hls, remux, thumb or subtitles
+        self.filename = filename
+        self.limited = limited    # counts towards transcode_max
+        self.started = time.time()
+        self.released = False
+        self.progress = {}        # the latest values from -progress, see read_progress
+        self.slow_since = None    # when the speed dropped below transcode_slow_speed
+        self.slow_warned = False
+        self.drained = 0          # bytes of stdout taken by a StreamFeed or Prefetch
+        self.drained_checked = 0  # the value of drained at the previous progress block
+
+    def read_progress(self, fd):
+        """ Thread which reads the -progress output of ffmpeg from fd until
+        it exits. ffmpeg writes blocks of key=value lines like this, ending
+        with progress=end when it finishes:
+          frame=1234  fps=48.00  bitrate=2345.6kbits/s  total_size=12345678
+          out_time_us=51234000  speed=2.01x  progress=continue
+        """
+        values = {}
+        with os.fdopen(fd, 'r', errors = 'replace') as progress:
+            for line in progress:
+                key, _, value = line.strip().partition('=')
+                values[key] = value
+                if key == 'progress':
+                    self.update_progress(values)
+                    values = {}
+
+    def update_progress(self, values):
+        """ Convert one block of -progress output and check the speed.
+        ffmpeg's own speed is the average since it started, so the check
+        uses the media time encoded since the previous block instead. A
+        stream or prefetch which nobody has read from since then is
+        blocked writing to the pipe, which isn't slow transcoding. """
+        def number(value, suffix = ''):
+            try:
+                return float(value[:len(value) - len(suffix)] if suffix and value.endswith(suffix) else value)
+            except (TypeError, ValueError):
+                return None
+        out_time_us = number(values.get('out_time_us', values.get('out_time_ms'))) # both are microseconds
+        progress = { 'frame': number(values.get('frame')), 'fps': number(values.get('fps')),
+            'bitrate': number(values.get('bitrate'), 'kbits/s'), # kbit/s
+            'total_size': number(values.get('total_size')),
+            'out_time': out_time_us / 1000000 if out_time_us is not None else None,
+            'speed': number(values.get('speed'), 'x'),
+            'progress': values.get('progress'), 'updated': time.time(), 'rate': None }
+        last = self.progress
+        if progress['out_time'] is not None and last.get('out_time') is not None and progress['updated'] > last['updated']:
+            progress['rate'] = (progress['out_time'] - last['out_time']) / (progress['updated'] - last['updated'])
+        self.progress = progress
+        rate = progress['rate']
+        throttled = self.purpose in ('stream', 'prefetch') and self.drained == self.drained_checked
+        self.drained_checked = self.drained
+        if progress['progress'] == 'end' or throttled or (rate is not None and rate >= transcode_slow_speed):
+            self.slow_since = None
+            self.slow_warned = False
+        elif rate is None:
+            pass
+        elif self.slow_since is None:
+            self.slow_since = progress['updated']
+        elif not self.slow_warned and progress['updated'] - self.slow_since >= transcode_slow_window:
+            app_logger.warning('Transcoding %s is too slow, %.2fx real time for %d seconds (%s fps)' %
+                (self.filename, rate, progress['updated'] - self.slow_since, progress['fps']))
+            self.slow_warned = True
+
+    def stop(self, close_pipe = False):
+        """ Stop the process and reap it. Only the thread reading stdout
+        should set close_pipe, otherwise the read could use a reused fd. """
+        if self.poll() is None:
+            app_logger.debug('Stopping %s PID %d' % (self.purpose, self.pid))
+            try:
+                if close_pipe and self.stdout:
+                    self.stdout.close() # ffmpeg gets EPIPE and exits
+                    self.wait(transcode_stop_timeout)
+                else:
+                    raise subprocess.TimeoutExpired(self.args, 0)
+            except subprocess.TimeoutExpired:
+                self.terminate()
+                try:
+                    self.wait(transcode_stop_timeout)
+                except subprocess.TimeoutExpired:
+                    # e.g. blocked writing to a pipe which nobody is reading
+                    app_logger.debug('Killing %s PID %d' % (self.purpose, self.pid))
+                    self.kill()
+                    self.wait()
+        elif close_pipe and self.stdout:
+            self.stdout.close()
+        self.supervisor.finished(self)
+
+    def as_dict(self):
+        """ Return a dict describing the process, for /transcoders """
+        return { 'pid': self.pid, 'purpose': self.purpose, 'file': self.filename,
+            'running': self.returncode is None, 'seconds': round(time.time() - self.started, 1),
+            'progress': self.progress, 'command': ' '.join(self.args) }
+
+
+class TranscodeSupervisor:
+    """ Starts, limits and reaps the ffmpeg processes """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.processes = []   # the live Transcoders
+        self.active = 0       # the number of limited processes
+        self.waiting = 0      # the number of requests waiting for a slot
+        self.reaper = None
+
+    def start(self, command, purpose, filename, limited = True, nice = None, **kwargs):
+        """ Start ffmpeg and return the Transcoder, or None if limited
+        and no slot became free within transcode_queue_timeout seconds.
+        The other arguments are passed to Popen. """
+        if limited and not self.acquire():
+            app_logger.error('Too many transcodes, cannot start %s for %s' % (purpose, filename))
+            return None
+        if transcode_threads:
+            command = command[:-1] + ['-threads', str(transcode_threads)] + command[-1:]
+        progress_read, progress_write = os.pipe()
+        command = command[:1] + ['-progress', 'pipe:%d' % progress_write] + command[1:]
+        if transcode_ionice is not None and shutil.which('ionice'):
+            command = ['ionice', '-c', str(transcode_ionice)] + command
+        if transcode_cpus and shutil.which('taskset'):
+            command = ['taskset', '-c', ','.join(str(cpu) for cpu in sorted(transcode_cpus))] + command
+        nice = transcode_nice if nice is None else nice
+        if nice and shutil.which('nice'):
+            command = ['nice', '-n', str(nice)] + command
+        try:
+            process = Transcoder(self, command, purpose, filename, limited,
+                pass_fds = (progress_write,), **kwargs)
+        except:
+            os.close(progress_read)
+            if limited:
+                self.release()
+            raise
+        finally:
+            os.close(progress_write)
+        threading.Thread(target = process.read_progress, args = (progress_read,), daemon = True).start()
+        with self.condition:
+            self.processes.append(process)
+            if not self.reaper:
+                self.reaper = threading.Thread(target = self.reap, daemon = True)
+                self.reaper.start()
+        app_logger.debug('Started %s PID %d for %s' % (purpose, process.pid, filename))
+        return process
+
+    def acquire(self):
+        deadline = time.time() + transcode_queue_timeout
+        with self.condition:
+            self.waiting += 1
+            try:
+                while self.active >= transcode_max:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self.condition.wait(remaining)
+                self.active += 1
+                return True
+            finally:
+                self.waiting -= 1
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+    def finished(self, process):
+        """ Forget a process which has been reaped and free its slot """
+        with self.condition:
+            if process.released:
+                return
+            process.released = True
+            if process in self.processes:
+                self.processes.remove(process)
+        if process.limited:
+            self.release()
+
+    def reap(self):
+        """ Thread which reaps the processes which exit by themselves """
+        while True:
+            time.sleep(1)
+            for process in self.list():
+                if process.poll() is not None:
+                    self.finished(process)
+
+    def list(self):
+        with self.condition:
+            return list(self.processes)
+
+
+transcoders = TranscodeSupervisor()
+
+
+@app.route(f"/api/v{api_version}/transcoders")
+def transcoders_list():
+    """ Return the live ffmpeg processes as JSON """
+
+    return jsonify({ 'max': transcode_max, 'active': transcoders.active, 'waiting': transcoders.waiting,
+        'transcoders': [process.as_dict() for process in transcoders.list()] })
+
+
+# ---------------------------------------------------------------------
+# Keep track of the streams being served. A session is one file being
+# streamed, with its ffmpeg process (if any), the number of bytes sent
+# and the position reached. play_file puts a session id into the stream
+# URL (&session=...) so that when the Chromecast reconnects the request
+# finds the same session and its old ffmpeg process is stopped rather than
+# being left running. Sessions started by play_file are "cast" sessions
+# which the monitor thread keeps up to date and closes (saving the position)
+# when the Chromecast stops playing them. Other sessions, e.g. someone
+# using the /stream URL directly, are closed when the client disconnects.
+
+class StreamSession:
+    """ One file being streamed """
+
+    def __init__(self, session_id, filename, cast_session):
+        self.id = session_id
+        self.filename = filename    # urlencoded path relative to movie_dir, as in the database
+        self.cast = cast_session    # True if started by play_file
+        self.lock = threading.Lock()
+        self.process = None         # the ffmpeg process, None if sending a file
+        self.hls_job = None         # the HlsJob if streaming HLS
+        self.active = False         # True once the stream has been requested
+        self.seekpos = 0            # where ffmpeg started, added to the Chromecast's position
+        self.position = -1          # the position reached in the file (seconds)
+        self.media_duration = -1    # the length of the file according to ffprobe
+        self.plan = None            # the transcode_plan
+        self.play_started = None    # when /play was called, for press_to_* timings
+        self.playing_seen = False   # the Chromecast has reported PLAYING
+        self.queued = False         # waiting in the Chromecast's queue (see enqueue_album)
+        self.prefetch_started = False # the next file has been prefetched (see prefetch_next)
+        self.bytes_sent = 0
+        self.started = time.time()
+        self.last_checkpoint = time.time()
+
+    def set_process(self, process):
+        """ Remember the ffmpeg process, stopping any previous one """
+        with self.lock:
+            old_process, self.process = self.process, process
+            self.active = True
+        if old_process:
+            self.stop_process(old_process)
+
+    def stop_process(self, process = None, close_pipe = False):
+        """ Stop the given ffmpeg process (default the current one),
+        see Transcoder.stop """
+        with self.lock:
+            if process is None:
+                process = self.process
+            if process is self.process:
+                self.process = None
+        if process:
+            process.stop(close_pipe)
+
+    def is_playing(self, content_id):
+        """ True if the Chromecast content_id is this session's stream """
+        return self.id in content_id
+
+    def update_position(self, current_time):
+        """ Update the position from the Chromecast's current_time,
+        writing it to the database every seekpos_checkpoint_interval seconds """
+        self.position = current_time + self.seekpos # current_time is an offset from where ffmpeg started which might have been seeked
+        if time.time() - self.last_checkpoint > seekpos_checkpoint_interval:
+            db_update_seekpos(self.filename, self.position)
+            self.last_checkpoint = time.time()
+
+    def close(self):
+        """ Stop streaming and save the position reached """
+        self.stop_process()
+        if self.hls_job:
+            self.hls_job.stop()
+        if self.position > 0:
+            app_logger.debug('Updating database with duration %f for %s' % (self.position, self.filename))
+            db_update_seekpos(self.filename, self.position)
+
+    def as_dict(self):
+        """ Return a dict describing the session, for /status """
+        return { 'id': self.id, 'file': urllib.parse.unquote_plus(self.filename),
+            'cast': self.cast, 'pid': self.process.pid if self.process else None,
+            'seekpos': self.seekpos, 'position': self.position,
+            'media_duration': self.media_duration, 'bytes_sent': self.bytes_sent,
+            'plan': self.plan, 'progress': self.process.progress if self.process else None,
+            'started': datetime.datetime.fromtimestamp(self.started).isoformat() }
+
+
+class SessionRegistry:
+    """ All of the current sessions, by session id """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions = {}
+
+    def create(self, filename, cast_session = False):
+        """ Create a new session for the (urlencoded) filename """
+        session = StreamSession(uuid.uuid4().hex[:16], filename, cast_session)
+        self.add(session)
+        return session
+
+    def add(self, session):
+        with self.lock:
+            if session.id in self.sessions:
+                return
+            self.sessions[session.id] = session
+        app_logger.debug('Created session %s for %s' % (session.id, session.filename))
+
+    def get_or_create(self, session_id, filename):
+        """ Return the session with the given id if it is for the same file,
+        otherwise (e.g. no id given) a new session. A new session isn't
+        added to the registry until add() is called, once ffmpeg has been
+        started for it, because only the end of its stream removes it. """
+        with self.lock:
+            session = self.sessions.get(session_id)
+        if session and session.filename == filename:
+            return session
+        return StreamSession(uuid.uuid4().hex[:16], filename, False)
+
+    def get(self, session_id):
+        with self.lock:
+            return self.sessions.get(session_id)
+
+    def remove(self, session_id):
+        with self.lock:
+            self.sessions.pop(session_id, None)
+
+    def release(self, session):
+        """ Remove a session not started by play_file when its stream has
+        ended. The monitor thread removes those which were. """
+        if not session.cast:
+            self.remove(session.id)
+
+    def list(self):
+        with self.lock:
+            return list(self.sessions.values())
+
+    def cast_sessions(self):
+        return [session for session in self.list() if session.cast]
+
+
+sessions = SessionRegistry()
+
+
+# ---------------------------------------------------------------------
+# Monitor the Chromecast. pychromecast calls the status listener (from its
+# socket thread) whenever the Chromecast sends a new media status, so we
+# notice immediately when it stops playing one of our streams and can kill
+# the ffmpeg process. The current position is only sent when something
+# changes so a thread also samples it every monitor_poll_interval seconds
+# (more often while one of our streams is playing, so that the position is
+# saved every seekpos_checkpoint_interval seconds as it should be),
+# using adjusted_current_time which pychromecast extrapolates from the last
+# status. That thread never exits.
+
+media_status_fields = ['content_id', 'content_type', 'duration', 'current_time',
+    'adjusted_current_time', 'stream_type', 'player_state', 'idle_reason',
+    'media_session_id', 'playback_rate', 'supported_media_commands',
+    'volume_level', 'volume_muted', 'title', 'subtitle_tracks',
+    'current_subtitle_tracks', 'media_custom_data', 'media_metadata', 'last_updated']
+
+# Reasons for the Chromecast being idle which mean it has stopped playing the stream
+media_stopped_reasons = ('FINISHED', 'CANCELLED', 'INTERRUPTED', 'ERROR')
+
+monitor_lock = threading.Lock()
+monitored_cast = None
+
+
+def media_status_dict(status):
+    """ Return a dict of the interesting MediaStatus attributes """
+
+    return { field: getattr(status, field, None) for field in media_status_fields }
+
+
+def monitor_update(status):
+    """ Update the cast sessions from the Chromecast media status.
+    If streaming one of our sessions then remember its current seek position (duration)
+    otherwise assume streaming stopped so close the session, which kills
+    the ffmpeg process then writes the final duration to the database.
+    While playing the duration is also written to the database
+    every seekpos_checkpoint_interval seconds.
     Parameters:
-      cast - a Chromecast object returned from find_chromecast
+      status - a MediaStatus object from the media controller
     Global variables:
-      global_duration - kept up to date while movie playing (or -1)
-      global_file_playing - kept up to date with current movie filename
-      global_pid - reads the ffmpeg pid and kills it when movie finished
-      global_process - the ffmpeg process object
+      sessions - the cast sessions are updated and closed
       app_logger - for logging
-    e.g. [2023-01-05 16:40:22,036] DEBUG in app: <MediaStatus {'metadata_type': None, 'title': None, 'series_title': None, 'season': None, 'episode': None, 'artist': None, 'album_name': None, 'album_artist': None, 'track': None, 'subtitle_tracks': [], 'images': [], 'supports_pause': True, 'supports_seek': True, 'supports_stream_volume': True, 'supports_stream_mute': True, 'supports_skip_forward': False, 'supports_skip_backward': False, 'current_time': 5.631622, 'content_id': 'http://192.168.1.30:5000/api/v1/stream?file=/Alpinist/The.Alpinist.2021.1080p.WEB-DL.DD5.1.H.264-TEPES.mkv', 'content_type': 'video/mp4', 'duration': 10.219, 'stream_type': 'BUFFERED', 'idle_reason': None, 'media_session_id': 1, 'playback_rate': 1, 'player_state': 'BUFFERING', 'supported_media_commands': 274447, 'volume_level': 1, 'volume_muted': False, 'media_custom_data': {}, 'media_metadata': {}, 'current_subtitle_tracks': [], 'last_updated': datetime.datetime(2023, 1, 5, 16, 40, 21, 781787)}>
     """
 
-    global global_duration
-    global global_file_playing
+    content_id = status.content_id or ''
+    # current_time is the playback position (the duration is the length of
+    # the media, which is the whole file if it's being served from the cache)
+    position = status.adjusted_current_time or -1
+    stopped = status.player_state == 'IDLE' and status.idle_reason in media_stopped_reasons
+    app_logger.debug('Media Status: %s at %f playing %s' % (status.player_state, position, content_id))
+    with monitor_lock:
+        for session in sessions.cast_sessions():
+            if session.is_playing(content_id) and not stopped:
+                session.queued = False
+                if position > 0:
+                    session.update_position(position)
+                    duration = status.duration or session.media_duration
+                    if prefetch_at and not session.prefetch_started and duration > 0 and session.position >= duration * prefetch_at:
+                        session.prefetch_started = True
+                        threading.Thread(target = prefetch_next, args = (session,), daemon = True).start()
+                if status.player_state == 'PLAYING' and not session.playing_seen:
+                    session.playing_seen = True
+                    if session.play_started:
+                        timing_observe('press_to_playing_seconds', time.time() - session.play_started,
+                            file = urllib.parse.unquote_plus(session.filename))
+            elif session.queued and not (stopped and status.idle_reason != 'FINISHED'):
+                # Still to come, unless the Chromecast has been stopped
+                continue
+            elif session.is_playing(content_id) or session.active or time.time() - session.started > session_start_timeout:
+                # Not playing (and not just waiting for the Chromecast to start)
+                app_logger.debug('Closing session %s for %s (%s)' % (session.id, session.filename, status.idle_reason))
+                sessions.remove(session.id)
+                session.close()
+                remux_wakeup.set()
+                subtitle_wakeup.set()
+
+
+class CastStatusListener:
+    """ Receives the media status callbacks from pychromecast """
+
+    def new_media_status(self, status):
+        try:
+            monitor_update(status)
+        except Exception as e:
+            app_logger.error('Cannot update sessions from media status: %s' % e)
+
+    def load_media_failed(self, *args):
+        app_logger.error('Chromecast failed to load media: %s' % (args,))
+
+
+def monitor_chromecast(cast):
+    """ Sample the Chromecast position every monitor_poll_interval seconds,
+    or every seekpos_checkpoint_interval/2 seconds while playing a cast session.
+    Parameters:
+      cast - a Chromecast object returned from find_chromecast
+    """
 
     app_logger.debug('Monitor thread running')
+    interval = monitor_poll_interval
     while True:
-        if cast.media_controller.status:
-            status = str(cast.media_controller.status) # no method to get properties
-            status_dict = eval(status[13:-1])          # strip off the class name
-            content_id = status_dict.get('content_id', '')
-            if not content_id:
-                content_id = ''
-            duration = status_dict.get('duration', -1)
-            if not duration:
-                duration = -1
-            app_logger.debug('Media Status: at %f playing %s' % (duration, content_id))
-            if global_file_playing:
-                if global_file_playing in content_id:
-                    #app_logger.debug('content_id contains filename (%s)' % (global_file_playing))
-                    if duration > 0:
-                        global_duration = duration + global_seekpos # duration is an offset from the where we started which might have been seeked
-                else:
-                    #app_logger.debug('content_id NOT contains filename %s' % (global_file_playing))
-                    app_logger.debug('Killing PID %s' % global_pid)
-                    os.kill(global_pid, signal.SIGKILL) # XXX hacky. only KILL works (prob because blocked in I/O) INT and TERM don't kill
-                    global_process.wait()
-                    app_logger.debug('Updating database with duration %f for %s' % (global_duration, global_file_playing))
-                    db_update_seekpos(global_file_playing, global_duration)
-                    global_file_playing = None
-            else:
-                app_logger.debug('No global_file_playing')
-        time.sleep(2)
+        time.sleep(interval)
+        if cast is not monitored_cast:
+            app_logger.debug('Monitor thread exiting, Chromecast has been replaced')
+            return
+        status = cast.media_controller.status
+        interval = monitor_poll_interval
+        if status:
+            try:
+                monitor_update(status)
+            except Exception as e:
+                app_logger.error('Cannot update sessions from media status: %s' % e)
+            if status.player_state == 'PLAYING' and sessions.cast_sessions():
+                # No status is sent while playing steadily
+                interval = min(monitor_poll_interval, seekpos_checkpoint_interval / 2)
 
 
 # ---------------------------------------------------------------------
-# Find the Chromecast
+# Find the Chromecast. mDNS discovery can take a minute, or forever if the
+# TV is off, so it runs in a background thread and the web server starts
+# immediately. The address of the Chromecast is saved in a shelf so that
+# at startup we can connect to it directly without waiting for discovery;
+# discovery then refreshes the saved address (e.g. if its IP has changed).
+# Until a Chromecast is known the global cast is None.
+
+def cast_info_load(desired_chromecast_name):
+    """ Return the saved (host, port, uuid, model_name, friendly_name)
+    of the named Chromecast, or None """
+
+    try:
+        with shelve.open(cast_shelf_file) as shelf:
+            return shelf.get(desired_chromecast_name)
+    except Exception as e:
+        app_logger.error('Cannot read %s: %s' % (cast_shelf_file, e))
+        return None
+
+
+def cast_info_save(desired_chromecast_name, cast):
+    """ Save the address of the Chromecast for next time """
+
+    info = cast.cast_info
+    host = (info.host, info.port, info.uuid, info.model_name, info.friendly_name)
+    try:
+        with shelve.open(cast_shelf_file) as shelf:
+            if shelf.get(desired_chromecast_name) != host:
+                shelf[desired_chromecast_name] = host
+    except Exception as e:
+        app_logger.error('Cannot write %s: %s' % (cast_shelf_file, e))
+
+
+def connect_saved_chromecast(desired_chromecast_name):
+    """ Return a Chromecast object for the saved address of the named
+    Chromecast, or None if it has not been found before. This doesn't wait
+    for the connection, pychromecast connects in its own thread. """
+
+    host = cast_info_load(desired_chromecast_name)
+    if not host:
+        return None
+    app_logger.debug('Connecting to saved Chromecast %s' % (host,))
+    import pychromecast
+    cast = pychromecast.get_chromecast_from_host(host)
+    cast.start()
+    return cast
+
 
 def find_chromecast(desired_chromecast_name):
     """ Find the named Chromecast and return a Chromecast object.
@@ -292,6 +1257,8 @@ def find_chromecast(desired_chromecast_name):
       by get_listed_chromecasts.
     """
 
+    global browser
+    import pychromecast
     chromecasts = None
     while not chromecasts:
         app_logger.debug('Searching for "%s" ...' % desired_chromecast_name)
@@ -304,28 +1271,114 @@ def find_chromecast(desired_chromecast_name):
     return cast
 
 
-def start_chromecast_monitor(cast):
-    """ Start a background thread to monitor the Chromecast
-    and update some global variables with the current seek position """
+def use_chromecast(new_cast, save = False):
+    """ Make new_cast the Chromecast used for playing, unless it's the same
+    device at the same address as the current one (keep that connection).
+    The monitor is started (and with save the address saved) before the old
+    connection is closed, which doesn't wait for its thread to finish. """
+
+    global cast
+    with cast_lock:
+        old_cast = cast
+        if old_cast is not None:
+            old_info, new_info = old_cast.cast_info, new_cast.cast_info
+            if (old_info.uuid, old_info.host, old_info.port) == (new_info.uuid, new_info.host, new_info.port):
+                old_cast = new_cast = None
+        if new_cast is not None:
+            cast = new_cast
+    if new_cast is not None:
+        start_chromecast_monitor(new_cast)
+    if save:
+        cast_info_save(desired_chromecast_name, cast)
+    if old_cast is not None:
+        app_logger.debug('Replacing Chromecast connection %s' % old_cast.cast_info)
+        try:
+            old_cast.disconnect(timeout = 0)
+        except Exception as e:
+            app_logger.error('Cannot disconnect from the old Chromecast: %s' % e)
+
+
+def discover_chromecast():
+    """ Find the Chromecast using mDNS, use it and save its address """
 
-    monitor_thread = threading.Thread(target = monitor_chromecast, args = (cast,))
+    app_logger.info('Searching for Chromecast "%s"' % desired_chromecast_name)
+    new_cast = find_chromecast(desired_chromecast_name)
+    use_chromecast(new_cast, save = True)
+
+
+def discover_chromecast_in_background(use_saved = False):
+    """ Start discover_chromecast in a background thread,
+    unless discovery is already running. If use_saved is set
+    first connect to the Chromecast found last time. """
+
+    def discover():
+        try:
+            if cast_backend == 'fake':
+                import fakecast
+                use_chromecast(fakecast.FakeChromecast(desired_chromecast_name, bitrate = fake_cast_bitrate))
+                return
+            if use_saved:
+                saved_cast = connect_saved_chromecast(desired_chromecast_name)
+                if saved_cast:
+                    use_chromecast(saved_cast)
+            discover_chromecast()
+        except Exception as e:
+            app_logger.error('Chromecast discovery failed: %s' % e)
+        finally:
+            cast_discovery_lock.release()
+
+    if cast_discovery_lock.acquire(blocking = False):
+        threading.Thread(target = discover, daemon = True).start()
+
+
+def start_chromecast_monitor(cast):
+    """ Register for media status updates from the Chromecast and start
+    a background thread to sample the current seek position """
+
+    global monitored_cast
+    if cast is monitored_cast:
+        return
+    monitored_cast = cast
+    cast.media_controller.register_status_listener(CastStatusListener())
+    monitor_thread = threading.Thread(target = monitor_chromecast, args = (cast,), daemon = True)
     monitor_thread.start()
 
 
 # ---------------------------------------------------------------------
 
-def mimetype_from_filename(filename):
-    """ Return a mimetype suitable for the given filename extension """
+# The Chromecast plays these audio files as they are (if the codec inside
+# is one of audio_native_codecs), others are converted to AAC in MP4.
+audio_mimetypes = { 'mp3': 'audio/mpeg', 'flac': 'audio/flac', 'ogg': 'audio/ogg', 'oga': 'audio/ogg',
+    'opus': 'audio/ogg', 'wav': 'audio/wav', 'm4a': 'audio/mp4', 'aac': 'audio/aac' }
+audio_native_codecs = ['mp3', 'aac', 'flac', 'vorbis', 'opus', 'pcm_s16le', 'pcm_s24le', 'pcm_u8']
 
-    ext_regex = '.*\.(' + '|'.join(audio_file_ext) + ')$'
-    if re.match(ext_regex, filename):
-        return 'audio/mp3'
+def is_audio_file(filename):
+    """ True if the filename has one of the audio_file_ext extensions """
+
+    return re.match('.*\.(' + '|'.join(audio_file_ext) + ')$', filename) is not None
+
+
+def mimetype_from_filename(filename, converted = False):
+    """ Return a mimetype suitable for the given filename extension.
+    An audio file which is converted by ffmpeg (or has to be) is sent as audio/mp4. """
+
+    if is_audio_file(filename):
+        return 'audio/mp4' if converted else audio_mimetypes.get(filename.rsplit('.', 1)[1], 'audio/mp4')
     ext_regex = '.*\.(' + '|'.join(video_file_ext) + ')$'
     if re.match(ext_regex, filename):
         return 'video/mp4'
     return 'video/mp4' # XXX default to video ???
 
 
+def validate_media_file(req_file):
+    """ Return the full path of the requested file, or None if it's not a file under movie_dir """
+
+    fullpath = os.path.normpath(os.path.join(movie_dir, req_file))
+    if not fullpath.startswith(os.path.normpath(movie_dir) + '/') or not os.path.isfile(fullpath):
+        return None
+    return fullpath
+
+
 # ---------------------------------------------------------------------
 # Home page returns list of files available to play
 # Each movie file is a URL /api/v1/play?file=<filename>
@@ -350,75 +1403,231 @@ def home():
     mtime, atime, wtime
     for file modified, file accessed, last watched time
     default is sort by filename.
+    Add &limit=N to list N files per page and &page=N for page N (from 1).
+    The page is streamed as it is rendered. The ETag changes when the library
+    or the seek positions change so the browser can get 304 Not Modified.
     """
 
     req_sort = request.args.get('sort', 'name')
-
-    # Collect a list of movie files underneath the media directory
-    files = []
-    ext_regex = '.*\.(' + '|'.join(video_file_ext) + ')$'
-    for root, dirslist, fileslist in os.walk(movie_dir, followlinks = True):
-        for filename in fileslist:
-            if re.match(ext_regex, filename):
-                fullpath = os.path.join(root, filename)
-                dbpath = urlencode(fullpath.replace(movie_dir+'/', ''))
-                files += [{
-                    'filename': fullpath,
-                    'last_modified': os.path.getmtime(fullpath),
-                    'last_accessed': os.path.getatime(fullpath),
-                    'last_watched' : db_get_last_modified(dbpath),
-                }]
-    if 'mtime' in req_sort:
-        files = [x for x in sorted(files, key=lambda x : x['last_modified'], reverse=True)]
-    elif 'atime' in req_sort:
-        files = [x for x in sorted(files, key=lambda x : x['last_accessed'], reverse=True)]
-    elif 'wtime' in req_sort:
-        files = [x for x in sorted(files, key=lambda x : x['last_watched'], reverse=True)]
+    try:
+        req_limit = max(0, int(request.args.get('limit', home_page_size)))
+        req_page = max(1, int(request.args.get('page', 1)))
+    except ValueError:
+        return Response('Bad page or limit', status = 400)
+
+    library.get_files()
+    etag = home_etag(req_sort, req_page, req_limit)
+    if request.if_none_match.contains(etag):
+        response = Response(status = 304)
     else:
-        files = [x for x in sorted(files, key=natsort_keygen(key = lambda x : x['filename']), reverse=False)]
-
-
-    # Create HTML document listing movie files with option to Restart from beginning
-    html = '<html><head><title>CCast-Player</title></head><body>\n'
-    html += '<style>\n'
-    html += ' .menu { }\n'
-    html += ' .menuitem { }\n'
-    html += ' .file { }\n'
-    html += ' .resume { }\n'
-    html += ' .download { }\n'
-    html += '</style>\n'
-    html += '<p class="cast">Using Chromecast: %s</p>\n' % desired_chromecast_name
-    html += '<p class="menu">Service: '
-    html += ' <a class="menuitem" href="/api/v1/status">| Status</a>'
-    html += ' <a class="menuitem" href="/api/v1/rescan">| Rescan</a>'
-    html += ' <a class="menuitem" href="/api/v1/reboot"> | Reboot</a>'
-    html += ' <a class="menuitem" href="/api/v1/shutdown"> | Shutdown</a></p>\n'
-    html += '<p class="menu">Sort by: '
-    html += ' <a class="menuitem" href="/?sort=name">| Name</a>'
-    html += ' <a class="menuitem" href="/?sort=mtime">| Modified</a>'
-    html += ' <a class="menuitem" href="/?sort=atime">| Accessed</a>'
-    html += ' <a class="menuitem" href="/?sort=wtime">| Watched</a>'
-    html += '<p>\n'
+        started = request.environ.get('ccastplayer.start', time.time())
+        files = home_files(req_sort)
+        response = Response(home_timed(home_html(files, req_sort, req_page, req_limit), started), mimetype = 'text/html')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache' # always revalidate
+    return response
+
+
+def home_timed(chunks, started):
+    """ Generator which passes on the chunks of the page, timing the
+    first chunk and the whole page """
+
+    first = True
+    for chunk in chunks:
+        if first:
+            timing_observe('home_first_chunk_seconds', time.time() - started)
+            first = False
+        yield chunk
+    timing_observe('home_build_seconds', time.time() - started)
+
+
+def home_etag(req_sort, req_page, req_limit):
+    """ Return an ETag for the home page which changes whenever
+    the library index or any seek position changes """
+
+    key = json.dumps([library.version, global_seekpos_version, len(global_probe_cache), movie_dir,
+        desired_chromecast_name, req_sort, req_page, req_limit])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:20]
+
+
+def has_subtitles(entry):
+    """ Return True if the file has subtitle files, or has embedded
+    subtitles which can be converted (only known once it's been probed) """
+
+    if entry['subtitles']:
+        return True
+    cached = global_probe_cache.get(os.path.join(movie_dir, entry['path'])) if subtitle_dir else None
+    return bool(cached and [x for x in probe_streams(cached[2], 'subtitle') if x.get('codec_name') in subtitle_text_codecs])
+
+
+def home_files(req_sort):
+    """ Return the list of library index entries sorted for the home page
+    (kept by the library index, so this is cheap after the first time) """
+
+    sort = req_sort if req_sort in ('mtime', 'atime', 'wtime') else 'name'
+    entries, keys = library.sorted_files(sort)
+    return entries
+
+
+def home_file_info(entry):
+    """ Return the details of one file shown on the home page. These are
+    only worked out for the files on the page, as each is rendered. """
+
+    return {
+        'filename': os.path.join(movie_dir, entry['path']),
+        'name': entry['name'],
+        'last_watched' : db_get_last_modified(urlencode(entry['path'])),
+        'subtitles': has_subtitles(entry),
+        'thumb': thumb_url(entry),
+    }
+
+
+def home_html(files, req_sort, req_page, req_limit):
+    """ Generator which yields the HTML document listing the movie files
+    (library index entries) with option to Restart from beginning,
+    home_chunk_files at a time. Only page req_page is listed if req_limit is not 0. """
+
+    html = ['<html><head><title>CCast-Player</title></head><body>\n',
+        '<style>\n',
+        ' .menu { }\n',
+        ' .menuitem { }\n',
+        ' .file { }\n',
+        ' .resume { }\n',
+        ' .download { }\n',
+        ' .thumb { height: 45px; vertical-align: middle; }\n',
+        '</style>\n',
+        '<p class="cast">Using Chromecast: %s</p>\n' % desired_chromecast_name,
+        '<p class="menu">Service: ',
+        ' <a class="menuitem" href="/api/v1/status">| Status</a>',
+        ' <a class="menuitem" href="/api/v1/rescan">| Rescan</a>',
+        ' <a class="menuitem" href="/api/v1/reboot"> | Reboot</a>',
+        ' <a class="menuitem" href="/api/v1/shutdown"> | Shutdown</a></p>\n',
+        '<p class="menu">Sort by: ',
+        ' <a class="menuitem" href="/?sort=name">| Name</a>',
+        ' <a class="menuitem" href="/?sort=mtime">| Modified</a>',
+        ' <a class="menuitem" href="/?sort=atime">| Accessed</a>',
+        ' <a class="menuitem" href="/?sort=wtime">| Watched</a>',
+        '<p>\n']
+    pages = ''
+    if req_limit:
+        last_page = max(1, (len(files) + req_limit - 1) // req_limit)
+        page_url = '/?sort=%s&limit=%d&page=' % (urlencode(req_sort), req_limit)
+        pages = '<p class="menu">Page %d of %d: ' % (req_page, last_page)
+        if req_page > 1:
+            pages += ' <a class="menuitem" href="%s%d">| Previous</a>' % (page_url, req_page - 1)
+        if req_page < last_page:
+            pages += ' <a class="menuitem" href="%s%d">| Next</a>' % (page_url, req_page + 1)
+        pages += '</p>\n'
+        html.append(pages)
+        files = files[(req_page - 1) * req_limit : req_page * req_limit]
+    yield ''.join(html)
+
     null_date = datetime.datetime(2000,1,1)
-    for file_info in files:
+    html = []
+    for entry in files:
+        file_info = home_file_info(entry)
         filename = file_info['filename']
-        # Check if subtitles file exists
-        subtitle_file = filename + '.vtt'
         # Strip off the path prefix
         filename = filename.replace(movie_dir, '')
         play_url = '/api/v1/play?file=' + urlencode(filename)
         download_url = '/api/v1/download?file=' + urlencode(filename)
-        html += '<br>%s ' % prettyname(filename)
+        html.append('<br> / %s ' % file_info['name'])
+        if file_info['thumb']:
+            html.append('<img class="thumb" loading="lazy" alt="" src="%s" onerror="this.style.display=\'none\'"> ' % file_info['thumb'])
         if file_info['last_watched'] > null_date:
-            html += '<a class="file" href="' + play_url + '">[Resume]</a>\n'
-            html += '  <a class="resume" href="' + play_url + '&resume=0">[Restart]</a>\n'
+            html.append('<a class="file" href="' + play_url + '">[Resume]</a>\n')
+            html.append('  <a class="resume" href="' + play_url + '&resume=0">[Restart]</a>\n')
         else:
-            html += '<a class="file" href="' + play_url + '">[Watch]</a>\n'
-        if os.path.isfile(subtitle_file):
-            html += '  <a class="file"   href="' + play_url + '&subtitles=1">[Subtitles]</a>\n'
-        html += '  <a class="download" href="' + download_url + '">[Download]</a>\n'
-    html += '</body></html>'
-    return Response(html)
+            html.append('<a class="file" href="' + play_url + '">[Watch]</a>\n')
+        if file_info['subtitles']:
+            html.append('  <a class="file"   href="' + play_url + '&subtitles=1">[Subtitles]</a>\n')
+        if is_audio_file(filename):
+            html.append('  <a class="file"   href="' + play_url + '&resume=0&album=1">[Album]</a>\n')
+        html.append('  <a class="download" href="' + download_url + '">[Download]</a>\n')
+        if len(html) >= home_chunk_files * 4:
+            yield ''.join(html)
+            html = []
+    if pages:
+        html.append('<p>\n' + pages)
+    html.append('</body></html>')
+    yield ''.join(html)
+
+
+# ---------------------------------------------------------------------
+# JSON listing of the library for scripts and remote control frontends.
+# /api/v1/library?sort=name&dir=TV&ext=mkv,mp4&limit=100
+# Returns { "items": [...], "next": cursor } and the next page is fetched
+# with &cursor=... (the other parameters must be the same). The cursor
+# holds the sort position of the last item so paging stays consistent
+# while files are being added or removed. The sorted list is cached by
+# the library index so each page is a binary search plus a short scan.
+
+library_api_limit = 100 # default number of items per page
+library_api_max_limit = 1000
+
+def library_cursor_encode(sort, entry):
+    """ Return a cursor which resumes after the entry """
+    value = json.dumps([entry['path'], library_sort_value(sort, entry)])
+    return base64.urlsafe_b64encode(value.encode('utf-8')).decode('ascii')
+
+
+def library_cursor_decode(sort, cursor):
+    """ Return the sort key of the cursor, raises ValueError if it's not valid """
+    try:
+        path, value = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        if sort in ('mtime', 'atime', 'wtime'):
+            value = float(value)
+        return library_sort_key(sort, str(path), value)
+    except (TypeError, ValueError, binascii.Error) as e:
+        raise ValueError('Bad cursor %s' % cursor) from e
+
+
+@app.route(f"/api/v{api_version}/library")
+def library_list():
+    """ Return a page of the library as JSON. Parameters:
+      sort - name, mtime, atime or wtime (default name)
+      dir - only files in this directory (relative to the media directory) and below
+      ext - only files with one of these comma separated extensions
+      limit - the number of items (default library_api_limit)
+      cursor - the next value from the previous page
+    """
+
+    req_sort = request.args.get('sort', 'name')
+    req_dir = request.args.get('dir', '').strip('/')
+    req_ext = request.args.get('ext', '')
+    req_cursor = request.args.get('cursor', None)
+    if req_sort not in ('name', 'mtime', 'atime', 'wtime'):
+        return Response('Bad sort %s' % req_sort, status = 400)
+    try:
+        req_limit = min(library_api_max_limit, max(1, int(request.args.get('limit', library_api_limit))))
+        start_key = library_cursor_decode(req_sort, req_cursor) if req_cursor else None
+    except ValueError as e:
+        return Response(str(e), status = 400)
+    exts = tuple('.' + ext.strip('.').lower() for ext in req_ext.split(',') if ext)
+
+    entries, keys = library.sorted_files(req_sort)
+    start = bisect.bisect_right(keys, start_key) if start_key else 0
+    items = []
+    last = None
+    for entry in itertools.islice(entries, start, None):
+        if req_dir and entry['dir'] != req_dir and not entry['dir'].startswith(req_dir + '/'):
+            continue
+        if exts and not entry['path'].lower().endswith(exts):
+            continue
+        if len(items) == req_limit:
+            break
+        seek = global_seekpos_cache.get(urlencode(entry['path']))
+        items.append({ 'path': entry['path'], 'name': entry['name'], 'dir': entry['dir'],
+            'size': entry['size'], 'mtime': entry['mtime'], 'atime': entry['atime'],
+            'subtitles': has_subtitles(entry),
+            'thumb': thumb_url(entry), 'sprite': thumb_url(entry, 'sprite'),
+            'seek': float(seek['seek']) if seek and seek['seek'] else 0,
+            'last_watched': seek['last_modified'].isoformat() if seek and seek['last_modified'] else None })
+        last = entry
+    else:
+        last = None # no more items
+    return jsonify({ 'items': items, 'version': library.version,
+        'next': library_cursor_encode(req_sort, last) if last else None })
 
 
 # ---------------------------------------------------------------------
@@ -441,24 +1650,94 @@ def help():
 # ---------------------------------------------------------------------
 @app.route(f"/api/v{api_version}/status")
 def status():
-    """ Return Chromecast status """
-    if cast.media_controller.status:
-        status = str(cast.media_controller.status) # no method to get properties
-        status_dict = eval(status[13:-1])          # strip off the class name
-        return Response('<pre>' + pprint.pformat(status_dict, indent=4) + '</pre>')
+    """ Return Chromecast status and the current stream sessions
+    (add ?json=1 to get them as JSON) """
+    session_list = [session.as_dict() for session in sessions.list()]
+    if request.args.get('json', None):
+        status_dict = media_status_dict(cast.media_controller.status) if cast and cast.media_controller.status else None
+        return jsonify({ 'chromecast': status_dict, 'sessions': session_list })
+    if cast and cast.media_controller.status:
+        status_dict = media_status_dict(cast.media_controller.status)
+        return Response('<pre>' + pprint.pformat(status_dict, indent=4) + '\n\n'
+            + pprint.pformat(session_list, indent=4) + '</pre>')
     return Response('Chromecast not found')
 
 
+# ---------------------------------------------------------------------
+# Metrics for Prometheus (or anything else which reads its text format).
+# e.g. ccastplayer_transcode_speed{pid="1234",purpose="stream",file="A/b.mkv"} 1.52
+
+def metric_labels(labels):
+    """ Return the labels formatted for the Prometheus text format """
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join('%s="%s"' % (key, escape(value)) for key, value in labels.items()) + '}' if labels else ''
+
+
+def metric(lines, name, description, kind, samples):
+    """ Append a metric of the given kind (gauge, counter) to lines.
+    samples is a list of (labels dict, value), those with a value of None are left out. """
+    lines.append('# HELP ccastplayer_%s %s' % (name, description))
+    lines.append('# TYPE ccastplayer_%s %s' % (name, kind))
+    for labels, value in samples:
+        if value is not None:
+            lines.append('ccastplayer_%s%s %s' % (name, metric_labels(labels), repr(float(value))))
+
+
+@app.route(f"/api/v{api_version}/metrics")
+def metrics():
+    """ Return the metrics in the Prometheus text format """
+
+    lines = []
+    processes = transcoders.list()
+    process_labels = [({ 'pid': p.pid, 'purpose': p.purpose, 'file': p.filename }, p.progress) for p in processes]
+    metric(lines, 'transcoders_active', 'Streaming transcodes running', 'gauge', [({}, transcoders.active)])
+    metric(lines, 'transcoders_waiting', 'Requests waiting for a transcode slot', 'gauge', [({}, transcoders.waiting)])
+    metric(lines, 'transcoders_max', 'Maximum streaming transcodes', 'gauge', [({}, transcode_max)])
+    for name, key, description in [
+            ('transcode_speed', 'speed', 'ffmpeg speed relative to real time'),
+            ('transcode_fps', 'fps', 'ffmpeg frames per second'),
+            ('transcode_out_time_seconds', 'out_time', 'Position ffmpeg has reached in its output'),
+            ('transcode_bitrate_kbps', 'bitrate', 'Bitrate of the ffmpeg output in kbit/s'),
+            ('transcode_output_bytes', 'total_size', 'Bytes output by ffmpeg')]:
+        metric(lines, name, description, 'gauge', [(labels, progress.get(key)) for labels, progress in process_labels])
+    metric(lines, 'transcode_slow', '1 if the transcode has been slower than real time for a while', 'gauge',
+        [({ 'pid': p.pid, 'purpose': p.purpose, 'file': p.filename }, 1 if p.slow_warned else 0) for p in processes])
+    session_list = sessions.list()
+    metric(lines, 'sessions', 'Stream sessions', 'gauge', [({}, len(session_list))])
+    session_labels = [({ 'session': x.id, 'file': urllib.parse.unquote_plus(x.filename) }, x) for x in session_list]
+    metric(lines, 'session_bytes_sent_total', 'Bytes sent for the session', 'counter',
+        [(labels, x.bytes_sent) for labels, x in session_labels])
+    metric(lines, 'session_position_seconds', 'Position reached by the Chromecast', 'gauge',
+        [(labels, x.position if x.position >= 0 else None) for labels, x in session_labels])
+    metric(lines, 'library_files', 'Files in the library index', 'gauge', [({}, len(library.files))])
+    with timing_lock:
+        histograms = sorted(timing_histograms.items())
+    for name in sorted(set(key[0] for key, histogram in histograms)):
+        lines.append('# TYPE ccastplayer_%s histogram' % name)
+        for (hname, labels), histogram in histograms:
+            if hname != name:
+                continue
+            labels = dict(labels)
+            for bucket, count in zip(histogram.buckets, histogram.counts):
+                lines.append('ccastplayer_%s_bucket%s %d' % (name, metric_labels(dict(labels, le = repr(float(bucket)))), count))
+            lines.append('ccastplayer_%s_bucket%s %d' % (name, metric_labels(dict(labels, le = '+Inf')), histogram.count))
+            lines.append('ccastplayer_%s_sum%s %s' % (name, metric_labels(labels), repr(float(histogram.sum))))
+            lines.append('ccastplayer_%s_count%s %d' % (name, metric_labels(labels), histogram.count))
+    return Response('\n'.join(lines) + '\n', mimetype = 'text/plain; version=0.0.4')
+
+
 # ---------------------------------------------------------------------
 @app.route(f"/api/v{api_version}/rescan")
 def rescan():
-    """ Look for the Chromecast again """
+    """ Rescan the media library in the background
+    (add &full=1 to read every directory, not just the modified ones)
+    and look for the Chromecast again """
 
     app_logger.debug('rescan')
-    cast = find_chromecast(desired_chromecast_name)
-    # XXX do we need to kill off the previous monitor thread?
-    start_chromecast_monitor(cast)
-    return Response('Please wait a minute for the Chromecast Discovery to complete')
+    library.scan_in_background(full = bool(request.args.get('full', None)))
+    discover_chromecast_in_background()
+    return Response('Please wait a minute for the Library Scan and Chromecast Discovery to complete')
 
 
 # ---------------------------------------------------------------------
@@ -472,10 +1751,351 @@ def reboot():
 @app.route(f"/api/v{api_version}/shutdown")
 def shutdown():
     app_logger.debug('shutdown')
-    pychromecast.discovery.stop_discovery(browser)
+    if browser:
+        import pychromecast
+        pychromecast.discovery.stop_discovery(browser)
     return Response('Not yet implemented')
 
 
+# ---------------------------------------------------------------------
+# Decide how ffmpeg should transcode a file for the Chromecast.
+# Re-encoding video uses far more CPU than anything else so the streams
+# which the Chromecast can play are copied and only the others are encoded.
+# What each model can play is described by a device profile; the video
+# codecs map to the largest size, frame rate, level (as reported by ffprobe,
+# for HEVC it's 30 times the level) and the pixel formats it can decode.
+# The plan for a file is one of:
+#   copy      - copy the video and audio
+#   audio     - copy the video, encode the audio
+#   downscale - encode the video at a smaller size (and/or lower frame rate)
+#   transcode - encode the video as H.264
+# The English audio track is used if there is one (otherwise the default).
+
+device_profiles = {
+    'gen2': {
+        'video': { 'h264': { 'max_width': 1920, 'max_height': 1080, 'max_fps': 30, 'max_level': 41,
+                             'pix_fmts': ['yuv420p', 'yuvj420p'] } },
+        'audio': ['aac', 'mp3'],
+        'max_audio_channels': 2,
+    },
+    'gen3': {
+        'video': { 'h264': { 'max_width': 1920, 'max_height': 1080, 'max_fps': 60, 'max_level': 42,
+                             'pix_fmts': ['yuv420p', 'yuvj420p'] } },
+        'audio': ['aac', 'mp3'],
+        'max_audio_channels': 2,
+    },
+    'ultra': {
+        'video': { 'h264': { 'max_width': 1920, 'max_height': 1080, 'max_fps': 60, 'max_level': 42,
+                             'pix_fmts': ['yuv420p', 'yuvj420p'] },
+                   'hevc': { 'max_width': 3840, 'max_height': 2160, 'max_fps': 60, 'max_level': 153,
+                             'pix_fmts': ['yuv420p', 'yuv420p10le'] },
+                   'vp9':  { 'max_width': 3840, 'max_height': 2160, 'max_fps': 60, 'max_level': None,
+                             'pix_fmts': ['yuv420p', 'yuv420p10le'] } },
+        'audio': ['aac', 'mp3'],
+        'max_audio_channels': 2,
+    },
+}
+x264_preset = 'veryfast'
+x264_crf = 21
+
+
+def device_profile_name():
+    """ Return the name of the device profile to use, from --device
+    or if that is auto from the model name of the Chromecast """
+
+    if transcode_device != 'auto':
+        return transcode_device
+    model_name = (cast.cast_info.model_name or '') if cast else ''
+    if re.search('Ultra|Google TV', model_name):
+        return 'ultra'
+    return 'gen3'
+
+
+def stream_fps(stream):
+    """ Return the frame rate of a video stream from the probe output, or 0 """
+    try:
+        num, den = [float(x) for x in (stream.get('avg_frame_rate') or stream.get('r_frame_rate')).split('/')]
+        return num / den if den else 0
+    except (AttributeError, TypeError, ValueError):
+        return 0
+
+
+def transcode_plan(full_filename, probe):
+    """ Decide which streams to use and whether to copy or encode them.
+    Returns a dict with keys
+      profile - the device profile name
+      action - copy, audio, downscale or transcode (see above)
+      video, audio - 'copy' or 'encode' (or None if there is no such stream)
+      video_stream, audio_stream - the stream index
+      reasons - a list of strings explaining anything which is encoded
+      args - the ffmpeg arguments
+    Parameters:
+      full_filename - the full path to the input file
+      probe - the output of probe_file for the input file
+    """
+
+    profile_name = device_profile_name()
+    profile = device_profiles[profile_name]
+    plan = { 'profile': profile_name, 'action': 'copy', 'video': None, 'audio': None,
+        'video_stream': None, 'audio_stream': None, 'reasons': [] }
+    args = []
+
+    # Video, ignoring cover art
+    videos = [x for x in probe_streams(probe, 'video') if not x.get('disposition', {}).get('attached_pic')]
+    if videos:
+        video = videos[0]
+        plan['video_stream'] = video['index']
+        args += ['-map', '0:%d' % video['index']]
+        codec = video.get('codec_name')
+        width, height = video.get('width', 0), video.get('height', 0)
+        fps = stream_fps(video)
+        caps = profile['video'].get(codec)
+        h264 = profile['video']['h264']
+        scale = None
+        if not caps:
+            plan['action'] = 'transcode'
+            plan['reasons'].append('%s video is not supported by %s' % (codec, profile_name))
+            caps = h264
+        elif caps['max_level'] and video.get('level', 0) > caps['max_level']:
+            plan['action'] = 'transcode'
+            plan['reasons'].append('%s level %s is too high for %s' % (codec, video.get('level'), profile_name))
+            caps = h264
+        elif video.get('pix_fmt') and video['pix_fmt'] not in caps['pix_fmts']:
+            plan['action'] = 'transcode'
+            plan['reasons'].append('%s pixel format %s is not supported by %s' % (codec, video['pix_fmt'], profile_name))
+            caps = h264
+        if width > caps['max_width'] or height > caps['max_height']:
+            if plan['action'] == 'copy':
+                plan['action'] = 'downscale'
+            plan['reasons'].append('%dx%d video is too large for %s' % (width, height, profile_name))
+            factor = min(caps['max_width'] / width, caps['max_height'] / height)
+            scale = 'scale=%d:%d' % (int(width * factor) // 2 * 2, int(height * factor) // 2 * 2)
+        if fps > caps['max_fps'] + 0.5:
+            if plan['action'] == 'copy':
+                plan['action'] = 'downscale'
+            plan['reasons'].append('%.2f fps is too fast for %s' % (fps, profile_name))
+        if plan['action'] == 'copy':
+            plan['video'] = 'copy'
+            args += ['-c:v', 'copy']
+        else:
+            plan['video'] = 'encode'
+            args += ['-c:v', 'libx264', '-preset', x264_preset, '-crf', str(x264_crf),
+                '-pix_fmt', 'yuv420p', '-profile:v', 'high', '-level:v', '%.1f' % (h264['max_level'] / 10)]
+            if scale:
+                args += ['-vf', scale]
+            if fps > caps['max_fps'] + 0.5:
+                args += ['-r', str(caps['max_fps'])]
+
+    # Audio, preferring English
+    audios = probe_streams(probe, 'audio')
+    english = [x for x in audios if stream_language(x) == 'eng']
+    default = [x for x in audios if x.get('disposition', {}).get('default')]
+    audio = (english or default or audios or [None])[0]
+    if audio:
+        plan['audio_stream'] = audio['index']
+        args += ['-map', '0:%d' % audio['index']]
+        if audio.get('codec_name') in profile['audio'] and audio.get('channels', 2) <= profile['max_audio_channels']:
+            plan['audio'] = 'copy'
+            args += ['-c:a', 'copy']
+        else:
+            plan['audio'] = 'encode'
+            plan['reasons'].append('%s audio with %s channels is not supported' % (audio.get('codec_name'), audio.get('channels')))
+            args += ['-c:a', 'aac', '-ac', '2']
+            if plan['action'] == 'copy':
+                plan['action'] = 'audio'
+
+    plan['args'] = args
+    return plan
+
+
+def transcode_codec_args(full_filename, probe):
+    """ Return a list of the ffmpeg arguments which select and encode
+    the streams, common to all of the output formats.
+    Parameters:
+      full_filename - the full path to the input file
+      probe - the output of probe_file for the input file
+    """
+
+    return transcode_plan(full_filename, probe)['args']
+
+
+def transcode_args(full_filename, probe):
+    """ Return a list of the ffmpeg output arguments (i.e. those between
+    the input file and the output) needed to stream the file to the Chromecast
+    as a single fragmented MP4 """
+
+    return (['-f', 'mp4'] # XXX mp4 or matroska, but matroska won't return seek offset during play
+        + transcode_codec_args(full_filename, probe)
+        + ['-movflags', '+frag_keyframe+separate_moof+omit_tfhd_offset+empty_moov'])
+
+
+def direct_playable(full_filename, probe):
+    """ True if the Chromecast can play the file as it is, so it is sent
+    without running ffmpeg (unless --no_direct_play). That's music with no
+    video (other than cover art) whose audio is one of audio_native_codecs,
+    or an MP4 file which transcode_plan would just copy, as long as the
+    audio it would pick is the first one (which the Chromecast plays). """
+
+    if not direct_play:
+        return False
+    videos = [x for x in probe_streams(probe, 'video') if not x.get('disposition', {}).get('attached_pic')]
+    audios = probe_streams(probe, 'audio')
+    if is_audio_file(full_filename):
+        max_channels = device_profiles[device_profile_name()]['max_audio_channels']
+        return (not videos and len(audios) == 1 and audios[0].get('codec_name') in audio_native_codecs
+            and audios[0].get('channels', 2) <= max_channels)
+    if not full_filename.lower().endswith('.mp4') or 'mp4' not in probe.get('format', {}).get('format_name', ''):
+        return False
+    plan = transcode_plan(full_filename, probe)
+    return (plan['action'] == 'copy' and plan['video'] == 'copy'
+        and plan['audio_stream'] == (audios[0]['index'] if audios else None))
+
+
+# ---------------------------------------------------------------------
+# Optional cache of transcoded output (enabled with --transcode_cache DIR).
+# When a file is streamed from the beginning the output of ffmpeg is also
+# written to the cache, and if ffmpeg runs to completion it is kept so that
+# subsequent requests to stream that file are served from the cache without
+# running ffmpeg. The cache key is made from the path, size and mtime of the
+# source file plus the ffmpeg arguments, so a changed file or a change to
+# the transcoding is a cache miss. The cache is limited in size, the least
+# recently used files are removed first (the mtime is updated on each use).
+
+def transcode_cache_path(full_filename, args):
+    """ Return the path of the cache file for the given source file
+    and ffmpeg output arguments, or None if the cache is disabled """
+
+    if not transcode_cache_dir:
+        return None
+    st = os.stat(full_filename)
+    key = json.dumps([full_filename, st.st_size, st.st_mtime, args])
+    return os.path.join(transcode_cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.mp4')
+
+
+def transcode_cache_lookup(full_filename, args):
+    """ Return the path of the cache file if it exists, otherwise None """
+
+    cache_path = transcode_cache_path(full_filename, args)
+    if cache_path and os.path.isfile(cache_path):
+        os.utime(cache_path) # mark as recently used
+        return cache_path
+    return None
+
+
+def cache_evict(cache_dir, max_size):
+    """ Remove the least recently used .mp4 files from the cache directory
+    until its total size is no more than max_size bytes """
+
+    entries = []
+    for ent in os.scandir(cache_dir):
+        if ent.name.endswith('.mp4') and ent.is_file():
+            st = ent.stat()
+            entries.append((st.st_mtime, st.st_size, ent.path))
+    total = sum(entry[1] for entry in entries)
+    for mtime, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        app_logger.debug('Removing %s from cache' % path)
+        try:
+            os.remove(path)
+            total -= size
+        except OSError as e:
+            app_logger.error('Cannot remove %s from cache: %s' % (path, e))
+
+
+# ---------------------------------------------------------------------
+# The body of a /stream response. A WSGI server (gunicorn or the Flask
+# development server) iterates over it, reading the ffmpeg pipe in its own
+# thread, and then calls close(). asgi.py reads the pipe without blocking
+# instead and passes each chunk to count(), so that a stream doesn't hold
+# a thread for the length of the movie. The bytes sent are counted in the
+# session. If cache_path is given the output is also written to a
+# temporary file in the transcode cache; if ffmpeg finishes successfully
+# that file is renamed to cache_path, otherwise (e.g. the Chromecast
+# stopped playing) it is removed. buffered is the output which has already
+# been read from the pipe by a Prefetch, which is sent first.
+
+class StreamFeed:
+    """ The output of an ffmpeg process being streamed """
+
+    def __init__(self, session, process, cache_path = None, request_started = None, buffered = None):
+        self.session = session
+        self.process = process
+        self.fd = process.stdout.fileno()
+        self.buffered = buffered or []
+        self.request_started = request_started
+        self.first_byte = None
+        self.bytes_sent = 0
+        self.complete = False       # all of the output of ffmpeg has been read
+        self.closed = False
+        self.cache_path = cache_path
+        self.cache_fd = None
+        if cache_path:
+            self.part_path = '%s.%d.part' % (cache_path, process.pid)
+            try:
+                self.cache_fd = open(self.part_path, 'wb')
+            except OSError as e:
+                app_logger.error('Cannot write to transcode cache: %s' % e)
+
+    def __iter__(self):
+        while self.buffered:
+            chunk = self.buffered.pop(0)
+            self.count(chunk)
+            yield chunk
+        while True:
+            chunk = os.read(self.fd, chunk_size)
+            if not chunk:
+                self.complete = True
+                return
+            self.count(chunk)
+            yield chunk
+
+    def count(self, chunk):
+        """ Count a chunk which is about to be sent, and write it to the cache """
+        session = self.session
+        if self.first_byte is None:
+            self.first_byte = time.time()
+            filename = urllib.parse.unquote_plus(session.filename)
+            if self.request_started:
+                timing_observe('stream_first_byte_seconds', self.first_byte - self.request_started, file = filename)
+            if session.play_started and not session.bytes_sent:
+                timing_observe('press_to_first_byte_seconds', self.first_byte - session.play_started, file = filename)
+        self.bytes_sent += len(chunk)
+        session.bytes_sent += len(chunk)
+        self.process.drained += len(chunk)
+        if self.cache_fd:
+            try:
+                self.cache_fd.write(chunk)
+            except OSError as e:
+                app_logger.error('Cannot write to transcode cache: %s' % e)
+                self.cache_fd.close()
+                self.cache_fd = None
+                os.remove(self.part_path)
+
+    def close(self):
+        """ Finish the cache file and stop the process, when the stream
+        has ended or the client has disconnected """
+        if self.closed:
+            return
+        self.closed = True
+        filename = urllib.parse.unquote_plus(self.session.filename)
+        if self.first_byte and time.time() - self.first_byte > 1:
+            timing_observe('stream_bytes_per_second', self.bytes_sent / (time.time() - self.first_byte), buckets = rate_buckets,
+                file = filename, bytes = self.bytes_sent)
+        if self.request_started:
+            timing_observe('stream_total_seconds', time.time() - self.request_started, file = filename)
+        if self.cache_fd:
+            self.cache_fd.close()
+            if self.complete and self.process.wait() == 0:
+                os.replace(self.part_path, self.cache_path)
+                app_logger.debug('Added %s to transcode cache' % self.cache_path)
+                cache_evict(transcode_cache_dir, transcode_cache_size)
+            else:
+                os.remove(self.part_path)
+        self.session.stop_process(self.process, close_pipe = True)
+        sessions.release(self.session)
+
+
 # ---------------------------------------------------------------------
 # /stream?file=path/file.mp4
 # Stream the file to the Chromecast, transcoded if necessary.
@@ -489,10 +2109,11 @@ def stream_file(filepath = None):
     # and not going to look like an additional argument to ffmpeg.
     req_file = request.args.get('file', '<None>')
     req_resume = request.args.get('resume', None)
+    req_session = request.args.get('session', None)
     req_file = req_file[1:] if req_file[0] == '/' else req_file
 
-    app_logger.debug('stream_file got file %s resume %s' % (req_file, req_resume))
-    global global_file_playing, global_pid, global_process, global_seekpos
+    app_logger.debug('stream_file got file %s resume %s session %s' % (req_file, req_resume, req_session))
+    session = sessions.get_or_create(req_session, urlencode(req_file))
 
     # Get seek position from the database if possible but override with param passed in URL
     # resume=0 starts from the beginning.
@@ -501,86 +2122,974 @@ def stream_file(filepath = None):
     if req_resume is not None:
         seekpos = float(req_resume)
     if seekpos:
-        global_seekpos = float(seekpos) # need to keep global so 'duration' can be added to it
-        seek_seconds = global_seekpos
+        seek_seconds = float(seekpos)
+    session.seekpos = seek_seconds # need to keep so 'duration' can be added to it
 
     # Find out which audio/subtitle streams are available
-    # Example ffprobe output:
-    #Input #0, matroska,webm, from 'Himalaya (check subtitles).mkv':
-    #  Duration: 01:48:24.50, start: 0.000000, bitrate: 10476 kb/s
-    #  Stream #0:0: Video: h264 (High), yuv420p(progressive), 1920x818, SAR 1:1 DAR 960:409, 23.98 fps, 23.98 tbr, 1k tbn (default)
-    #  Stream #0:1(tib): Audio: dts (DTS), 48000 Hz, 5.1(side), fltp, 1536 kb/s (default)
-    #  Stream #0:2(dut): Subtitle: subrip (default)
-    #  Stream #0:3(eng): Subtitle: subrip
-    command = ['ffprobe',
-            os.path.join(movie_dir, req_file),
-            ]
-    app_logger.debug('RUN %s' % ' '.join(command))
-    output = subprocess.check_output(command, shell=False, stderr=subprocess.STDOUT).decode('utf-8')
-    audio_eng = None
-    subtitle_eng = None
-    subtitle_count = -1
-    subtitle_cmd = ''
-    for line in output.splitlines():
-        # group1:group2 is stream, group3=language, group4=A for audio, V for video, S for subtitle
-        rc=re.match('.*Stream #([0-9]):([0-9])\(([a-z][a-z][a-z])\): ([AVS])', line)
-        if not rc:
-            continue
-        if rc.group(4) == 'A':
-            if rc.group(3) == 'eng':
-                audio_eng = rc.group(1)+':'+rc.group(2)
-        if rc.group(4) == 'S':
-            subtitle_count += 1
-            if rc.group(3) == 'eng':
-                subtitle_eng = subtitle_count
-    if not audio_eng:
-        if subtitle_eng:
-            # need to burn subtitle onto video because no english is available
-            full_filename = os.path.join(movie_dir, req_file)
-            subtitle_cmd = f'-vf subtitles={full_filename}:si={subtitle_eng}'
-    subtitle_cmd = ''
-
-    mtype = mimetype_from_filename(req_file)
-
-    # XXX this command only works for video, not audio
-    # XXX could also add options to rescale to ensure no larger than 1920x1080
-    # e.g. -vf scale='min(1920,iw):-1'
-    command = ['ffmpeg',
+    full_filename = os.path.join(movie_dir, req_file)
+    with Span('stream_probe_seconds', file = req_file):
+        probe = probe_file(full_filename)
+    session.media_duration = probe_duration(probe)
+    app_logger.debug('Probed %s duration %s video %s audio %s' % (req_file, session.media_duration,
+        [x.get('codec_name') for x in probe_streams(probe, 'video')],
+        [x.get('codec_name') for x in probe_streams(probe, 'audio')]))
+    session.plan = transcode_plan(full_filename, probe)
+    app_logger.debug('Plan for %s is %s %s' % (req_file, session.plan['action'], session.plan['reasons']))
+    output_args = transcode_args(full_filename, probe)
+
+    # A file which the Chromecast can play is sent as it is, and
+    # the Chromecast can use Range requests to seek within it
+    if direct_playable(full_filename, probe) and not seek_seconds:
+        app_logger.debug('Streaming %s without converting it' % req_file)
+        session.set_process(None)
+        return send_media_file(full_filename, mimetype_from_filename(req_file))
+    mtype = mimetype_from_filename(req_file, converted = True)
+
+    # Serve the pre-remuxed file or previously transcoded output if there is one.
+    # The Chromecast can use Range requests to seek within it.
+    cache_path = find_ready_file(full_filename, probe)
+    if cache_path and not seek_seconds:
+        app_logger.debug('Streaming %s from cache %s' % (req_file, cache_path))
+        session.set_process(None)
+        return send_media_file(cache_path, mtype)
+
+    session.stop_process() # free its slot first if the Chromecast is reconnecting
+    prefetch = prefetch_take(full_filename, seek_seconds, output_args)
+    if prefetch:
+        # ffmpeg was started when the previous file was nearly finished
+        app_logger.debug('Streaming %s from prefetch, %d bytes ready' % (req_file, prefetch.size))
+        process = prefetch.process
+        process.purpose = 'stream'
+    else:
+        command = stream_command(full_filename, seek_seconds, output_args)
+        app_logger.debug('RUN %s' % ' '.join(command))
+        stderr_dest = sys.stdout if debug else DEVNULL
+        with Span('stream_start_seconds', file = req_file):
+            process = transcoders.start(command, 'stream', req_file, stdout=PIPE, stderr=stderr_dest, stdin=DEVNULL, bufsize=-1)
+    if not process:
+        return Response('Too many streams are being transcoded, please try again later',
+            status = 503, headers = { 'Retry-After': str(transcode_queue_timeout) })
+    session.set_process(process)
+    sessions.add(session)
+    app_logger.debug('RUNNING pid %d for session %s %s' % (process.pid, session.id, session.filename))
+
+    # Keep a copy of the output in the cache if it's the whole file
+    cache_path = None
+    if transcode_cache_dir and not seek_seconds:
+        cache_path = transcode_cache_path(full_filename, output_args)
+    rv = Response(StreamFeed(session, process, cache_path, request.environ.get('ccastplayer.start'),
+        prefetch.chunks if prefetch else None), mimetype=mtype)
+    rv.direct_passthrough = True # give the StreamFeed itself to the server
+    return rv
+
+
+# ---------------------------------------------------------------------
+# Warm start of the next file. When the Chromecast is prefetch_at of the way
+# through a file the one likely to be played next (the next in the
+# Chromecast's queue, otherwise the next file in the same directory) is
+# probed, and if it will need ffmpeg, ffmpeg is started for it from its seek
+# position. Up to prefetch_bytes of its output is read into memory, then
+# ffmpeg waits, blocked writing to the pipe. If /stream is asked for that
+# file (from the same position, with the same arguments) within
+# prefetch_max_age it is given that ffmpeg process and sends what has been
+# read first, so the Chromecast starts without waiting for ffmpeg. Only one
+# file is prefetched at a time, and only if there is a free transcode slot.
+
+prefetched = None # the Prefetch waiting to be used
+prefetch_lock = threading.Lock()
+
+class Prefetch:
+    """ An ffmpeg process started early, with the start of its output """
+
+    def __init__(self, full_filename, seek_seconds, output_args, process):
+        self.key = [full_filename, seek_seconds, output_args]
+        self.process = process
+        self.fd = process.stdout.fileno()
+        self.chunks = []
+        self.size = 0
+        self.complete = False    # all of the output of ffmpeg has been read
+        self.state = 'filling'   # then taken or discarded
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.started = time.time()
+        self.thread = threading.Thread(target = self.fill, daemon = True)
+        self.thread.start()
+
+    def fill(self):
+        """ Thread which reads the output until prefetch_bytes have been read,
+        then waits until the stream is taken, discarded or too old """
+        while self.state == 'filling':
+            if time.time() - self.started > prefetch_max_age:
+                self.discard()
+            elif self.complete or self.size >= prefetch_bytes:
+                self.wakeup.wait(1)
+            elif select.select([self.fd], [], [], 0.1)[0]:
+                chunk = os.read(self.fd, chunk_size * 32)
+                if chunk:
+                    self.chunks.append(chunk)
+                    self.size += len(chunk)
+                    self.process.drained += len(chunk)
+                else:
+                    self.complete = True
+        if self.state == 'discarded':
+            app_logger.debug('Discarding prefetched stream of %s' % self.process.filename)
+            self.process.stop(close_pipe = True)
+
+    def take(self):
+        """ Stop reading, so the stream can be sent. False if it's been discarded. """
+        with self.lock:
+            if self.state != 'filling':
+                return False
+            self.state = 'taken'
+        self.wakeup.set()
+        self.thread.join()
+        return True
+
+    def discard(self):
+        """ Stop ffmpeg (from the fill thread) """
+        with self.lock:
+            if self.state == 'filling':
+                self.state = 'discarded'
+        self.wakeup.set()
+
+
+def stream_command(full_filename, seek_seconds, output_args):
+    """ Return the ffmpeg command which streams the file to stdout """
+
+    return ['ffmpeg',
             '-ss', str(seek_seconds),
-            '-i', os.path.join(movie_dir, req_file),
-            '-f', 'mp4', # XXX mp4 or matroska, but matroska won't return seek offset during play
-            '-c', 'copy', '-c:a', 'aac', '-ac', '2',
-            subtitle_cmd,
-            '-movflags', '+frag_keyframe+separate_moof+omit_tfhd_offset+empty_moov',
-            'pipe:1']
-    # Remove empty elements
-    command[:] = [x for x in command if x and len(x)]
+            '-i', full_filename] + output_args + ['pipe:1']
+
+
+def prefetch_take(full_filename, seek_seconds, output_args):
+    """ Return the Prefetch of this stream for /stream, or None if there isn't one.
+    A prefetch of another file is discarded if it's holding the last free slot. """
+
+    global prefetched
+    with prefetch_lock:
+        prefetch = prefetched
+        if not prefetch or (prefetch.key != [full_filename, seek_seconds, output_args]
+                and transcoders.active < transcode_max):
+            return None
+        prefetched = None
+    if prefetch.key == [full_filename, seek_seconds, output_args] and prefetch.take():
+        return prefetch
+    prefetch.discard()
+    return None
+
+
+def next_to_play(session):
+    """ Return the file (relative to movie_dir) likely to be played after the session's one """
+
+    queued = [other for other in sessions.cast_sessions() if other.queued]
+    if queued:
+        return urllib.parse.unquote_plus(queued[0].filename)
+    from natsort import natsorted
+    path = urllib.parse.unquote_plus(session.filename)
+    reldir = os.path.dirname(path)
+    siblings = natsorted(entry['path'] for entry in library.get_files() if entry['dir'] == reldir)
+    if path in siblings and siblings.index(path) + 1 < len(siblings):
+        return siblings[siblings.index(path) + 1]
+    return None
+
+
+def prefetch_next(session):
+    """ Thread which prefetches the file likely to be played after the session's one """
+
+    global prefetched
+    try:
+        path = next_to_play(session)
+        if not path:
+            return
+        full_filename = os.path.join(movie_dir, path)
+        start = time.time()
+        probe = probe_file(full_filename)
+        if hls_dir or direct_playable(full_filename, probe) or find_ready_file(full_filename, probe):
+            app_logger.debug('Prefetched the probe of %s, it needs no ffmpeg' % path)
+            return
+        seek_seconds = float(db_get_seekpos(urlencode(path)) or 0)
+        output_args = transcode_args(full_filename, probe)
+        with prefetch_lock:
+            if prefetched and prefetched.state == 'filling' and prefetched.key == [full_filename, seek_seconds, output_args]:
+                return
+        if transcoders.active >= transcode_max:
+            app_logger.debug('Not prefetching %s, no free transcode slot' % path)
+            return
+        command = stream_command(full_filename, seek_seconds, output_args)
+        app_logger.debug('RUN %s' % ' '.join(command))
+        process = transcoders.start(command, 'prefetch', path, stdout=PIPE, stderr=DEVNULL, stdin=DEVNULL, bufsize=-1)
+        if not process:
+            return
+        prefetch = Prefetch(full_filename, seek_seconds, output_args, process)
+        with prefetch_lock:
+            old, prefetched = prefetched, prefetch
+        if old:
+            old.discard()
+        timing_observe('prefetch_start_seconds', time.time() - start, file = path)
+    except Exception as e:
+        app_logger.error('Cannot prefetch the file after %s: %s' % (session.filename, e))
+
+
+# ---------------------------------------------------------------------
+# Optional background pre-remuxing (enabled with --remux_dir DIR).
+# Transcoding the audio while playing is the main use of CPU, so a pool of
+# low priority worker processes converts the files which are likely to be
+# played next into ready-to-play MP4 files, which /stream can send directly.
+# Likely files are the next file (in name order) in the same directory as
+# each of the recently watched files, e.g. the next episode, and the most
+# recently added files. The candidates are recalculated every remux_interval
+# seconds and whenever the Chromecast stops playing something. The files are
+# kept in a size-limited directory, least recently used removed first.
+
+remux_queue = queue.Queue()
+remux_pending = set()
+remux_wakeup = threading.Event()
+
+def remux_path(full_filename, probe):
+    """ Return the path of the pre-remuxed file for the source file, or None if disabled """
+
+    if not remux_dir:
+        return None
+    st = os.stat(full_filename)
+    key = json.dumps([full_filename, st.st_size, st.st_mtime, transcode_codec_args(full_filename, probe)])
+    return os.path.join(remux_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.mp4')
+
+
+def remux_lookup(full_filename, probe):
+    """ Return the path of the pre-remuxed file if it exists, otherwise None """
+
+    path = remux_path(full_filename, probe)
+    if path and os.path.isfile(path):
+        os.utime(path) # mark as recently used
+        return path
+    return None
+
+
+def remux_candidates():
+    """ Return a list of the files (relative to movie_dir) most likely to be watched next """
+
+    from natsort import natsorted
+    files = library.get_files()
+    by_dir = {}
+    for entry in files:
+        by_dir.setdefault(entry['dir'], []).append(entry['path'])
+    candidates = []
+    # The next file after each of the recently watched files
+    watched = sorted(global_seekpos_cache.items(), key = lambda x : x[1]['last_modified'] or datetime.datetime(2000,1,1), reverse = True)
+    for filename, row in watched[:remux_recent]:
+        path = urllib.parse.unquote_plus(filename)
+        siblings = natsorted(by_dir.get(os.path.dirname(path), []))
+        if path in siblings and siblings.index(path) + 1 < len(siblings):
+            candidates.append(siblings[siblings.index(path) + 1])
+    # The most recently added files
+    newest = sorted(files, key = lambda x : x['mtime'], reverse = True)
+    candidates += [entry['path'] for entry in newest[:remux_recent]]
+    return candidates
+
+
+def remux_scheduler():
+    """ Thread which periodically queues the likely files which haven't been remuxed """
+
+    while True:
+        try:
+            for path in remux_candidates():
+                full_filename = os.path.join(movie_dir, path)
+                if full_filename in remux_pending:
+                    continue
+                probe = probe_file(full_filename)
+                if remux_lookup(full_filename, probe) or direct_playable(full_filename, probe):
+                    continue
+                app_logger.debug('Queueing %s for remuxing' % path)
+                remux_pending.add(full_filename)
+                remux_queue.put(full_filename)
+        except Exception as e:
+            app_logger.error('Cannot schedule remuxing: %s' % e)
+        remux_wakeup.wait(remux_interval)
+        remux_wakeup.clear()
+
+
+def remux_worker():
+    """ Thread which remuxes the queued files, one ffmpeg process at a time """
+
+    while True:
+        full_filename = remux_queue.get()
+        part_path = None
+        try:
+            probe = probe_file(full_filename)
+            path = remux_path(full_filename, probe)
+            part_path = '%s.%d.part' % (path, threading.get_ident())
+            command = ['ffmpeg', '-nostdin', '-y',
+                    '-i', full_filename,
+                    ] + transcode_codec_args(full_filename, probe) + [
+                    '-movflags', '+faststart',
+                    '-f', 'mp4', part_path]
+            app_logger.debug('RUN %s' % ' '.join(command))
+            start = time.time()
+            process = transcoders.start(command, 'remux', full_filename, limited = False, nice = remux_nice,
+                stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL)
+            rc = process.wait()
+            process.stop() # reap
+            if rc == 0:
+                os.replace(part_path, path)
+                app_logger.debug('Remuxed %s in %.1f seconds' % (full_filename, time.time() - start))
+                cache_evict(remux_dir, remux_size)
+            else:
+                app_logger.error('Cannot remux %s, ffmpeg returned %d' % (full_filename, rc))
+        except Exception as e:
+            app_logger.error('Cannot remux %s: %s' % (full_filename, e))
+        finally:
+            if part_path and os.path.exists(part_path):
+                os.remove(part_path)
+            remux_pending.discard(full_filename)
+
+
+def start_remux_workers():
+    """ Start the scheduler and remux_workers worker threads """
+
+    threading.Thread(target = remux_scheduler, daemon = True).start()
+    for n in range(remux_workers):
+        threading.Thread(target = remux_worker, daemon = True).start()
+
+
+# ---------------------------------------------------------------------
+# Optional thumbnails (enabled with --thumb_dir DIR). A pool of thumb_workers
+# low priority ffmpeg processes makes a poster frame and a seek sprite sheet
+# (sprite_columns x sprite_rows frames spread evenly over the movie) for
+# every file in the library, in the background. After each library scan
+# the files without them are queued, newest first, all of the posters before
+# any of the sprites. Reading the media over the network is slow so a
+# request for a missing image never runs ffmpeg, it only moves the file to
+# the front of the queue and returns 404.
+# The images are named after a hash of the file's name, size and mtime (but
+# not its directory, so moving a file keeps its images) and the settings,
+# so a changed file gets new images. The URLs include the hash so the
+# browser can cache them for ever.
+#   /api/v1/thumb?file=path/file.mp4&kind=poster&v=hash (or kind=sprite)
+
+thumb_queue = queue.PriorityQueue()
+thumb_pending = {}   # (path, kind) -> priority, while queued or being made
+thumb_failed = set() # (key, kind) which ffmpeg could not make, not retried until restarted
+thumb_wakeup = threading.Event()
+thumb_sequence = itertools.count() # keeps the queue in order within each priority
+thumb_kinds = ('poster', 'sprite')
+
+def thumb_key(path, size, mtime):
+    """ Return the hash which names the images of a file """
+
+    key = json.dumps([os.path.basename(path), size, mtime,
+        thumb_width, sprite_tile_width, sprite_columns, sprite_rows])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:32]
+
+
+def thumb_path(key, kind):
+    """ Return the path of the image in thumb_dir """
+
+    return os.path.join(thumb_dir, key[:2], '%s-%s.jpg' % (key, kind))
+
+
+def thumb_url(entry, kind = 'poster'):
+    """ Return the URL of the poster or sprite of a library entry,
+    or None if thumbnails are disabled or it's music """
+
+    if not thumb_dir or is_audio_file(entry['path']):
+        return None
+    return '/api/v%s/thumb?file=%s&kind=%s&v=%s' % (api_version, urlencode(entry['path']), kind,
+        thumb_key(entry['path'], entry['size'], entry['mtime']))
+
+
+def thumb_queue_file(path, key, kind, priority):
+    """ Queue a file (relative to movie_dir) to have an image made,
+    unless it is already queued at the same or a higher priority (0 is the highest) """
+
+    if (key, kind) in thumb_failed or thumb_pending.get((path, kind), priority + 1) <= priority:
+        return
+    thumb_pending[(path, kind)] = priority
+    thumb_queue.put((priority, next(thumb_sequence), path, key, kind))
+
+
+def thumb_args(full_filename, kind, duration):
+    """ Return the ffmpeg input and filter arguments to make the image """
+
+    if kind == 'poster':
+        # A tenth of the way in, to miss the titles
+        seek = min(duration / 10, 300) if duration > 0 else 0
+        return ['-ss', '%.3f' % seek, '-i', full_filename, '-an', '-sn',
+            '-vf', 'scale=%d:-2' % thumb_width, '-frames:v', '1', '-q:v', '4']
+    # Only the key frames are decoded, which is much faster than decoding
+    # every frame, so the frames are only approximately evenly spaced
+    interval = duration / (sprite_columns * sprite_rows) if duration > 0 else 10
+    return ['-skip_frame', 'nokey', '-i', full_filename, '-an', '-sn',
+        '-vf', 'fps=1/%.3f,scale=%d:-2,tile=%dx%d' % (interval, sprite_tile_width, sprite_columns, sprite_rows),
+        '-frames:v', '1', '-q:v', '5']
+
+
+def thumb_scheduler():
+    """ Thread which queues the files without images after each library scan """
+
+    while True:
+        try:
+            entries = sorted(library.get_files(), key = lambda x : x['mtime'], reverse = True)
+            queued = 0
+            for priority, kind in enumerate(thumb_kinds, 1):
+                for entry in entries:
+                    if is_audio_file(entry['path']):
+                        continue
+                    key = thumb_key(entry['path'], entry['size'], entry['mtime'])
+                    if (entry['path'], kind) not in thumb_pending and not os.path.isfile(thumb_path(key, kind)):
+                        thumb_queue_file(entry['path'], key, kind, priority)
+                        queued += 1
+            app_logger.debug('Queued %d thumbnails' % queued)
+        except Exception as e:
+            app_logger.error('Cannot schedule thumbnails: %s' % e)
+        thumb_wakeup.wait(library_max_age)
+        thumb_wakeup.clear()
+
+
+def thumb_worker():
+    """ Thread which makes the queued images, one ffmpeg process at a time """
+
+    while True:
+        priority, sequence, path, key, kind = thumb_queue.get()
+        if thumb_pending.get((path, kind)) != priority:
+            continue # already made, or queued again at a higher priority
+        full_filename = os.path.join(movie_dir, path)
+        dest = thumb_path(key, kind)
+        part_path = None
+        try:
+            if not os.path.isfile(dest):
+                os.makedirs(os.path.dirname(dest), exist_ok = True)
+                part_path = '%s.%d.part' % (dest, threading.get_ident())
+                duration = probe_duration(probe_file(full_filename))
+                command = (['ffmpeg', '-nostdin', '-y'] + thumb_args(full_filename, kind, duration)
+                    + ['-f', 'mjpeg', part_path])
+                app_logger.debug('RUN %s' % ' '.join(command))
+                start = time.time()
+                process = transcoders.start(command, 'thumb', full_filename, limited = False, nice = thumb_nice,
+                    stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL)
+                rc = process.wait()
+                process.stop() # reap
+                if rc == 0 and os.path.getsize(part_path):
+                    os.replace(part_path, dest)
+                    timing_observe('thumb_seconds', time.time() - start, { 'kind': kind }, file = path)
+                else:
+                    app_logger.error('Cannot make %s of %s, ffmpeg returned %d' % (kind, path, rc))
+                    thumb_failed.add((key, kind))
+        except Exception as e:
+            app_logger.error('Cannot make %s of %s: %s' % (kind, path, e))
+            thumb_failed.add((key, kind))
+        finally:
+            if part_path and os.path.exists(part_path):
+                os.remove(part_path)
+            thumb_pending.pop((path, kind), None)
+
+
+def start_thumb_workers():
+    """ Start the scheduler and thumb_workers worker threads """
+
+    threading.Thread(target = thumb_scheduler, daemon = True).start()
+    for n in range(thumb_workers):
+        threading.Thread(target = thumb_worker, daemon = True).start()
+
+
+@app.route(f"/api/v{api_version}/thumb")
+def thumb():
+    """ Return the poster frame (kind=poster, the default)
+    or the seek sprite sheet (kind=sprite) of a file in the library """
+
+    req_file = request.args.get('file', '')
+    req_kind = request.args.get('kind', 'poster')
+    req_version = request.args.get('v', None)
+    if not thumb_dir:
+        return Response('Thumbnails are not enabled', status = 404)
+    if req_kind not in thumb_kinds:
+        return Response('Bad kind %s' % req_kind, status = 400)
+    library.db_init()
+    entry = library.files.get(req_file)
+    if not entry or is_audio_file(req_file):
+        return Response('Cannot find file %s' % req_file, status = 404)
+    key = thumb_key(entry['path'], entry['size'], entry['mtime'])
+    path = thumb_path(key, req_kind)
+    if not os.path.isfile(path):
+        thumb_queue_file(entry['path'], key, req_kind, 0)
+        rv = Response('The %s of %s has not been made yet' % (req_kind, req_file), status = 404)
+        rv.headers['Cache-Control'] = 'no-store'
+        return rv
+    # Only the URL with the current hash can be cached for ever
+    if req_version == key:
+        rv = send_media_file(path, 'image/jpeg', max_age = thumb_max_age)
+        rv.cache_control.immutable = True
+        return rv
+    return send_media_file(path, 'image/jpeg')
+
+
+# ---------------------------------------------------------------------
+# Subtitles. The Chromecast shows WebVTT subtitles given to it as a separate
+# track, so rather than burning them into the video (which would need the
+# video to be encoded) they are converted to WebVTT. A file's subtitle tracks
+# are its sidecar files (movie.mp4.vtt, movie.srt, movie.eng.srt etc., the
+# language taken from the name) and its embedded text subtitle streams.
+# .vtt files are sent as they are. With --subtitle_dir the others are
+# converted once by a low priority ffmpeg process and kept in that directory,
+# named after a hash of the source, its size and mtime: .srt files when they
+# are played, embedded streams (which means reading the whole file) in the
+# background, for the files which are likely to be played next (see
+# remux_candidates) and for a file which has been played.
+#   /api/v1/subtitles?file=path/file.mkv - the tracks, as JSON
+#   /api/v1/subtitles?file=path/file.mkv&track=2 - the WebVTT of track 2
+
+subtitle_text_codecs = ('subrip', 'srt', 'ass', 'ssa', 'mov_text', 'webvtt', 'text')
+subtitle_queue = queue.Queue()
+subtitle_pending = set()
+subtitle_failed = set() # cache paths which ffmpeg could not make, not retried until restarted
+subtitle_wakeup = threading.Event()
+
+# The ISO 639-1 codes (used by the Chromecast) of ISO 639-2 codes (used in media files)
+language_codes = { 'eng': 'en', 'fre': 'fr', 'fra': 'fr', 'ger': 'de', 'deu': 'de', 'spa': 'es',
+    'ita': 'it', 'dut': 'nl', 'nld': 'nl', 'por': 'pt', 'swe': 'sv', 'dan': 'da', 'nor': 'no',
+    'fin': 'fi', 'pol': 'pl', 'rus': 'ru', 'gre': 'el', 'ell': 'el', 'tur': 'tr', 'heb': 'he',
+    'ara': 'ar', 'hin': 'hi', 'jpn': 'ja', 'kor': 'ko', 'chi': 'zh', 'zho': 'zh', 'cze': 'cs', 'ces': 'cs',
+    'hun': 'hu', 'rum': 'ro', 'ron': 'ro', 'ukr': 'uk', 'bul': 'bg', 'hrv': 'hr', 'slo': 'sk', 'slk': 'sk',
+    'slv': 'sl', 'vie': 'vi', 'tha': 'th' }
+
+def language_code(tag):
+    """ Return the language code used for matching tracks, e.g. en for eng, en, en-GB
+    or en.forced, the tag itself if it's not known, or None if there is no tag """
+
+    tag = (tag or '').lower().replace('_', '-').split('.')[0].split('-')[0]
+    if not tag.isalpha() or tag == 'und':
+        return None
+    return language_codes.get(tag, tag)
+
+
+def is_subtitle_sidecar(name):
+    """ True if the file is a subtitle file which can be sent: a .vtt file,
+    or an .srt file if --subtitle_dir is given to keep it converted to WebVTT """
+
+    return name.endswith('.vtt') or bool(subtitle_dir and name.endswith('.srt'))
+
+
+def subtitle_sidecar_targets(name):
+    """ Return the (media file name or stem, language tag) pairs which the
+    sidecar subtitle file could belong to, longest name first. e.g. for
+    Film.en.forced.srt [('Film.en.forced', ''), ('Film', 'en.forced')].
+    Only a language code from language_codes is accepted as the tag, so
+    Film.Extended.srt belongs to Film.Extended.mkv and not to Film.mkv. """
+
+    parts = name[:-4].split('.')
+    targets = [(name[:-4], '')]
+    for n in range(len(parts) - 1, 0, -1):
+        tag = '.'.join(parts[n:])
+        code = tag.lower().replace('_', '-').split('.')[0].split('-')[0]
+        if code in language_codes or code in language_codes.values():
+            targets.append(('.'.join(parts[:n]), tag))
+    return targets
+
+
+def subtitle_cache_path(source_path, index = None):
+    """ Return the path of the WebVTT file for a sidecar file or a
+    stream of the media file, or None if the cache is disabled """
+
+    if not subtitle_dir:
+        return None
+    st = os.stat(source_path)
+    key = json.dumps([source_path, st.st_size, st.st_mtime, index])
+    return os.path.join(subtitle_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.vtt')
+
+
+def subtitle_tracks(full_filename, probe = None):
+    """ Return a list of the subtitle tracks of a file (probing it if
+    probe is not given), each a dict with keys
+      id - the track number, from 1
+      lang - the language code (see language_code) or None
+      source - the sidecar file name, or 'stream N'
+      input - the file to convert it from
+      index - the stream index in input, None for a sidecar file
+      cache - the converted WebVTT file, None for a .vtt file
+      path - the WebVTT file to send, None if it hasn't been converted yet
+    """
+
+    tracks = []
+    dirname, basename = os.path.split(full_filename)
+    stem = os.path.splitext(basename)[0]
+    try:
+        names = sorted(os.listdir(dirname))
+    except OSError:
+        names = []
+    for name in names:
+        if not is_subtitle_sidecar(name) or name == basename:
+            continue
+        for target, tag in subtitle_sidecar_targets(name):
+            if target in (basename, stem):
+                path = os.path.join(dirname, name)
+                cache = None if name.endswith('.vtt') else subtitle_cache_path(path)
+                tracks.append({ 'lang': language_code(tag), 'source': name,
+                    'input': path, 'index': None, 'cache': cache,
+                    'path': path if not cache else cache if os.path.isfile(cache) else None })
+                break
+    if subtitle_dir:
+        if probe is None:
+            try:
+                probe = probe_file(full_filename)
+            except Exception as e:
+                app_logger.error('Cannot probe %s for subtitles: %s' % (full_filename, e))
+                probe = {}
+        for stream in probe_streams(probe, 'subtitle'):
+            if stream.get('codec_name') in subtitle_text_codecs:
+                cache = subtitle_cache_path(full_filename, stream['index'])
+                tracks.append({ 'lang': language_code(stream_language(stream)), 'source': 'stream %d' % stream['index'],
+                    'input': full_filename, 'index': stream['index'], 'cache': cache,
+                    'path': cache if os.path.isfile(cache) else None })
+    for n, track in enumerate(tracks, 1):
+        track['id'] = n
+    return tracks
+
+
+def subtitle_convert(input_path, tracks):
+    """ Convert the tracks (all from input_path) to WebVTT with one ffmpeg process """
+
+    command = ['ffmpeg', '-nostdin', '-y', '-i', input_path]
+    for track in tracks:
+        track['part'] = '%s.%d.part' % (track['cache'], threading.get_ident())
+        if track['index'] is not None:
+            command += ['-map', '0:%d' % track['index']]
+        command += ['-c:s', 'webvtt', '-f', 'webvtt', track['part']]
     app_logger.debug('RUN %s' % ' '.join(command))
+    try:
+        process = transcoders.start(command, 'subtitles', input_path, limited = False, nice = subtitle_nice,
+            stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL)
+        rc = process.wait()
+        process.stop() # reap
+        for track in tracks:
+            if rc == 0 and os.path.isfile(track['part']):
+                os.replace(track['part'], track['cache'])
+                track['path'] = track['cache']
+            else:
+                app_logger.error('Cannot convert subtitles %s of %s, ffmpeg returned %d' % (track['source'], input_path, rc))
+                subtitle_failed.add(track['cache'])
+    finally:
+        for track in tracks:
+            if os.path.exists(track['part']):
+                os.remove(track['part'])
+
 
-    mtype = mimetype_from_filename(req_file)
-
-    stderr_dest = sys.stdout if debug else DEVNULL
-    global_process = Popen(command, stdout=PIPE, stderr=stderr_dest, stdin=DEVNULL, bufsize=-1)
-    global_file_playing = urlencode(req_file)
-    global_pid = global_process.pid
-    app_logger.debug('RUNNING pid %d for %s' % (global_pid, global_file_playing))
-    # Create a function that calls os.read(from process, blocksize)
-    # then an iterator which repeats until read returns empty string.
-    read_chunk = partial(os.read, global_process.stdout.fileno(), chunk_size)
-    # Debugging function:
-    def feeder():
-        chunk = os.read(global_process.stdout.fileno(), chunk_size)
-        app_logger.debug('returning chunk size %d = %s' % (len(chunk),chunk))
-        return chunk
-    # Return the HTTP response using iterator to feed all data back
+def subtitle_queue_file(full_filename):
+    """ Queue a file to have its embedded subtitles converted """
+
+    if subtitle_dir and full_filename not in subtitle_pending:
+        subtitle_pending.add(full_filename)
+        subtitle_queue.put(full_filename)
+
+
+def subtitle_scheduler():
+    """ Thread which periodically queues the likely files """
+
+    while True:
+        try:
+            for path in remux_candidates():
+                subtitle_queue_file(os.path.join(movie_dir, path))
+        except Exception as e:
+            app_logger.error('Cannot schedule subtitles: %s' % e)
+        subtitle_wakeup.wait(remux_interval)
+        subtitle_wakeup.clear()
+
+
+def subtitle_worker():
+    """ Thread which converts the subtitles of the queued files """
+
+    while True:
+        full_filename = subtitle_queue.get()
+        try:
+            tracks = [track for track in subtitle_tracks(full_filename)
+                if track['cache'] and not track['path'] and track['cache'] not in subtitle_failed]
+            by_input = {}
+            for track in tracks:
+                by_input.setdefault(track['input'], []).append(track)
+            for input_path, input_tracks in by_input.items():
+                start = time.time()
+                subtitle_convert(input_path, input_tracks)
+                app_logger.debug('Converted %d subtitle tracks of %s in %.1f seconds' % (len(input_tracks), input_path, time.time() - start))
+        except Exception as e:
+            app_logger.error('Cannot convert subtitles of %s: %s' % (full_filename, e))
+        finally:
+            subtitle_pending.discard(full_filename)
+
+
+def start_subtitle_workers():
+    """ Start the scheduler and the worker thread """
+
+    threading.Thread(target = subtitle_scheduler, daemon = True).start()
+    threading.Thread(target = subtitle_worker, daemon = True).start()
+
+
+def play_subtitles(fullpath, req_file, req_subtitles):
+    """ Return the play_media arguments for the subtitles, or {}.
+    req_subtitles is a language (e.g. fr or fre), 1 for subtitle_language,
+    0 for none, or None to show subtitle_language only if there is no
+    audio in that language. """
+
+    if req_subtitles == '0':
+        return {}
     try:
-        return Response(iter(read_chunk, b""), mimetype=mtype)
-        # To debug the network transfer use this instead:
-        #return Response(iter(feeder, b""), mimetype=mtype)
-    except:
-        # XXX this never seems to be called
-        app_logger.error('Connection closed?')
-        return Response('ABORTED')
+        probe = probe_file(fullpath)
+    except Exception as e:
+        app_logger.error('Cannot probe %s for subtitles: %s' % (fullpath, e))
+        probe = {}
+    tracks = subtitle_tracks(fullpath, probe)
+    if req_subtitles is None:
+        audio_langs = [language_code(stream_language(x)) for x in probe_streams(probe, 'audio')]
+        if not audio_langs or subtitle_language in audio_langs or None in audio_langs:
+            return {}
+        chosen = [track for track in tracks if track['lang'] == subtitle_language]
+    elif req_subtitles == '1':
+        chosen = ([track for track in tracks if track['lang'] == subtitle_language]
+            + [track for track in tracks if track['lang'] is None] + tracks)
+    else:
+        chosen = [track for track in tracks if track['lang'] == language_code(req_subtitles)]
+    # Convert a sidecar file now, it's quick, but the embedded streams in the background
+    if [track for track in tracks if track['index'] is not None and not track['path']]:
+        subtitle_queue_file(fullpath)
+    for track in chosen:
+        if not track['path'] and track['index'] is None and track['cache'] not in subtitle_failed:
+            subtitle_convert(track['input'], [track])
+        if track['path']:
+            url = subtitles_url + urlencode(req_file) + '&track=%d' % track['id']
+            return { 'subtitles': url, 'subtitles_lang': track['lang'] or subtitle_language,
+                'subtitles_mime': 'text/vtt', 'subtitle_id': track['id'] }
+    app_logger.debug('No subtitles %s for %s (tracks %s)' % (req_subtitles, req_file, [(t['lang'], t['source'], bool(t['path'])) for t in tracks]))
+    return {}
+
+
+@app.route(f"/api/v{api_version}/subtitles")
+def subtitles():
+    """ Return the subtitle tracks of a file as JSON,
+    or with &track=N the WebVTT of that track """
+
+    req_file = request.args.get('file', '')
+    req_track = request.args.get('track', None)
+    fullpath = validate_media_file(req_file)
+    if not fullpath:
+        return Response('Cannot find file %s' % req_file, status = 404)
+    tracks = subtitle_tracks(fullpath)
+    if req_track is None:
+        return jsonify([{ 'id': track['id'], 'lang': track['lang'], 'source': track['source'],
+            'ready': bool(track['path']) } for track in tracks])
+    track = [track for track in tracks if str(track['id']) == req_track]
+    if not track:
+        return Response('Cannot find track %s of %s' % (req_track, req_file), status = 404)
+    if not track[0]['path']:
+        subtitle_queue_file(fullpath)
+        rv = Response('Track %s of %s has not been converted yet' % (req_track, req_file), status = 404)
+        rv.headers['Cache-Control'] = 'no-store'
+        return rv
+    return send_media_file(track[0]['path'], 'text/vtt', max_age = subtitle_max_age)
+
+
+# ---------------------------------------------------------------------
+# Return a file which can be sent to the Chromecast as-is (and which
+# it can seek within) instead of transcoding, if there is one.
+
+def find_ready_file(full_filename, probe):
+    """ Return the path of a pre-remuxed or cached transcoded copy of the file, or None """
+
+    return (remux_lookup(full_filename, probe) or
+        transcode_cache_lookup(full_filename, transcode_args(full_filename, probe)))
+
+
+# ---------------------------------------------------------------------
+# HLS mode (enabled with --hls DIR).
+# Instead of a single fragmented MP4 stream the Chromecast is given an HLS
+# playlist of hls_segment_time second segments covering the whole file, so it
+# knows the duration and can seek. ffmpeg writes the segments into a work
+# directory (one per source file, kept for reuse) and a segment request waits
+# until its file appears. If a segment is requested which is a long way from
+# where ffmpeg has got to (i.e. the user has seeked) then ffmpeg is restarted
+# at that segment. The segments have their original timestamps so the
+# Chromecast's position (and the subtitles) are correct after a resume.
+# With -c:v copy ffmpeg can only cut at keyframes so the segments are only
+# approximately hls_segment_time long, and a run started with -ss begins at
+# the keyframe before the seek point so its cut points differ from those of
+# a run started elsewhere. The segments of one run are contiguous, so when
+# ffmpeg is restarted the segments of the previous run are removed rather
+# than mixed with the new ones (which would overlap or leave gaps).
+# /hls/path/file.mp4/index.m3u8
+# /hls/path/file.mp4/seg00000.ts
+
+class HlsJob:
+    """ The work directory and the ffmpeg process producing HLS segments for one file """
+
+    def __init__(self, full_filename, workdir):
+        self.full_filename = full_filename
+        self.workdir = workdir
+        self.lock = threading.Lock()
+        self.process = None
+        self.start_segment = 0
+
+    def segment_path(self, segment):
+        return os.path.join(self.workdir, 'seg%05d.ts' % segment)
+
+    def next_missing(self):
+        """ Return the number of the first segment not yet written
+        since ffmpeg was started """
+        segment = self.start_segment
+        while os.path.isfile(self.segment_path(segment)):
+            segment += 1
+        return segment
+
+    def is_running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def stop(self):
+        if self.process:
+            self.process.stop()
+
+    def discard_segments(self):
+        """ Remove the segments (and ffmpeg's playlist) written by earlier runs """
+        for ent in os.scandir(self.workdir):
+            if ent.name.startswith('seg') or ent.name.startswith('ffmpeg.m3u8'):
+                try:
+                    os.remove(ent.path)
+                except OSError:
+                    pass
+
+    def ensure_segment(self, segment):
+        """ Make sure that ffmpeg is (or will soon be) writing the segment,
+        restarting it from the segment if it's too far away. """
+        with self.lock:
+            if os.path.isfile(self.segment_path(segment)):
+                return
+            if self.is_running() and self.start_segment <= segment <= self.next_missing() + hls_lookahead:
+                return
+            self.stop()
+            self.discard_segments()
+            start_time = segment * hls_segment_time
+            probe = probe_file(self.full_filename)
+            codec_args = transcode_codec_args(self.full_filename, probe)
+            if '-c:v' in codec_args and codec_args[codec_args.index('-c:v') + 1] != 'copy':
+                # When encoding put a keyframe at the start of every segment
+                codec_args += ['-force_key_frames', 'expr:gte(t,n_forced*%d)' % hls_segment_time]
+            command = ['ffmpeg',
+                    '-ss', str(start_time),
+                    '-i', self.full_filename,
+                    ] + codec_args + [
+                    '-output_ts_offset', str(start_time),
+                    '-f', 'hls',
+                    '-hls_time', str(hls_segment_time),
+                    '-hls_list_size', '0',
+                    '-hls_flags', 'temp_file',
+                    '-start_number', str(segment),
+                    '-hls_segment_filename', os.path.join(self.workdir, 'seg%05d.ts'),
+                    os.path.join(self.workdir, 'ffmpeg.m3u8')]
+            app_logger.debug('RUN %s' % ' '.join(command))
+            stderr_dest = sys.stdout if debug else DEVNULL
+            self.process = transcoders.start(command, 'hls', self.full_filename,
+                stdout=DEVNULL, stderr=stderr_dest, stdin=DEVNULL)
+            self.start_segment = segment
+
+    def wait_for_segment(self, segment):
+        """ Wait for the segment to be written, return its path or None """
+        path = self.segment_path(segment)
+        deadline = time.time() + hls_segment_timeout
+        while not os.path.isfile(path):
+            if time.time() > deadline:
+                return None
+            if not self.is_running():
+                # Stopped (e.g. by the monitor thread) so start again
+                self.ensure_segment(segment)
+            time.sleep(0.1)
+        return path
+
+
+global_hls_jobs = {} # full_filename -> HlsJob
+global_hls_lock = threading.Lock()
+
+def hls_get_job(full_filename):
+    """ Return the HlsJob for the file, creating its work directory if necessary.
+    The work directory name includes the size and mtime of the file and the
+    ffmpeg arguments so that a changed file isn't served from old segments. """
+
+    probe = probe_file(full_filename)
+    st = os.stat(full_filename)
+    key = json.dumps([full_filename, st.st_size, st.st_mtime, hls_segment_time,
+        transcode_codec_args(full_filename, probe)])
+    workdir = os.path.join(hls_dir, hashlib.sha1(key.encode('utf-8')).hexdigest())
+    with global_hls_lock:
+        job = global_hls_jobs.get(full_filename)
+        if job and job.workdir == workdir:
+            return job
+        if job:
+            job.stop()
+        os.makedirs(workdir, exist_ok = True)
+        os.utime(workdir) # mark as recently used
+        hls_evict(keep = workdir)
+        job = global_hls_jobs[full_filename] = HlsJob(full_filename, workdir)
+        return job
+
+
+def hls_evict(keep):
+    """ Remove the least recently used work directories
+    so that no more than hls_keep_dirs remain """
+
+    dirs = sorted([ent for ent in os.scandir(hls_dir) if ent.is_dir() and ent.path != keep],
+        key = lambda ent: ent.stat().st_mtime, reverse = True)
+    for ent in dirs[hls_keep_dirs-1:]:
+        app_logger.debug('Removing HLS work directory %s' % ent.path)
+        shutil.rmtree(ent.path, ignore_errors = True)
+
+
+@app.route(f"/api/v{api_version}/hls/<path:req_file>/index.m3u8")
+def hls_playlist(req_file):
+    """ Return an HLS playlist for the whole of the file """
+
+    req_session = request.args.get('session', None)
+    app_logger.debug('hls_playlist got file %s session %s' % (req_file, req_session))
+    full_filename = validate_media_file(req_file)
+    if not full_filename:
+        return Response('Cannot find file %s' % req_file, status = 404)
+    probe = probe_file(full_filename)
+    duration = probe_duration(probe)
+    if duration <= 0:
+        return Response('Cannot find duration of file %s' % req_file, status = 500)
+    job = hls_get_job(full_filename)
+
+    # So the monitor thread can stop ffmpeg when the Chromecast stops playing.
+    # Other players don't get a session, as nothing would remove it.
+    session = sessions.get(req_session)
+    if session and session.filename == urlencode(req_file):
+        session.hls_job = job
+        session.seekpos = 0 # the segments have their original timestamps
+        session.media_duration = duration
+        session.plan = transcode_plan(full_filename, probe)
+        session.set_process(None)
+
+    playlist = ['#EXTM3U',
+        '#EXT-X-VERSION:3',
+        '#EXT-X-TARGETDURATION:%d' % (hls_segment_time * 2), # keyframes may make segments longer
+        '#EXT-X-MEDIA-SEQUENCE:0',
+        '#EXT-X-PLAYLIST-TYPE:VOD']
+    segment = 0
+    while segment * hls_segment_time < duration:
+        playlist.append('#EXTINF:%.3f,' % min(hls_segment_time, duration - segment * hls_segment_time))
+        playlist.append('seg%05d.ts' % segment)
+        segment += 1
+    playlist.append('#EXT-X-ENDLIST')
+    return Response('\n'.join(playlist) + '\n', mimetype = 'application/x-mpegurl')
+
+
+@app.route(f"/api/v{api_version}/hls/<path:req_file>/seg<int:segment>.ts")
+def hls_segment(req_file, segment):
+    """ Return one segment, starting ffmpeg if necessary and waiting for it """
+
+    app_logger.debug('hls_segment got file %s segment %d' % (req_file, segment))
+    full_filename = validate_media_file(req_file)
+    if not full_filename:
+        return Response('Cannot find file %s' % req_file, status = 404)
+    job = hls_get_job(full_filename)
+    job.ensure_segment(segment)
+    with Span('hls_segment_wait_seconds', file = req_file, segment = segment):
+        path = job.wait_for_segment(segment)
+    if not path:
+        return Response('Timed out waiting for segment %d of %s' % (segment, req_file), status = 504)
+    return send_media_file(path, 'video/mp2t')
 
 
 # ---------------------------------------------------------------------
@@ -589,14 +3098,19 @@ def stream_file(filepath = None):
 # to the Chromecast.
 # /play?file=path/file.mp4
 # Add &resume=0 to restart instead of continuing where you left off.
-# Add &subtitles=1 to overlay subtitles from filename.vtt (e.g. movie.mp4.vtt)
+# Add &subtitles=1 to show subtitles (see play_subtitles), &subtitles=fr for
+# French ones or &subtitles=0 for none. Without it English subtitles are
+# shown if none of the audio is in English (see --subtitle_language).
+# Add &album=1 to queue the rest of the music in the same directory.
 
 @app.route(f"/api/v{api_version}/play")
 def play_file(filepath = None):
+    global album_session
 
     req_file = request.args.get('file', '<None>')
     req_resume = request.args.get('resume', None)
     req_subtitles = request.args.get('subtitles', None)
+    req_album = request.args.get('album', None)
     req_file = req_file[1:] if req_file[0] == '/' else req_file
     app_logger.debug('play_file got %s resume %s' % (req_file, req_resume))
 
@@ -615,61 +3129,249 @@ def play_file(filepath = None):
     except:
         req_resume = None
 
-    # Construct the streaming URL
-    file_url = stream_url + urlencode(req_file)
-    subtitle_url = download_url + urlencode(req_file + '.vtt')
-
-    # Check there's a subtitles file alongside
-    if req_subtitles and os.path.isfile(fullpath + '.vtt'):
-        req_subtitles = {
-            'subtitles' : subtitle_url,
-            'subtitles_lang' : 'en-US',
-            'subtitles_mime' : 'text/vtt',
-            'subtitle_id'    : 1
-        }
-    else:
-        req_subtitles = {}
+    if not cast:
+        return Response('Chromecast "%s" not found yet, please try again in a minute' % desired_chromecast_name)
+
+    # Whatever was queued is replaced by this file
+    album_session = None
+    for queued in sessions.cast_sessions():
+        if queued.queued:
+            sessions.remove(queued.id)
+            queued.close()
+
+    # Construct the streaming URL, including a new session id so that
+    # the monitor thread can tell when the Chromecast stops playing it
+    session = sessions.create(urlencode(req_file), cast_session = True)
+    session.play_started = request.environ.get('ccastplayer.start', time.time())
+    album_session = session.id
+    file_url = stream_url + urlencode(req_file) + '&session=' + session.id
+
+    # Offer the requested subtitles (or English ones if the audio isn't English)
+    with Span('play_subtitles_seconds', file = req_file):
+        req_subtitles = play_subtitles(fullpath, req_file, req_subtitles)
     app_logger.debug('play_file got subtitles %s' % (req_subtitles))
 
     # Start worker thread and wait for cast device to be ready
     app_logger.debug('Waiting for cast device to be ready...')
     # If we timeout after 10 seconds (to prevent web server getting hung up permanently) what happens if it does timeout?
-    cast.wait(timeout = 10)
+    with Span('play_cast_wait_seconds', file = req_file):
+        cast.wait(timeout = 10)
 
     app_logger.debug('Getting media controller...')
     mc = cast.media_controller
 
+    # If the file has been remuxed, or the transcoded file is in the cache,
+    # the Chromecast can seek within it so tell it where to start rather
+    # than asking ffmpeg to seek.
+    play_args = {}
+    seek_after_start = None
+    file_type = mimetype_from_filename(req_file, converted = True)
+    if play_direct(fullpath, req_file):
+        # The file itself is sent, and the Chromecast seeks to the resume position
+        if req_resume is None:
+            req_resume = float(db_get_seekpos(urlencode(req_file)) or 0)
+        if req_resume:
+            seek_after_start = req_resume
+        file_url = direct_url + urllib.parse.quote(req_file) + '?session=' + session.id
+        file_type = mimetype_from_filename(req_file)
+        play_args['stream_type'] = 'BUFFERED'
+        req_resume = None
+    elif hls_dir:
+        # In HLS mode the Chromecast seeks to the resume position itself
+        if req_resume is None:
+            req_resume = float(db_get_seekpos(urlencode(req_file)) or 0)
+        if req_resume:
+            seek_after_start = req_resume
+        file_url = hls_url + urllib.parse.quote(req_file) + '/index.m3u8?session=' + session.id
+        file_type = 'application/x-mpegurl'
+        play_args['stream_type'] = 'BUFFERED'
+        req_resume = None
+    elif (transcode_cache_dir or remux_dir) and play_ready_file(fullpath, req_file):
+        if req_resume is None:
+            req_resume = float(db_get_seekpos(urlencode(req_file)) or 0)
+        play_args['current_time'] = req_resume
+        play_args['stream_type'] = 'BUFFERED'
+        req_resume = 0
     if req_resume is not None:
         file_url += '&resume=%s' % req_resume
-    file_type = mimetype_from_filename(req_file)
     app_logger.debug('Asking Chromecast to play %s' % file_url)
-    mc.play_media(file_url, file_type, **req_subtitles)
-    # play_media also accepts these parameters:
-    #    subtitles: str | None = None,
-    #    subtitles_lang: str = "en-US",
-    #    subtitles_mime: str = "text/vtt",
-    #    subtitle_id: int = 1,
-    # There's also an enable_subtitle() call which takes a trackid
-    if req_subtitles:
-        app_logger.debug('Asking Chromecast to enable subtitle %s' % 1)
-        mc.update_status()
-        mc.enable_subtitle(1)
+    with Span('play_media_seconds', file = req_file):
+        mc.play_media(file_url, file_type, **play_args, **req_subtitles)
+        # play_media also accepts these parameters:
+        #    subtitles: str | None = None,
+        #    subtitles_lang: str = "en-US",
+        #    subtitles_mime: str = "text/vtt",
+        #    subtitle_id: int = 1,
+        # There's also an enable_subtitle() call which takes a trackid
+        if req_subtitles:
+            app_logger.debug('Asking Chromecast to enable subtitle %s' % req_subtitles['subtitle_id'])
+            mc.update_status()
+            mc.enable_subtitle(req_subtitles['subtitle_id'])
 
 
     app_logger.debug('Waiting until active...')
     # What happens if this blocks forever?
-    mc.block_until_active()
+    with Span('play_block_until_active_seconds', file = req_file):
+        mc.block_until_active()
+
+    if seek_after_start:
+        app_logger.debug('Asking Chromecast to seek to %s' % seek_after_start)
+        mc.seek(seek_after_start)
+
+    if req_album and is_audio_file(req_file):
+        threading.Thread(target = enqueue_album, args = (mc, req_file, session.id), daemon = True).start()
 
     app_logger.debug('Playing status:')
     app_logger.debug(mc.status)
     # e.g. <MediaStatus {'metadata_type': None, 'title': None, 'series_title': None, 'season': None, 'episode': None, 'artist': None, 'album_name': None, 'album_artist': None, 'track': None, 'subtitle_tracks': {}, 'images': [], 'supports_pause': True, 'supports_seek': True, 'supports_stream_volume': True, 'supports_stream_mute': True, 'supports_skip_forward': False, 'supports_skip_backward': False, 'current_time': 0, 'content_id': 'http://commondatastorage.googleapis.com/gtv-videos-bucket/sample/BigBuckBunny.mp4', 'content_type': 'video/mp4', 'duration': None, 'stream_type': 'BUFFERED', 'idle_reason': None, 'media_session_id': 1, 'playback_rate': 1, 'player_state': 'IDLE', 'supported_media_commands': 274447, 'volume_level': 1, 'volume_muted': False, 'media_custom_data': {}, 'media_metadata': {}, 'current_subtitle_tracks': [], 'last_updated': datetime.datetime(2023, 1, 4, 14, 55, 51, 60789)}>
 
+    timing_observe('play_total_seconds', time.time() - session.play_started, file = req_file)
     return Response(f'Playing file {req_file}')
 
 
+def play_ready_file(fullpath, req_file):
+    """ Return the remuxed or cached file for play_file, timing the probe """
+
+    with Span('play_probe_seconds', file = req_file):
+        return find_ready_file(fullpath, probe_file(fullpath))
+
+
+def play_direct(fullpath, req_file):
+    """ Return True if the file can be sent as it is, for play_file, timing the probe """
+
+    with Span('play_probe_seconds', file = req_file):
+        return direct_playable(fullpath, probe_file(fullpath))
+
+
+album_session = None # the id of the session last started by play_file, see enqueue_album
+
+def enqueue_album(mc, req_file, session_id):
+    """ Thread which adds the music after req_file in its directory (in name
+    order) to the Chromecast's queue, so the tracks play one after the other
+    without anything more being asked of the server. Each has a session so
+    that the monitor can tell when it starts playing, but it isn't closed
+    while it's waiting in the queue. The files aren't probed (that would take
+    a long time for a big album), a track is sent as it is if it has one of
+    the audio_mimetypes extensions unless a cached probe says otherwise. An
+    m4a file may be ALAC so it goes through /stream, which sends it as it is
+    if it's AAC (it's audio/mp4 either way).
+    Stops if another file is played (session_id is no longer album_session). """
+
+    from natsort import natsorted
+    started = time.time()
+    reldir = os.path.dirname(req_file)
+    tracks = natsorted(entry['path'] for entry in library.get_files()
+        if entry['dir'] == reldir and is_audio_file(entry['path']))
+    if req_file not in tracks:
+        return
+    for path in tracks[tracks.index(req_file) + 1:][:album_queue_max]:
+        if album_session != session_id:
+            app_logger.debug('Stopped queueing the album of %s, another file is playing' % req_file)
+            return
+        fullpath = os.path.join(movie_dir, path)
+        cached = global_probe_cache.get(fullpath)
+        if cached:
+            direct = direct_playable(fullpath, cached[2])
+        else:
+            direct = direct_play and path.rsplit('.', 1)[1] in audio_mimetypes and not path.endswith('.m4a')
+        session = sessions.create(urlencode(path), cast_session = True)
+        session.queued = True
+        if direct:
+            file_url = direct_url + urllib.parse.quote(path) + '?session=' + session.id
+        else:
+            file_url = stream_url + urlencode(path) + '&session=' + session.id + '&resume=0'
+        app_logger.debug('Asking Chromecast to queue %s' % file_url)
+        try:
+            mc.play_media(file_url, mimetype_from_filename(path, converted = not direct),
+                stream_type = 'BUFFERED' if direct else 'LIVE', enqueue = True)
+        except Exception as e:
+            app_logger.error('Cannot queue %s: %s' % (path, e))
+            sessions.remove(session.id)
+            return
+    timing_observe('play_enqueue_seconds', time.time() - started, file = req_file)
+
+
+# ---------------------------------------------------------------------
+# Send a file from disk, honouring conditional requests (If-None-Match,
+# If-Modified-Since) and byte ranges (Range, If-Range) so that downloads
+# can be resumed and the Chromecast can seek. The file is handed to the
+# server's wsgi.file_wrapper which under gunicorn uses sendfile() so the
+# data never passes through Python. gunicorn sends exactly Content-Length
+# bytes from the current file offset, so a partial response just seeks
+# the file first. Other servers (e.g. the Flask development server)
+# send the whole file from a file_wrapper, so partial responses there
+# are fed by a generator instead.
+
+def send_media_file(fullpath, mimetype, attachment = False, max_age = None):
+    """ Return a Response which sends the file (or the requested part of it).
+    Parameters:
+      fullpath - the full path to the file
+      mimetype - the content type of the response
+      attachment - True to ask the browser to save the file
+      max_age - seconds the client may cache the file without revalidating
+    """
+
+    st = os.stat(fullpath)
+    size = st.st_size
+    etag = '%x-%x' % (int(st.st_mtime * 1000), size)
+    last_modified = datetime.datetime.fromtimestamp(int(st.st_mtime), datetime.timezone.utc)
+
+    rv = Response(mimetype = mimetype)
+    rv.set_etag(etag)
+    rv.last_modified = last_modified
+    rv.accept_ranges = 'bytes'
+    if max_age is not None:
+        rv.cache_control.public = True
+        rv.cache_control.max_age = max_age
+    if attachment:
+        rv.headers['Content-Disposition'] = f'attachment; filename={os.path.basename(fullpath)}'
+
+    # Conditional request, the client already has this version
+    if not is_resource_modified(request.environ, etag, last_modified = last_modified):
+        rv.status_code = 304
+        return rv
+
+    # Range request, only honoured if If-Range (when given) still matches
+    start, stop = 0, size
+    if request.range:
+        if_range = request.if_range
+        if ((if_range.etag and if_range.etag != etag) or
+            (if_range.date and if_range.date < last_modified)):
+            pass
+        else:
+            byte_range = request.range.range_for_length(size)
+            if byte_range is None:
+                rv.status_code = 416
+                rv.headers['Content-Range'] = 'bytes */%d' % size
+                return rv
+            start, stop = byte_range
+            rv.status_code = 206
+            rv.content_range = ContentRange('bytes', start, stop, size)
+
+    fd = open(fullpath, 'rb')
+    fd.seek(start)
+    if standalone and stop < size:
+        def feeder(fd, length):
+            with fd:
+                while length > 0:
+                    buf = fd.read(min(file_chunk_size, length))
+                    if not buf:
+                        break
+                    length -= len(buf)
+                    yield buf
+        rv.response = feeder(fd, stop - start)
+    else:
+        rv.response = wrap_file(request.environ, fd, file_chunk_size)
+    rv.direct_passthrough = True
+    rv.content_length = stop - start
+    return rv
+
+
 # ---------------------------------------------------------------------
 # The /download/ method allows the user to download the raw video file.
 # /download?file=path/file.mp4
+# Supports Range requests so downloads can be resumed,
+# and subtitle files (.vtt) may be cached by the client.
 
 @app.route(f"/api/v{api_version}/download")
 def download_file(filepath = None):
@@ -692,32 +3394,70 @@ def download_file(filepath = None):
 
     #mtype = mimetype_from_filename(req_file) # serve as movie
     mtype = 'application/octet-stream'        # serve as binary file
-    def feeder(filename):
-        with open(filename, 'rb') as fd:
-            while True:
-                buf = fd.read(chunk_size)
-                if buf:
-                    yield buf
-                else:
-                    break
-    # Return the HTTP response using iterator to feed all data back
-    return Response(stream_with_context(feeder(fullpath)), mimetype=mtype,
-        headers={
-            'Content-Disposition': f'attachment; filename={os.path.basename(fullpath)}'
-        }
-    )
+    max_age = None
+    if req_file.endswith('.vtt'):
+        mtype = 'text/vtt'
+        max_age = subtitle_max_age
+    return send_media_file(fullpath, mtype, attachment = True, max_age = max_age)
+
+
+# ---------------------------------------------------------------------
+# /direct/path/file.mp4?session=0123456789abcdef
+# Send a file which the Chromecast can play as it is (see direct_playable),
+# so playing it starts no ffmpeg process and seeking is just a Range request.
+# The path is in the URL, rather than a parameter, so it looks like any
+# other file on a web server.
+
+@app.route(f"/api/v{api_version}/direct/<path:req_file>")
+def direct_file(req_file):
+    """ Send the file, marking its session as started """
+
+    req_session = request.args.get('session', None)
+    app_logger.debug('direct_file got file %s session %s' % (req_file, req_session))
+    fullpath = validate_media_file(req_file)
+    if not fullpath:
+        return Response('Cannot find file %s' % req_file, status = 404)
+    session = sessions.get(req_session)
+    if session and session.filename == urlencode(req_file):
+        session.set_process(None)
+    return send_media_file(fullpath, mimetype_from_filename(req_file))
 
 
 # ---------------------------------------------------------------------
 # Main program, instead of python -m flask run --host etc
 
 def main():
-    global cast
     global movie_dir
+    global home_page_size
     global port
     global desired_chromecast_name
     global stream_url
     global download_url
+    global subtitles_url
+    global transcode_max
+    global transcode_nice
+    global transcode_ionice
+    global transcode_cpus
+    global transcode_threads
+    global transcode_cache_dir
+    global transcode_cache_size
+    global remux_dir
+    global remux_size
+    global remux_workers
+    global remux_nice
+    global hls_dir
+    global transcode_device
+    global hls_url
+    global direct_url
+    global direct_play
+    global prefetch_at
+    global prefetch_bytes
+    global thumb_dir
+    global thumb_workers
+    global subtitle_dir
+    global subtitle_language
+    global cast_backend
+    global fake_cast_bitrate
 
     parser = argparse.ArgumentParser(description='CCast-Player')
     parser.add_argument('-v', '--verbose', action="store_true", help='verbose (logs to screen when running with --service)')
@@ -726,7 +3466,30 @@ def main():
     parser.add_argument('--host', dest='host', action="store", help='network interfaces to listen on (default %(default)s)', default='0.0.0.0')
     parser.add_argument('--port', dest='port', action="store", help='network port to listen on (default %(default)s)', default=str(port))
     parser.add_argument('--chromecast', dest='chromecast', action="store", help='name of Chromecast to cast to (default %(default)s)', default=desired_chromecast_name)
+    parser.add_argument('--cast_backend', dest='cast_backend', action="store", choices=['pychromecast', 'fake'], help='pychromecast, or fake for an in-process fake Chromecast for testing (default %(default)s)', default=cast_backend)
+    parser.add_argument('--fake_bitrate', dest='fake_bitrate', action="store", help='Mbit/s at which the fake Chromecast pulls streams, 0 for as fast as possible (default %(default)s)', default=str(fake_cast_bitrate // 1000000))
     parser.add_argument('--media', dest='media', action="store", help='location of media files (default %(default)s)', default=movie_dir)
+    parser.add_argument('--transcode_max', dest='transcode_max', action="store", help='number of streams which can be transcoded at once (default %(default)s)', default=str(transcode_max))
+    parser.add_argument('--transcode_nice', dest='transcode_nice', action="store", help='niceness of the ffmpeg processes (default %(default)s)', default=str(transcode_nice))
+    parser.add_argument('--transcode_ionice', dest='transcode_ionice', action="store", help='I/O scheduling class of the ffmpeg processes, 1 realtime, 2 best-effort, 3 idle (default unchanged)', default=transcode_ionice)
+    parser.add_argument('--transcode_cpus', dest='transcode_cpus', action="store", help='CPUs the ffmpeg processes can use, e.g. 1-3 or 0,2 (default all)', default=None)
+    parser.add_argument('--transcode_threads', dest='transcode_threads', action="store", help='threads for each ffmpeg process, 0 for the ffmpeg default (default %(default)s)', default=str(transcode_threads))
+    parser.add_argument('--transcode_cache', dest='transcode_cache', action="store", help='directory in which to keep transcoded files (default none)', default=transcode_cache_dir)
+    parser.add_argument('--transcode_cache_size', dest='transcode_cache_size', action="store", help='maximum size of the transcode cache in GB (default %(default)s)', default=str(transcode_cache_size // (1024*1024*1024)))
+    parser.add_argument('--remux_dir', dest='remux_dir', action="store", help='directory in which to pre-remux likely files in the background (default none)', default=remux_dir)
+    parser.add_argument('--remux_size', dest='remux_size', action="store", help='maximum size of the remux directory in GB (default %(default)s)', default=str(remux_size // (1024*1024*1024)))
+    parser.add_argument('--remux_workers', dest='remux_workers', action="store", help='number of background remuxing processes (default %(default)s)', default=str(remux_workers))
+    parser.add_argument('--remux_nice', dest='remux_nice', action="store", help='niceness of the remuxing processes (default %(default)s)', default=str(remux_nice))
+    parser.add_argument('--device', dest='device', action="store", choices=['auto'] + sorted(device_profiles), help='what the Chromecast can play, auto uses its model name (default %(default)s)', default=transcode_device)
+    parser.add_argument('--thumb_dir', dest='thumb_dir', action="store", help='directory in which to keep thumbnails made in the background (default none)', default=thumb_dir)
+    parser.add_argument('--thumb_workers', dest='thumb_workers', action="store", help='number of ffmpeg processes making thumbnails (default %(default)s)', default=str(thumb_workers))
+    parser.add_argument('--subtitle_dir', dest='subtitle_dir', action="store", help='directory in which to keep .srt and embedded subtitles converted to WebVTT (default none)', default=subtitle_dir)
+    parser.add_argument('--subtitle_language', dest='subtitle_language', action="store", help='language of the subtitles to show, also shown when the audio is in another language (default %(default)s)', default=subtitle_language)
+    parser.add_argument('--prefetch_at', dest='prefetch_at', action="store", help='percentage of the way through a file when the next one is prefetched, 0 to disable (default %(default)s)', default=str(int(prefetch_at * 100)))
+    parser.add_argument('--prefetch_mb', dest='prefetch_mb', action="store", help='MB of the next file\'s stream kept in memory (default %(default)s)', default=str(prefetch_bytes // (1024*1024)))
+    parser.add_argument('--no_direct_play', dest='no_direct_play', action="store_true", help='always stream through ffmpeg, even files the Chromecast can play as they are')
+    parser.add_argument('--hls', dest='hls', action="store", help='stream using HLS, keeping segments in this directory (default none)', default=hls_dir)
+    parser.add_argument('--page_size', dest='page_size', action="store", help='number of files on each page of the listing, 0 for all (default %(default)s)', default=str(home_page_size))
     parser.add_argument('--media_dump', dest='mediadump', action="store_true", help="display the list of movie files")
     parser.add_argument('--db_dump', dest='dbdump', action="store_true", help="display the database of seek positions")
     parser.add_argument('--db_set', dest='dbset', action="store", help="set seek position (in seconds) filename=seconds (e.g. file.mp4=60)")
@@ -753,16 +3516,60 @@ def main():
         db_dump()
         sys.exit(0)
 
+    movie_dir = args.media
+    home_page_size = int(args.page_size)
+
     if args.mediadump:
-        print(str(home().data).replace('\\n','\n'))
+        library.scan()
+        for chunk in home_html(home_files('name'), 'name', 1, 0):
+            sys.stdout.write(chunk)
+        print()
         sys.exit(0)
 
     desired_chromecast_name = args.chromecast
+    cast_backend = args.cast_backend
+    fake_cast_bitrate = int(float(args.fake_bitrate) * 1000000)
     port = int(args.port)
-    movie_dir = args.media
+    transcode_max = int(args.transcode_max)
+    transcode_nice = int(args.transcode_nice)
+    transcode_ionice = int(args.transcode_ionice) if args.transcode_ionice else None
+    transcode_threads = int(args.transcode_threads)
+    if args.transcode_cpus:
+        transcode_cpus = set()
+        for cpus in args.transcode_cpus.split(','):
+            first, _, last = cpus.partition('-')
+            transcode_cpus.update(range(int(first), int(last or first) + 1))
+    transcode_cache_dir = args.transcode_cache
+    transcode_cache_size = int(float(args.transcode_cache_size) * 1024*1024*1024)
+    if transcode_cache_dir:
+        os.makedirs(transcode_cache_dir, exist_ok = True)
+    remux_dir = args.remux_dir
+    remux_size = int(float(args.remux_size) * 1024*1024*1024)
+    remux_workers = int(args.remux_workers)
+    remux_nice = int(args.remux_nice)
+    if remux_dir:
+        os.makedirs(remux_dir, exist_ok = True)
+    transcode_device = args.device
+    thumb_dir = args.thumb_dir
+    thumb_workers = int(args.thumb_workers)
+    if thumb_dir:
+        os.makedirs(thumb_dir, exist_ok = True)
+    subtitle_dir = args.subtitle_dir
+    subtitle_language = language_code(args.subtitle_language) or 'en'
+    if subtitle_dir:
+        os.makedirs(subtitle_dir, exist_ok = True)
+    hls_dir = args.hls
+    direct_play = not args.no_direct_play
+    prefetch_at = float(args.prefetch_at) / 100
+    prefetch_bytes = int(float(args.prefetch_mb) * 1024*1024)
+    if hls_dir:
+        os.makedirs(hls_dir, exist_ok = True)
     ip = get_local_ip()
     stream_url = f'http://{ip}:{port}/api/v1/stream?file=' # XXX why not just use a relative URL?
     download_url = f'http://{ip}:{port}/api/v1/download?file=' # XXX why not just use a relative URL?
+    subtitles_url = f'http://{ip}:{port}/api/v1/subtitles?file='
+    hls_url = f'http://{ip}:{port}/api/v1/hls/'
+    direct_url = f'http://{ip}:{port}/api/v1/direct/'
 
     #app_logger.debug('app.root_path = %s' % app.root_path)
     #app_logger.debug('app.instance_path = %s' % app.instance_path)
@@ -771,9 +3578,20 @@ def main():
     app_logger.debug('port = %s' % port)
     app_logger.debug('movie_dir = %s' % movie_dir)
 
-    app_logger.info('Searching for Chromecast "%s"' % desired_chromecast_name)
-    cast = find_chromecast(desired_chromecast_name)
-    start_chromecast_monitor(cast)
+    # Bring the library index up to date without delaying the start of the web server
+    library.scan_in_background()
+
+    if remux_dir:
+        start_remux_workers()
+
+    if thumb_dir:
+        start_thumb_workers()
+
+    if subtitle_dir:
+        start_subtitle_workers()
+
+    # Connect to the Chromecast found last time, and run discovery, in the background
+    discover_chromecast_in_background(use_saved = True)
 
     if standalone:
         app_logger.info('Starting web server')
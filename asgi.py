@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# Serve the app with asyncio, using an ASGI server such as uvicorn:
+#   uvicorn asgi:app --host 0.0.0.0 --port 5000 --log-config ccastplayer.logconf
+# Under gunicorn each /api/v1/stream and /api/v1/download holds a worker
+# thread for the whole length of the movie, blocked reading the ffmpeg pipe
+# or the file, so a couple of downloads and a stream starve the listing.
+# Here every request is still handled by the Flask app (in a small pool of
+# threads, so all of the routes work as before) but the body of a stream
+# or a file is sent from the event loop: the ffmpeg pipe is read when it is
+# readable and each chunk of a file is read by a thread which is then free
+# again, so a connection which is waiting costs no thread at all.
+# Other response bodies (e.g. the streamed listing) are iterated in the pool.
+
+import asyncio
+import io
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault('SERVER_SOFTWARE', 'ccastplayer asgi') # so app doesn't start its own server
+
+import app as ccast
+from werkzeug.wsgi import FileWrapper
+
+flask_app = ccast.app
+asgi_threads = 16 # threads running the Flask app, and reading files
+executor = ThreadPoolExecutor(asgi_threads, thread_name_prefix = 'asgi')
+
+
+def wsgi_environ(scope, body):
+    """ Return the WSGI environ for an ASGI http scope """
+
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'SERVER_SOFTWARE': os.environ['SERVER_SOFTWARE'],
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        environ[name] = environ[name] + ',' + value if name in environ else value
+    return environ
+
+
+def dispatch(environ):
+    """ Run the Flask app for the request (in a pool thread),
+    returning the Response rather than sending it """
+
+    ctx = flask_app.request_context(environ)
+    ctx.push()
+    try:
+        try:
+            return flask_app.full_dispatch_request()
+        except Exception as e:
+            return flask_app.handle_exception(e)
+    finally:
+        ctx.pop()
+
+
+async def wait_readable(fd, disconnected):
+    """ Wait until fd can be read or the client has disconnected """
+
+    loop = asyncio.get_running_loop()
+    readable = loop.create_future()
+    loop.add_reader(fd, lambda: readable.done() or readable.set_result(None))
+    try:
+        await asyncio.wait([readable, disconnected], return_when = asyncio.FIRST_COMPLETED)
+    finally:
+        loop.remove_reader(fd)
+        readable.cancel()
+
+
+async def send_feed(feed, send, disconnected):
+    """ Send the output of ffmpeg, reading the pipe without blocking """
+
+    while feed.buffered and not disconnected.done():
+        chunk = feed.buffered.pop(0) # already read by a prefetch
+        feed.count(chunk)
+        await send({ 'type': 'http.response.body', 'body': chunk, 'more_body': True })
+    os.set_blocking(feed.fd, False)
+    while not disconnected.done():
+        try:
+            chunk = os.read(feed.fd, ccast.chunk_size * 32)
+        except BlockingIOError:
+            await wait_readable(feed.fd, disconnected)
+            continue
+        if not chunk:
+            feed.complete = True
+            break
+        feed.count(chunk)
+        await send({ 'type': 'http.response.body', 'body': chunk, 'more_body': True })
+        await asyncio.sleep(0) # let other connections run if the pipe is always readable
+
+
+async def send_file(wrapper, length, send, disconnected):
+    """ Send length bytes (or all) of the file from its current offset,
+    reading each chunk in a pool thread """
+
+    loop = asyncio.get_running_loop()
+    while not disconnected.done() and (length is None or length > 0):
+        size = ccast.file_chunk_size if length is None else min(ccast.file_chunk_size, length)
+        chunk = await loop.run_in_executor(executor, wrapper.file.read, size)
+        if not chunk:
+            break
+        if length is not None:
+            length -= len(chunk)
+        await send({ 'type': 'http.response.body', 'body': chunk, 'more_body': True })
+
+
+async def send_iterable(app_iter, send, disconnected):
+    """ Send any other response body, iterating over it in a pool thread """
+
+    loop = asyncio.get_running_loop()
+    iterator = iter(app_iter)
+    while not disconnected.done():
+        chunk = await loop.run_in_executor(executor, next, iterator, None)
+        if chunk is None:
+            break
+        if chunk:
+            await send({ 'type': 'http.response.body', 'body': chunk, 'more_body': True })
+
+
+async def http(scope, receive, send):
+    """ Handle one HTTP request """
+
+    loop = asyncio.get_running_loop()
+    body = b''
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            break
+
+    # The next message is the client disconnecting
+    disconnected = loop.create_future()
+    async def watch():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+        disconnected.set_result(True)
+    watcher = loop.create_task(watch())
+
+    environ = wsgi_environ(scope, body)
+    response = await loop.run_in_executor(executor, dispatch, environ)
+    app_iter = None
+    try:
+        app_iter, status, headers = response.get_wsgi_response(environ)
+        await send({ 'type': 'http.response.start', 'status': int(status.split()[0]),
+            'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers] })
+        if isinstance(app_iter, ccast.StreamFeed):
+            await send_feed(app_iter, send, disconnected)
+        elif isinstance(app_iter, FileWrapper):
+            await send_file(app_iter, response.content_length, send, disconnected)
+        else:
+            await send_iterable(app_iter, send, disconnected)
+        if not disconnected.done():
+            await send({ 'type': 'http.response.body', 'body': b'', 'more_body': False })
+    finally:
+        watcher.cancel()
+        # Stopping ffmpeg can take a few seconds
+        close = app_iter.close if hasattr(app_iter, 'close') else response.close
+        await loop.run_in_executor(executor, close)
+
+
+async def app(scope, receive, send):
+    """ The ASGI application """
+
+    if scope['type'] == 'http':
+        await http(scope, receive, send)
+    elif scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({ 'type': 'lifespan.startup.complete' })
+            elif message['type'] == 'lifespan.shutdown':
+                await send({ 'type': 'lifespan.shutdown.complete' })
+                return
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# Benchmark the web app against a synthetic library:
+#   bench/bench_app.py --files 10000 --repeat 5
+# This creates a library (see make_library.py) and a SeekPos table in a
+# temporary directory, puts the stand-in ffmpeg/ffprobe from bench/bin at
+# the front of the PATH and then times, in this process:
+#   the library scan (cold and with nothing changed)
+#   prettyname and db_get_seekpos for every file
+#   the home page for each sort mode (first request, repeats, and 304s)
+#   paging through /api/v1/library
+#   downloading a large file and streaming through the fake ffmpeg over HTTP
+# so it runs on any Linux box without real media or a Chromecast.
+
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+repo_dir = os.path.dirname(bench_dir)
+sys.path.insert(0, bench_dir)
+sys.path.insert(0, repo_dir)
+
+from make_library import make_library
+
+results = []
+
+
+def record(name, seconds, **fields):
+    """ Remember and print one result """
+    results.append(dict(name = name, seconds = seconds, **fields))
+    extra = ' '.join('%s=%s' % (key, value) for key, value in fields.items())
+    print('%-32s %10.3f ms  %s' % (name, seconds * 1000, extra))
+
+
+def timed(func, repeat = 1):
+    """ Call func repeat times, return (median seconds, last result) """
+    times = []
+    for n in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times), result
+
+
+def fetch(url):
+    """ GET the URL over HTTP, return the number of bytes """
+    size = 0
+    with urllib.request.urlopen(url) as response:
+        while True:
+            chunk = response.read(1024*1024)
+            if not chunk:
+                return size
+            size += len(chunk)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the web app against a synthetic library')
+    parser.add_argument('--files', dest='files', action="store", default=10000, help='number of media files (default %(default)s)')
+    parser.add_argument('--depth', dest='depth', action="store", default=2, help='depth of the directory tree (default %(default)s)')
+    parser.add_argument('--fanout', dest='fanout', action="store", default=10, help='subdirectories in each directory (default %(default)s)')
+    parser.add_argument('--vtt', dest='vtt', action="store", default=0.3, help='fraction of files with subtitles (default %(default)s)')
+    parser.add_argument('--seek', dest='seek', action="store", default=0.1, help='fraction of files with a seek position (default %(default)s)')
+    parser.add_argument('--repeat', dest='repeat', action="store", default=5, help='times to repeat each request (default %(default)s)')
+    parser.add_argument('--download_mb', dest='download_mb', action="store", default=256, help='size of the file to download in MB, 0 to skip (default %(default)s)')
+    parser.add_argument('--stream_mb', dest='stream_mb', action="store", default=256, help='MB output by the fake ffmpeg, 0 to skip (default %(default)s)')
+    parser.add_argument('--work', dest='work', action="store", default=None, help='directory for the library and databases (default a temporary directory)')
+    parser.add_argument('--json', dest='json', action="store", default=None, help='also write the results as JSON to this file')
+    args = parser.parse_args()
+    repeat = int(args.repeat)
+
+    work_dir = args.work or tempfile.mkdtemp(prefix = 'ccastplayer-bench-')
+    media_dir = os.path.join(work_dir, 'media')
+    os.makedirs(media_dir, exist_ok = True)
+    start = time.perf_counter()
+    paths = make_library(media_dir, int(args.files), int(args.depth), int(args.fanout),
+        float(args.vtt), int(args.download_mb))
+    print('Created %d files in %s in %.1f seconds' % (len(paths), media_dir, time.perf_counter() - start))
+
+    # Import the app as gunicorn would, with its databases in work_dir
+    os.environ['PATH'] = os.path.join(bench_dir, 'bin') + os.pathsep + os.environ['PATH']
+    os.environ['SERVER_SOFTWARE'] = 'gunicorn'
+    os.environ['BENCH_STREAM_BYTES'] = str(int(args.stream_mb) * 1024 * 1024)
+    os.chdir(work_dir)
+    import app
+    app.movie_dir = media_dir
+    app.standalone = True # served by the werkzeug server below
+
+    seconds, result = timed(lambda: app.library.scan())
+    record('library_scan_cold', seconds, files = len(app.library.files))
+    seconds, result = timed(lambda: app.library.scan(), repeat)
+    record('library_scan_unchanged', seconds)
+
+    # Seed the seek positions
+    rand = random.Random(1)
+    for path in rand.sample(paths, int(len(paths) * float(args.seek))):
+        app.db_update_seekpos(app.urlencode(path), rand.randint(1, 5000))
+    app.db_flush()
+
+    seconds, result = timed(lambda: [app.prettyname(path) for path in paths])
+    record('prettyname_per_file', seconds / len(paths))
+    seconds, result = timed(lambda: [app.db_get_seekpos(app.urlencode(path)) for path in paths])
+    record('db_get_seekpos_per_file', seconds / len(paths))
+
+    client = app.app.test_client()
+    def get_page(url, **kwargs):
+        response = client.get(url, **kwargs)
+        response.get_data() # the page is streamed, so this is when it's rendered
+        return response
+    for sort in ['name', 'mtime', 'atime', 'wtime']:
+        url = '/?sort=%s' % sort
+        seconds, response = timed(lambda: get_page(url))
+        record('home_%s_first' % sort, seconds, bytes = len(response.data))
+        seconds, response = timed(lambda: get_page(url), repeat)
+        record('home_%s' % sort, seconds, bytes = len(response.data))
+        etag = response.headers['ETag']
+        seconds, response = timed(lambda: get_page(url, headers = { 'If-None-Match': etag }), repeat)
+        record('home_%s_304' % sort, seconds, status = response.status_code)
+    seconds, response = timed(lambda: get_page('/?sort=name&limit=100&page=2'), repeat)
+    record('home_name_page_of_100', seconds, bytes = len(response.data))
+
+    def page_library():
+        cursor = ''
+        for page in range(10):
+            data = client.get('/api/v1/library?sort=name&limit=100' + cursor).get_json()
+            if not data['next']:
+                break
+            cursor = '&cursor=' + data['next']
+    seconds, result = timed(page_library, repeat)
+    record('api_library_10_pages_of_100', seconds)
+
+    # Download and stream over HTTP
+    from werkzeug.serving import make_server
+    server = make_server('127.0.0.1', 0, app.app, threaded = True)
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    base_url = 'http://127.0.0.1:%d' % server.server_port
+    if int(args.download_mb):
+        seconds, size = timed(lambda: fetch(base_url + '/api/v1/download?file=download-test.mp4'))
+        record('download', seconds, bytes = size, mb_per_second = round(size / seconds / 1e6, 1))
+    if int(args.stream_mb):
+        app.direct_play = False # the MP4 files would be sent as they are
+        url = base_url + '/api/v1/stream?resume=0&file=' + urllib.parse.quote_plus(paths[0])
+        seconds, size = timed(lambda: fetch(url))
+        record('stream', seconds, bytes = size, mb_per_second = round(size / seconds / 1e6, 1))
+    server.shutdown()
+
+    if args.json:
+        with open(args.json, 'w') as fd:
+            json.dump(results, fd, indent = 2)
+    sys.stdout.flush()
+    os._exit(0) # don't wait for the app's background threads
+
+
+if __name__ == '__main__':
+    main()
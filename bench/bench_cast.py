@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# Load test the play / monitor loop using the fake Chromecast:
+#   bench/bench_cast.py --plays 5 --play_seconds 15 --clients 4 --bitrate 8
+# This starts app.py with --cast_backend fake (see fakecast.py) and the
+# stand-in ffmpeg from bench/bin, then plays --plays files one after the
+# other, each for --play_seconds, while --clients more fake players pull
+# /api/v1/stream directly. After each play it reports how long /play took,
+# the position the app has recorded compared with the fake Chromecast's,
+# the bytes streamed and the number of ffmpeg processes still running (one
+# for the Chromecast plus one for each client, anything more is a leak).
+# At the end the press_to_* timings are read from /api/v1/metrics.
+# Direct play is turned off so that every file goes through ffmpeg.
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+import urllib.request
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+repo_dir = os.path.dirname(bench_dir)
+sys.path.insert(0, bench_dir)
+sys.path.insert(0, repo_dir)
+
+from make_library import make_library
+import fakecast
+
+
+def get(url):
+    with urllib.request.urlopen(url) as response:
+        return response.read()
+
+
+def ffmpeg_children(pid):
+    """ Return the number of ffmpeg child processes of pid """
+    count = 0
+    for task in os.listdir('/proc/%d/task' % pid):
+        try:
+            with open('/proc/%d/task/%s/children' % (pid, task)) as fd:
+                children = fd.read().split()
+        except OSError:
+            continue
+        for child in children:
+            try:
+                with open('/proc/%s/cmdline' % child) as fd:
+                    command = fd.read().split('\0')
+            except OSError:
+                continue
+            # the stand-in ffmpeg is a script so look past the interpreter
+            count += any(os.path.basename(arg) == 'ffmpeg' for arg in command[:2])
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the play / monitor loop using the fake Chromecast')
+    parser.add_argument('--plays', dest='plays', action="store", default=5, help='number of files to play one after the other (default %(default)s)')
+    parser.add_argument('--play_seconds', dest='play_seconds', action="store", default=15, help='seconds to play each file (default %(default)s)')
+    parser.add_argument('--clients', dest='clients', action="store", default=0, help='other fake players streaming at the same time (default %(default)s)')
+    parser.add_argument('--bitrate', dest='bitrate', action="store", default=8, help='Mbit/s at which the fake players pull the streams (default %(default)s)')
+    parser.add_argument('--port', dest='port', action="store", default=5099, help='port for the app (default %(default)s)')
+    parser.add_argument('--work', dest='work', action="store", default=None, help='directory for the library, databases and app.log (default a temporary directory)')
+    parser.add_argument('--json', dest='json', action="store", default=None, help='also write the results as JSON to this file')
+    args = parser.parse_args()
+    plays = int(args.plays)
+    clients = int(args.clients)
+    bitrate = int(float(args.bitrate) * 1000000)
+
+    work_dir = args.work or tempfile.mkdtemp(prefix = 'ccastplayer-bench-')
+    media_dir = os.path.join(work_dir, 'media')
+    os.makedirs(media_dir, exist_ok = True)
+    paths = make_library(media_dir, plays + clients, 1, 1, 0)
+
+    env = dict(os.environ)
+    env['PATH'] = os.path.join(bench_dir, 'bin') + os.pathsep + env['PATH']
+    env['BENCH_STREAM_BYTES'] = str(100*1024*1024*1024) # longer than any play
+    base_url = 'http://127.0.0.1:%s/api/v1' % args.port
+    with open(os.path.join(work_dir, 'app.log'), 'w') as log:
+        app_process = subprocess.Popen([sys.executable, os.path.join(repo_dir, 'app.py'),
+            '--debug', '--cast_backend', 'fake', '--fake_bitrate', str(args.bitrate),
+            '--media', media_dir, '--port', str(args.port), '--transcode_max', str(clients + 2), '--no_direct_play'],
+            cwd = work_dir, env = env, stdout = log, stderr = subprocess.STDOUT)
+    results = { 'plays': [], 'clients': [] }
+    try:
+        for n in range(100):
+            try:
+                get(base_url + '/status')
+                break
+            except OSError:
+                time.sleep(0.1)
+        print('App output in %s, its log in the usual place' % os.path.join(work_dir, 'app.log'))
+
+        # The other players
+        players = []
+        for path in paths[plays:]:
+            player = fakecast.FakeChromecast('client', bitrate = bitrate)
+            player.media_controller.play_media(base_url + '/stream?resume=0&file=' + urllib.parse.quote_plus(path), 'video/mp4')
+            players.append(player)
+        started = time.time()
+
+        print('%4s %8s %10s %10s %10s %12s %7s' % ('play', 'play ms', 'cast time', 'recorded', 'error', 'bytes', 'ffmpeg'))
+        for path in paths[:plays]:
+            start = time.time()
+            text = get(base_url + '/play?resume=0&file=' + urllib.parse.quote_plus(path)).decode('utf-8')
+            play_seconds = time.time() - start
+            if not text.startswith('Playing'):
+                raise RuntimeError(text)
+            time.sleep(float(args.play_seconds))
+            status = json.loads(get(base_url + '/status?json=1'))
+            cast_time = status['chromecast']['adjusted_current_time']
+            session = [s for s in status['sessions'] if s['cast'] and s['file'] == path]
+            recorded = session[0]['position'] if session else -1
+            bytes_sent = session[0]['bytes_sent'] if session else 0
+            result = { 'file': path, 'play_seconds': play_seconds, 'cast_time': cast_time,
+                'recorded': recorded, 'bytes': bytes_sent, 'ffmpeg': ffmpeg_children(app_process.pid) }
+            results['plays'].append(result)
+            print('%4d %8.1f %10.1f %10.1f %10.1f %12d %7d' % (len(results['plays']), play_seconds * 1000,
+                cast_time, recorded, cast_time - recorded, bytes_sent, result['ffmpeg']))
+
+        for player in players:
+            mc = player.media_controller
+            results['clients'].append({ 'bytes': mc.bytes_received, 'seconds': time.time() - started,
+                'state': mc.status.player_state, 'current_time': mc.status.adjusted_current_time })
+            print('client %12d bytes %8.2f Mbit/s %s at %.1f' % (mc.bytes_received,
+                mc.bytes_received * 8 / (time.time() - started) / 1e6, mc.status.player_state, mc.status.adjusted_current_time))
+            player.disconnect()
+
+        metrics = get(base_url + '/metrics').decode('utf-8')
+        for line in metrics.splitlines():
+            if line.startswith('ccastplayer_press_to_') and ('_sum' in line or '_count' in line):
+                print(line)
+        results['metrics'] = metrics
+    finally:
+        app_process.terminate()
+        app_process.wait()
+
+    if args.json:
+        with open(args.json, 'w') as fd:
+            json.dump(results, fd, indent = 2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# Measure how long the web app takes to start, i.e. what a gunicorn worker
+# restart costs before the first byte is served:
+#   bench/bench_startup.py --media /path/to/movies --runs 5 --budget 2.0
+# For each run a new python process imports app (as gunicorn would) and
+# then requests / using the Flask test client. The report shows the
+# `python -X importtime` totals, the slowest imports and the median time
+# from starting python to the first response. If --budget is given the
+# exit status is 1 when the median time to the first response exceeds it.
+# Each run uses a new temporary directory for the databases, so / is
+# served from a cold library index.
+
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Run in the child process. Times are printed as seconds since the epoch
+# so that they can be compared with the time the parent started the child.
+child_script = '''
+import json, os, sys, time
+import_start = time.time()
+import app
+import_end = time.time()
+if len(sys.argv) > 1:
+    app.movie_dir = sys.argv[1]
+client = app.app.test_client()
+response = client.get('/')
+response_end = time.time()
+print(json.dumps({ 'import_start': import_start, 'import_end': import_end,
+    'response_end': response_end, 'status': response.status_code,
+    'bytes': len(response.data) }))
+sys.stdout.flush()
+os._exit(0) # don't wait for the background threads
+'''
+
+importtime_regex = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+
+def parse_importtime(stderr):
+    """ Return a list of (self_us, cumulative_us, module) from -X importtime output """
+
+    modules = []
+    for line in stderr.splitlines():
+        match = importtime_regex.match(line)
+        if match:
+            modules.append((int(match.group(1)), int(match.group(2)), match.group(4)))
+    return modules
+
+
+def run_once(python, media_dir):
+    """ Start the app in a new process and return a dict of timings """
+
+    env = dict(os.environ)
+    env['SERVER_SOFTWARE'] = 'gunicorn' # don't start the development server
+    env['PYTHONPATH'] = repo_dir + os.pathsep + env.get('PYTHONPATH', '')
+    command = [python, '-X', 'importtime', '-c', child_script]
+    if media_dir:
+        command.append(media_dir)
+    with tempfile.TemporaryDirectory() as work_dir:
+        start = time.time()
+        result = subprocess.run(command, cwd = work_dir, env = env,
+            stdout = subprocess.PIPE, stderr = subprocess.PIPE, universal_newlines = True)
+    if result.returncode != 0 or not result.stdout.strip():
+        print(result.stderr, file = sys.stderr)
+        raise RuntimeError('app failed to start, exit status %d' % result.returncode)
+    times = json.loads(result.stdout.strip().splitlines()[-1])
+    modules = parse_importtime(result.stderr)
+    return {
+        'interpreter': times['import_start'] - start,
+        'import': times['import_end'] - times['import_start'],
+        'first_response': times['response_end'] - times['import_end'],
+        'total': times['response_end'] - start,
+        'status': times['status'],
+        'bytes': times['bytes'],
+        'import_self_total': sum(x[0] for x in modules) / 1e6,
+        'modules': modules,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the startup time of the web app')
+    parser.add_argument('--media', dest='media', action="store", default=None, help='media directory to list (default the app default)')
+    parser.add_argument('--runs', dest='runs', action="store", default=5, help='number of runs (default %(default)s)')
+    parser.add_argument('--top', dest='top', action="store", default=15, help='number of slowest imports to show (default %(default)s)')
+    parser.add_argument('--budget', dest='budget', action="store", default=None, help='fail if the median time to the first response exceeds this many seconds')
+    parser.add_argument('--python', dest='python', action="store", default=sys.executable, help='python interpreter (default %(default)s)')
+    parser.add_argument('--json', dest='json', action="store_true", help='output the results as JSON')
+    args = parser.parse_args()
+
+    runs = [run_once(args.python, args.media) for n in range(int(args.runs))]
+    summary = {}
+    for key in ['interpreter', 'import', 'first_response', 'total', 'import_self_total']:
+        values = [run[key] for run in runs]
+        summary[key] = { 'median': statistics.median(values), 'min': min(values), 'max': max(values) }
+
+    # Slowest top-level packages in the last run, by cumulative time
+    # (the nesting shown by -X importtime is unreliable because the
+    # library scan and Chromecast discovery threads also import modules)
+    modules = [x for x in runs[-1]['modules'] if '.' not in x[2]]
+    slowest = sorted(modules, key = lambda x : x[1], reverse = True)[:int(args.top)]
+
+    if args.json:
+        print(json.dumps({ 'summary': summary,
+            'slowest': [{ 'module': x[2], 'cumulative': x[1] / 1e6 } for x in slowest],
+            'status': runs[-1]['status'], 'bytes': runs[-1]['bytes'] }, indent = 2))
+    else:
+        print('%d runs, / returned status %d with %d bytes' % (len(runs), runs[-1]['status'], runs[-1]['bytes']))
+        print('%-28s %8s %8s %8s' % ('seconds', 'median', 'min', 'max'))
+        for key, label in [('interpreter', 'python startup'), ('import', 'import app'),
+                ('first_response', 'first response for /'), ('total', 'start to first response'),
+                ('import_self_total', 'importtime self total')]:
+            print('%-28s %8.3f %8.3f %8.3f' % (label, summary[key]['median'], summary[key]['min'], summary[key]['max']))
+        print('\nSlowest imports (cumulative seconds):')
+        for self_us, cumulative_us, module in slowest:
+            print('  %-26s %8.3f' % (module, cumulative_us / 1e6))
+
+    if args.budget is not None and summary['total']['median'] > float(args.budget):
+        print('Start to first response %.3f seconds exceeds the budget of %s seconds'
+            % (summary['total']['median'], args.budget), file = sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
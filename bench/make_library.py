@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# Create a synthetic media library for the benchmarks:
+#   bench/make_library.py /tmp/media --files 10000 --depth 2 --fanout 10 --vtt 0.3
+# The files are empty (except for an optional large sparse file to
+# download) so a library of 100k files takes no space. The names look like
+# real ones, e.g.
+#   Show 007/Season 2/Show.007.S02E05.1080p.WEB-DL.x264.mkv
+#   Film 0123 (1987) 720p BluRay XviD.avi
+# so that prettyname and the natural sort have realistic work to do.
+# The same arguments (and --seed) always make the same library.
+
+import argparse
+import os
+import random
+
+video_exts = ['mkv', 'mp4', 'avi', 'mov', 'ts']
+tags = ['1080p.WEB-DL.x264', '720p.BluRay.XviD', 'DVDRip.DivX', 'h264_a1b2c3d4_original', '1080p.H264']
+
+
+def make_dirs(root, depth, fanout):
+    """ Return the list of leaf directories (relative to root) of a tree
+    with fanout subdirectories at each of depth levels """
+    dirs = ['']
+    for level in range(depth):
+        name = 'Show %03d' if level == 0 else 'Season %d'
+        dirs = [os.path.join(d, name % (n + 1)) for d in dirs for n in range(fanout)]
+    for d in dirs:
+        os.makedirs(os.path.join(root, d), exist_ok = True)
+    return dirs
+
+
+def make_library(root, files = 10000, depth = 2, fanout = 10, vtt = 0.3, download_mb = 0, seed = 1):
+    """ Create the library under root and return the list of the media
+    files created (relative to root). If download_mb is not 0 a sparse
+    file download-test.mp4 of that size is also created. """
+
+    rand = random.Random(seed)
+    dirs = make_dirs(root, depth, fanout)
+    paths = []
+    for n in range(files):
+        d = dirs[n % len(dirs)]
+        ext = rand.choice(video_exts)
+        if depth:
+            show = os.path.basename(os.path.dirname(d) if depth > 1 else d).replace(' ', '.')
+            name = '%s.S%02dE%02d.%s.%s' % (show, (n // len(dirs)) // 20 + 1, (n // len(dirs)) % 20 + 1, rand.choice(tags), ext)
+        else:
+            name = 'Film %05d (%d) %s.%s' % (n, rand.randint(1950, 2023), rand.choice(tags).replace('.', ' '), ext)
+        path = os.path.join(d, name)
+        open(os.path.join(root, path), 'wb').close()
+        if rand.random() < vtt:
+            open(os.path.join(root, path + '.vtt'), 'wb').close()
+        paths.append(path)
+    if download_mb:
+        with open(os.path.join(root, 'download-test.mp4'), 'wb') as fd:
+            fd.truncate(download_mb * 1024 * 1024)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Create a synthetic media library')
+    parser.add_argument('root', action="store", help='directory to create the library in')
+    parser.add_argument('--files', dest='files', action="store", default=10000, help='number of media files (default %(default)s)')
+    parser.add_argument('--depth', dest='depth', action="store", default=2, help='depth of the directory tree (default %(default)s)')
+    parser.add_argument('--fanout', dest='fanout', action="store", default=10, help='subdirectories in each directory (default %(default)s)')
+    parser.add_argument('--vtt', dest='vtt', action="store", default=0.3, help='fraction of files with a .vtt subtitle file (default %(default)s)')
+    parser.add_argument('--download_mb', dest='download_mb', action="store", default=0, help='size of the sparse download-test.mp4 file in MB (default none)')
+    parser.add_argument('--seed', dest='seed', action="store", default=1, help='random number seed (default %(default)s)')
+    args = parser.parse_args()
+    paths = make_library(args.root, int(args.files), int(args.depth), int(args.fanout),
+        float(args.vtt), int(args.download_mb), int(args.seed))
+    print('Created %d files in %s' % (len(paths), args.root))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+# A fake Chromecast which runs in the same process as the web app, so that
+# play_file, the monitor and /status can be load tested and profiled
+# without a real device:
+#   app.py --cast_backend fake --fake_bitrate 8
+# It has the parts of the pychromecast Chromecast and MediaController
+# interfaces which app.py uses (cast_info, wait, media_controller.play_media,
+# block_until_active, seek, status listeners ...). play_media starts a
+# thread which pulls the URL over HTTP like a real player, at bitrate bits
+# per second (0 for as fast as possible), and advances current_time by the
+# amount of media received. HLS playlists are followed segment by segment
+# using the #EXTINF durations. Media added with enqueue=True is played when
+# the current item finishes. Like a real Chromecast the status listeners
+# are only called when the player state changes.
+
+import datetime
+import threading
+import time
+import urllib.parse
+import urllib.request
+import uuid
+
+chunk_size = 64*1024
+
+
+class FakeCastInfo:
+    """ Looks like pychromecast's CastInfo """
+
+    def __init__(self, friendly_name, model_name, host, port):
+        self.friendly_name = friendly_name
+        self.model_name = model_name
+        self.host = host
+        self.port = port
+        self.uuid = uuid.uuid5(uuid.NAMESPACE_DNS, friendly_name)
+        self.cast_type = 'cast'
+        self.manufacturer = 'Fake'
+
+    def __repr__(self):
+        return 'FakeCastInfo(friendly_name=%r, model_name=%r, host=%r, port=%r)' % (
+            self.friendly_name, self.model_name, self.host, self.port)
+
+
+class FakeMediaStatus:
+    """ Looks like pychromecast's MediaStatus """
+
+    def __init__(self):
+        self.content_id = None
+        self.content_type = None
+        self.duration = None
+        self.current_time = 0
+        self.stream_type = None
+        self.player_state = 'UNKNOWN'
+        self.idle_reason = None
+        self.media_session_id = None
+        self.playback_rate = 1
+        self.supported_media_commands = 0
+        self.volume_level = 1
+        self.volume_muted = False
+        self.title = None
+        self.subtitle_tracks = {}
+        self.current_subtitle_tracks = []
+        self.media_custom_data = {}
+        self.media_metadata = {}
+        self.last_updated = None
+
+    @property
+    def adjusted_current_time(self):
+        """ current_time extrapolated to now if playing, as pychromecast does """
+        if self.player_state == 'PLAYING' and self.last_updated:
+            return self.current_time + (datetime.datetime.now() - self.last_updated).total_seconds() * self.playback_rate
+        return self.current_time
+
+
+class FakeMediaController:
+    """ Plays media by pulling it over HTTP """
+
+    def __init__(self, bitrate):
+        self.bitrate = bitrate
+        self.status = None
+        self.listeners = []
+        self.lock = threading.Lock()
+        self.active = threading.Event()
+        self.stop_event = None
+        self.seek_to = None
+        self.media_session_id = 0
+        self.bytes_received = 0
+        self.queue = []     # (url, content_type, current_time, stream_type) to play next
+
+    def register_status_listener(self, listener):
+        self.listeners.append(listener)
+
+    def notify(self):
+        """ Send the status to the listeners """
+        for listener in self.listeners:
+            listener.new_media_status(self.status)
+
+    def set_state(self, stop_event, player_state, idle_reason = None):
+        """ Change the player state (unless the player has been replaced) and tell the listeners """
+        with self.lock:
+            if stop_event is not self.stop_event:
+                return
+            self.status.player_state = player_state
+            self.status.idle_reason = idle_reason
+            self.status.last_updated = datetime.datetime.now()
+        self.notify()
+
+    def set_time(self, stop_event, current_time):
+        with self.lock:
+            if stop_event is self.stop_event:
+                self.status.current_time = current_time
+                self.status.last_updated = datetime.datetime.now()
+
+    def play_media(self, url, content_type, current_time = 0, stream_type = 'LIVE', enqueue = False, **kwargs):
+        """ Stop playing anything else (and clear the queue) and start
+        pulling url in a thread, or with enqueue add it to the queue if
+        something is playing. The subtitle and metadata arguments are
+        accepted and ignored. """
+        with self.lock:
+            if enqueue and self.stop_event and not self.stop_event.is_set() and self.status.player_state != 'IDLE':
+                self.queue.append((url, content_type, current_time, stream_type))
+                return
+            self.queue = []
+        self.stop(idle_reason = 'INTERRUPTED')
+        self.load(url, content_type, current_time, stream_type)
+
+    def load(self, url, content_type, current_time, stream_type):
+        """ Start pulling url in a thread """
+        stop_event = threading.Event()
+        with self.lock:
+            self.media_session_id += 1
+            self.status = FakeMediaStatus()
+            self.status.content_id = url
+            self.status.content_type = content_type
+            self.status.stream_type = stream_type
+            self.status.current_time = current_time or 0
+            self.status.media_session_id = self.media_session_id
+            self.stop_event = stop_event
+            self.seek_to = None
+            self.active.clear()
+        self.set_state(stop_event, 'BUFFERING')
+        player = self.play_hls if 'mpegurl' in content_type else self.play_stream
+        threading.Thread(target = self.play, args = (player, url, stop_event), daemon = True).start()
+
+    def play(self, player, url, stop_event):
+        """ Run the player, setting the final state """
+        try:
+            player(url, stop_event)
+            idle_reason = 'CANCELLED' if stop_event.is_set() else 'FINISHED'
+        except Exception as e:
+            idle_reason = 'ERROR'
+            for listener in self.listeners:
+                if hasattr(listener, 'load_media_failed'):
+                    listener.load_media_failed(url, str(e))
+        self.active.set() # don't leave block_until_active waiting
+        self.set_state(stop_event, 'IDLE', idle_reason)
+        with self.lock:
+            next_item = self.queue.pop(0) if idle_reason == 'FINISHED' and stop_event is self.stop_event and self.queue else None
+        if next_item:
+            self.load(*next_item)
+
+    def pull(self, url, stop_event, start_time, seconds = None, offset = 0):
+        """ Read url (from byte offset) at bitrate, advancing current_time
+        from start_time. If the length of the media (seconds) is known the
+        time advances in proportion to the bytes read, otherwise at the bitrate. """
+        request = urllib.request.Request(url, headers = { 'Range': 'bytes=%d-' % offset } if offset else {})
+        with urllib.request.urlopen(request) as response:
+            self.active.set()
+            length = int(response.headers.get('Content-Length') or 0)
+            started = time.time()
+            received = 0
+            while not stop_event.is_set():
+                chunk = response.read(chunk_size)
+                if not chunk:
+                    break
+                if not received:
+                    self.set_state(stop_event, 'PLAYING')
+                received += len(chunk)
+                self.bytes_received += len(chunk)
+                if seconds and length:
+                    self.set_time(stop_event, start_time + seconds * received / length)
+                elif self.bitrate:
+                    self.set_time(stop_event, start_time + received * 8 / self.bitrate)
+                else:
+                    self.set_time(stop_event, start_time + time.time() - started)
+                if self.bitrate:
+                    delay = started + received * 8 / self.bitrate - time.time()
+                    if delay > 0:
+                        stop_event.wait(delay)
+                if self.seek_to is not None:
+                    break
+
+    def play_stream(self, url, stop_event):
+        """ Play a single (progressive) stream. A BUFFERED one (i.e. a file)
+        starts at current_time, and seeks, with a Range request, taking the
+        bitrate as the rate of the media. """
+        start_time = self.status.current_time
+        buffered = self.status.stream_type == 'BUFFERED' and self.bitrate
+        while not stop_event.is_set():
+            offset = int(start_time * self.bitrate / 8) if buffered else 0
+            self.pull(url, stop_event, start_time, offset = offset)
+            if self.seek_to is None:
+                break
+            start_time, self.seek_to = self.seek_to, None
+
+    def play_hls(self, url, stop_event):
+        """ Play each of the segments in the HLS playlist in turn """
+        with urllib.request.urlopen(url) as response:
+            lines = response.read().decode('utf-8').splitlines()
+        segments = []
+        start = 0
+        for line in lines:
+            if line.startswith('#EXTINF:'):
+                duration = float(line[len('#EXTINF:'):].split(',')[0])
+            elif line and not line.startswith('#'):
+                segments.append((urllib.parse.urljoin(url, line), start, duration))
+                start += duration
+        with self.lock:
+            self.status.duration = start
+        segment = 0
+        while segment < len(segments) and not stop_event.is_set():
+            if self.seek_to is not None:
+                # Jump to the segment containing the new position
+                seek_to, self.seek_to = self.seek_to, None
+                segment = max([n for n, (u, s, d) in enumerate(segments) if s <= seek_to] or [0])
+            segment_url, segment_start, segment_duration = segments[segment]
+            self.pull(segment_url, stop_event, segment_start, segment_duration)
+            if self.seek_to is None:
+                segment += 1
+
+    def block_until_active(self, timeout = None):
+        """ Wait for the player to connect """
+        self.active.wait(timeout)
+
+    def update_status(self):
+        pass
+
+    def enable_subtitle(self, trackid):
+        with self.lock:
+            if self.status:
+                self.status.current_subtitle_tracks = [trackid]
+
+    def seek(self, position):
+        """ Seek within an HLS playlist or a file, or just move the time for a live stream """
+        with self.lock:
+            if not self.status:
+                return
+            self.status.current_time = position
+            self.status.last_updated = datetime.datetime.now()
+            if 'mpegurl' in (self.status.content_type or '') or self.status.stream_type == 'BUFFERED':
+                self.seek_to = position
+        self.notify()
+
+    def stop(self, idle_reason = 'CANCELLED'):
+        """ Stop the player, and forget the queue """
+        with self.lock:
+            self.queue = []
+            stop_event, self.stop_event = self.stop_event, None
+            if not stop_event:
+                return
+            stop_event.set()
+            self.status.player_state = 'IDLE'
+            self.status.idle_reason = idle_reason
+            self.status.last_updated = datetime.datetime.now()
+        self.notify()
+
+
+class FakeChromecast:
+    """ Looks like pychromecast's Chromecast """
+
+    def __init__(self, friendly_name = 'TV', model_name = 'Fake Chromecast', bitrate = 8000000, host = '127.0.0.1', port = 8009):
+        self.cast_info = FakeCastInfo(friendly_name, model_name, host, port)
+        self.media_controller = FakeMediaController(bitrate)
+
+    def start(self):
+        pass
+
+    def wait(self, timeout = None):
+        return True
+
+    def disconnect(self, timeout = None):
+        self.media_controller.stop()
+
+    def __repr__(self):
+        return 'FakeChromecast(%r)' % self.cast_info
@@ -0,0 +1,333 @@
+# Tests of app.py which don't need ffmpeg or a Chromecast:
+#   python -m pytest tests
+# Each test gets an empty media directory (and working directory, for the
+# databases) made by pytest, and uses the Flask test client.
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+os.environ['SERVER_SOFTWARE'] = 'gunicorn' # log to the app logger, not ccastplayer.log
+# Importing app runs main(), which keeps its databases and the saved
+# Chromecast address in the current directory
+os.chdir(tempfile.mkdtemp(prefix = 'ccastplayer-test-'))
+import app as ccast
+
+
+@pytest.fixture
+def media_dir(tmp_path, monkeypatch):
+    """ An empty media directory, also the working directory """
+    monkeypatch.setattr(ccast, 'movie_dir', str(tmp_path))
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def client(media_dir, monkeypatch):
+    # The test client sends the whole of a file_wrapper, like the Flask development server
+    monkeypatch.setattr(ccast, 'standalone', True)
+    return ccast.app.test_client()
+
+
+def get(client, url, **headers):
+    """ Return the response with its body read and the file closed """
+    rv = client.get(url, headers = headers)
+    rv.get_data()
+    rv.close()
+    return rv
+
+
+# ---------------------------------------------------------------------
+# send_media_file, through /download
+
+content = bytes(range(256)) * 40
+
+@pytest.fixture
+def movie(media_dir):
+    (media_dir / 'movie.mp4').write_bytes(content)
+    return '/api/v1/download?file=movie.mp4'
+
+
+def test_download_whole_file(client, movie):
+    rv = get(client, movie)
+    assert rv.status_code == 200
+    assert rv.data == content
+    assert rv.headers['Content-Length'] == str(len(content))
+    assert rv.headers['Accept-Ranges'] == 'bytes'
+    assert rv.headers['ETag'] and rv.headers['Last-Modified']
+
+
+def test_download_range(client, movie):
+    rv = get(client, movie, Range = 'bytes=100-299')
+    assert rv.status_code == 206
+    assert rv.data == content[100:300]
+    assert rv.headers['Content-Length'] == '200'
+    assert rv.headers['Content-Range'] == 'bytes 100-299/%d' % len(content)
+
+
+def test_download_range_to_end(client, movie):
+    rv = get(client, movie, Range = 'bytes=-50')
+    assert rv.status_code == 206
+    assert rv.data == content[-50:]
+    assert rv.headers['Content-Range'] == 'bytes %d-%d/%d' % (len(content) - 50, len(content) - 1, len(content))
+
+
+def test_download_unsatisfiable_range(client, movie):
+    rv = get(client, movie, Range = 'bytes=%d-' % len(content))
+    assert rv.status_code == 416
+    assert rv.headers['Content-Range'] == 'bytes */%d' % len(content)
+    assert rv.data == b''
+
+
+def test_download_not_modified(client, movie):
+    etag = get(client, movie).headers['ETag']
+    rv = get(client, movie, **{ 'If-None-Match': etag })
+    assert rv.status_code == 304
+    assert rv.data == b''
+    last_modified = get(client, movie).headers['Last-Modified']
+    assert get(client, movie, **{ 'If-Modified-Since': last_modified }).status_code == 304
+
+
+def test_download_if_range(client, movie):
+    etag = get(client, movie).headers['ETag']
+    rv = get(client, movie, Range = 'bytes=0-9', **{ 'If-Range': etag })
+    assert rv.status_code == 206
+    assert rv.data == content[:10]
+    # The file has changed since the client got the first part, so it gets all of it
+    rv = get(client, movie, Range = 'bytes=0-9', **{ 'If-Range': '"0-0"' })
+    assert rv.status_code == 200
+    assert rv.data == content
+    assert 'Content-Range' not in rv.headers
+
+
+# ---------------------------------------------------------------------
+# /api/v1/library paging
+
+@pytest.fixture
+def library(media_dir, monkeypatch):
+    """ A library of 36 files in three directories, with names which sort
+    naturally (Ep 2 before Ep 10) and several files with the same mtime """
+    for n, show in enumerate(['Show A', 'Show B', 'Show C']):
+        (media_dir / show).mkdir()
+        for episode in range(1, 13):
+            path = media_dir / show / ('Ep %d.%s' % (episode, 'mkv' if episode % 2 else 'mp4'))
+            path.write_bytes(b'')
+            mtime = 1700000000 + (episode // 4) * 1000 + n # ties within each show
+            os.utime(path, (mtime, mtime))
+    index = ccast.LibraryIndex(str(media_dir / 'library.sqlite'))
+    monkeypatch.setattr(ccast, 'library', index)
+    index.scan()
+    return index
+
+
+def page_through(client, query, limit, between_pages = None):
+    """ Return the paths on all of the pages, following the next cursors.
+    between_pages is called with the paths so far after each page but the last. """
+    paths = []
+    cursor = None
+    while True:
+        rv = client.get('/api/v1/library?%s&limit=%d' % (query, limit) + ('&cursor=' + cursor if cursor else ''))
+        assert rv.status_code == 200
+        page = rv.get_json()
+        assert len(page['items']) <= limit
+        paths += [item['path'] for item in page['items']]
+        cursor = page['next']
+        if not cursor:
+            return paths
+        if between_pages:
+            between_pages(paths)
+
+
+@pytest.mark.parametrize('sort', ['name', 'mtime', 'atime'])
+def test_library_pages(client, library, sort):
+    everything = page_through(client, 'sort=' + sort, 1000)
+    assert sorted(everything) == sorted(library.files)
+    for limit in (1, 5, 12, 35):
+        assert page_through(client, 'sort=' + sort, limit) == everything
+
+
+def test_library_sort_order(client, library):
+    by_name = page_through(client, 'sort=name', 1000)
+    assert by_name[:3] == ['Show A/Ep 1.mkv', 'Show A/Ep 2.mp4', 'Show A/Ep 3.mkv']
+    assert by_name.index('Show A/Ep 9.mkv') < by_name.index('Show A/Ep 10.mp4')
+    by_mtime = page_through(client, 'sort=mtime', 1000)
+    mtimes = [library.files[path]['mtime'] for path in by_mtime]
+    assert mtimes == sorted(mtimes, reverse = True)
+
+
+def test_library_pages_filtered(client, library):
+    everything = [path for path in page_through(client, 'sort=mtime', 1000)
+        if path.startswith('Show B/') and path.endswith('.mkv')]
+    assert len(everything) == 6
+    assert page_through(client, 'sort=mtime&dir=Show B&ext=mkv', 4) == everything
+
+
+def test_library_pages_while_changing(client, library, media_dir):
+    # Between pages a file is added before the cursor and the last file
+    # sent is removed, which would make offset paging repeat or skip files
+    before = page_through(client, 'sort=name', 1000)
+    def change(paths):
+        (media_dir / 'Show A' / ('Ep 0.%d.mp4' % len(paths))).write_bytes(b'')
+        os.remove(media_dir / paths[-1])
+        os.utime(media_dir / 'Show A') # the scan only reads directories whose mtime has changed
+        library.scan()
+    assert page_through(client, 'sort=name', 5, change) == before
+    assert 'Show A/Ep 0.5.mp4' in library.files and before[4] not in library.files
+
+
+# ---------------------------------------------------------------------
+# transcode_plan, with probes like those from ffprobe
+
+def probe(*streams):
+    return { 'streams': [dict(stream, index = n) for n, stream in enumerate(streams)],
+        'format': { 'format_name': 'matroska,webm', 'duration': '5400.0' } }
+
+def h264(width = 1920, height = 1080, fps = '24000/1001', level = 40, pix_fmt = 'yuv420p'):
+    return { 'codec_type': 'video', 'codec_name': 'h264', 'width': width, 'height': height,
+        'avg_frame_rate': fps, 'level': level, 'pix_fmt': pix_fmt }
+
+def hevc_4k():
+    return { 'codec_type': 'video', 'codec_name': 'hevc', 'width': 3840, 'height': 2160,
+        'avg_frame_rate': '24/1', 'level': 153, 'pix_fmt': 'yuv420p10le' }
+
+def audio(codec = 'aac', channels = 2, language = None, default = 0):
+    stream = { 'codec_type': 'audio', 'codec_name': codec, 'channels': channels,
+        'disposition': { 'default': default } }
+    if language:
+        stream['tags'] = { 'language': language }
+    return stream
+
+
+@pytest.mark.parametrize('streams, actions', [
+    # gen2, gen3, ultra
+    ((h264(), audio()), ('copy', 'copy', 'copy')),
+    ((h264(fps = '60/1', level = 41), audio()), ('downscale', 'copy', 'copy')),
+    ((h264(level = 42), audio()), ('transcode', 'copy', 'copy')),
+    ((h264(), audio('ac3', 6)), ('audio', 'audio', 'audio')),
+    ((h264(), audio('aac', 6)), ('audio', 'audio', 'audio')),
+    ((h264(3840, 2160, level = 51), audio()), ('transcode', 'transcode', 'transcode')),
+    ((h264(3840, 2160, level = 41), audio()), ('downscale', 'downscale', 'downscale')),
+    ((h264(pix_fmt = 'yuv420p10le'), audio()), ('transcode', 'transcode', 'transcode')),
+    ((hevc_4k(), audio('eac3', 6)), ('transcode', 'transcode', 'audio')),
+    ((hevc_4k(), audio()), ('transcode', 'transcode', 'copy')),
+    ((audio('mp3'),), ('copy', 'copy', 'copy')),
+    ((audio('flac'),), ('audio', 'audio', 'audio')),
+])
+def test_transcode_plan_actions(monkeypatch, streams, actions):
+    for profile, action in zip(('gen2', 'gen3', 'ultra'), actions):
+        monkeypatch.setattr(ccast, 'transcode_device', profile)
+        plan = ccast.transcode_plan('/movies/film.mkv', probe(*streams))
+        assert (profile, plan['action']) == (profile, action)
+        assert bool(plan['reasons']) == (action != 'copy')
+        if plan['video']:
+            assert plan['video'] == ('copy' if action in ('copy', 'audio') else 'encode')
+
+
+def test_transcode_plan_downscale_args(monkeypatch):
+    monkeypatch.setattr(ccast, 'transcode_device', 'gen3')
+    plan = ccast.transcode_plan('/movies/film.mkv', probe(h264(3840, 1600, level = 41), audio()))
+    assert plan['video'] == 'encode' and plan['audio'] == 'copy'
+    assert plan['args'][plan['args'].index('-vf') + 1] == 'scale=1920:800'
+    assert plan['args'][plan['args'].index('-level:v') + 1] == '4.2'
+    plan = ccast.transcode_plan('/movies/film.mkv', probe(h264(fps = '120/1', level = 42), audio()))
+    assert plan['action'] == 'downscale'
+    assert plan['args'][plan['args'].index('-r') + 1] == '60'
+
+
+def test_transcode_plan_streams(monkeypatch):
+    monkeypatch.setattr(ccast, 'transcode_device', 'gen3')
+    cover = dict(h264(600, 600), codec_name = 'mjpeg', disposition = { 'attached_pic': 1 })
+    plan = ccast.transcode_plan('/movies/film.mkv', probe(cover, h264(), audio('ac3', 6, 'fre', default = 1),
+        audio('aac', 2, 'eng'), audio('aac', 2, 'ger')))
+    # The cover art is ignored and the English audio chosen, so nothing is encoded
+    assert (plan['video_stream'], plan['audio_stream'], plan['action']) == (1, 3, 'copy')
+    assert plan['args'] == ['-map', '0:1', '-c:v', 'copy', '-map', '0:3', '-c:a', 'copy']
+    plan = ccast.transcode_plan('/movies/film.mkv', probe(h264(), audio('aac', 2, 'fre'), audio('ac3', 6, 'ger', default = 1)))
+    assert (plan['audio_stream'], plan['action']) == (2, 'audio')
+    assert plan['args'][-4:] == ['-c:a', 'aac', '-ac', '2']
+
+
+# ---------------------------------------------------------------------
+# Replacing the Chromecast when discovery finds it at another address
+
+def test_use_chromecast(media_dir, monkeypatch):
+    import fakecast
+    monkeypatch.setattr(ccast, 'cast', None)
+    monkeypatch.setattr(ccast, 'monitored_cast', None)
+    monkeypatch.setattr(ccast, 'cast_shelf_file', str(media_dir / 'ccastplayer.shelf'))
+    saved = fakecast.FakeChromecast('TV', host = '192.0.2.1')
+    found = fakecast.FakeChromecast('TV', host = '192.0.2.2')
+    disconnected = []
+    disconnect = saved.disconnect
+    def record_disconnect(*args, **kwargs):
+        disconnected.append(kwargs.get('timeout'))
+        return disconnect(*args, **kwargs) # with the same signature as pychromecast's
+    monkeypatch.setattr(saved, 'disconnect', record_disconnect)
+    ccast.use_chromecast(saved)
+    assert ccast.cast is saved and ccast.monitored_cast is saved
+    ccast.use_chromecast(found, save = True)
+    assert ccast.cast is found and ccast.monitored_cast is found
+    assert disconnected == [0]
+    assert ccast.cast_info_load('TV')[0] == '192.0.2.2'
+    # The same device at the same address keeps the existing connection
+    ccast.use_chromecast(fakecast.FakeChromecast('TV', host = '192.0.2.2'))
+    assert ccast.cast is found and ccast.monitored_cast is found
+
+
+# ---------------------------------------------------------------------
+# Sidecar subtitle files
+
+def test_subtitle_sidecars(media_dir, monkeypatch):
+    for name in ['Film.mkv', 'Film.Extended.mkv', 'Film.Extended.srt', 'Film.Cut.srt', 'Film.en.forced.srt',
+            'Film.fre.srt', 'Film.mkv.vtt', 'Other.avi', 'Other.mkv.srt', 'Show.mp4', 'Show.srt']:
+        (media_dir / name).write_bytes(b'')
+    def sidecars(name):
+        return [(track['source'], track['lang']) for track in ccast.subtitle_tracks(str(media_dir / name), probe = {})]
+    def listed():
+        return { entry['path']: entry['subtitles'] for entry in ccast.library.read_dir('')[1] }
+
+    # Only .vtt files can be sent without --subtitle_dir
+    monkeypatch.setattr(ccast, 'subtitle_dir', None)
+    assert sidecars('Film.mkv') == [('Film.mkv.vtt', None)]
+    assert sidecars('Show.mp4') == []
+    assert listed() == { 'Film.mkv': True, 'Film.Extended.mkv': False, 'Other.avi': False, 'Show.mp4': False }
+
+    monkeypatch.setattr(ccast, 'subtitle_dir', str(media_dir / 'subtitles'))
+    assert sidecars('Film.mkv') == [('Film.en.forced.srt', 'en'), ('Film.fre.srt', 'fr'), ('Film.mkv.vtt', None)]
+    assert sidecars('Film.Extended.mkv') == [('Film.Extended.srt', None)]
+    assert sidecars('Other.avi') == []
+    assert sidecars('Show.mp4') == [('Show.srt', None)]
+    assert listed() == { 'Film.mkv': True, 'Film.Extended.mkv': True, 'Other.avi': False, 'Show.mp4': True }
+
+
+# ---------------------------------------------------------------------
+# The slow transcode warning
+
+def test_transcode_slow_warning(monkeypatch):
+    process = ccast.Transcoder.__new__(ccast.Transcoder)
+    process.purpose, process.filename = 'stream', 'Film.mkv'
+    process.progress, process.slow_since, process.slow_warned = {}, None, False
+    process.drained = process.drained_checked = 0
+    now = [1000.0]
+    monkeypatch.setattr(ccast.time, 'time', lambda: now[0])
+    def block(out_time, drained = 1, speed = '3.00x'):
+        now[0] += 5
+        process.drained += drained
+        process.update_progress({ 'out_time_us': str(int(out_time * 1000000)), 'speed': speed,
+            'fps': '24', 'bitrate': '2345.6kbits/s', 'progress': 'continue' })
+        return process.slow_warned
+
+    # ffmpeg's average speed is high from the fast start, but it has been at half speed for 30 seconds
+    assert [block(t) for t in (60, 62.5, 65, 67.5, 70, 72.5, 75, 77.5)] == [False] * 7 + [True]
+    assert process.progress['rate'] == 0.5
+    assert not block(90) # back to real time
+    # Blocked on the pipe because the Chromecast isn't reading, so not slow
+    assert [block(90 + i, drained = 0) for i in range(10)] == [False] * 10
+    assert process.slow_since is None
+    # A transcode to a file doesn't need to be read from
+    process.purpose = 'hls'
+    assert [block(100 + i, drained = 0) for i in range(7)] == [False] * 6 + [True]